@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+# *****************************************************************************
+# batch_s3_inventory.py
+# *****************************************************************************
+
+# Purpose:
+# In-memory inventory of the keys of an S3 bucket, used by the batch
+# simulators to check which files exist. Each pfaf_{basin}/{exp}/{mod}/{stp}/
+# prefix is listed once with a paginated list_objects_v2, and the listing can
+# be refreshed incrementally for a single month.
+# Authors:
+# Manu Tom, Cedric H. David, 2023-2025
+
+import logging
+import boto3
+import botocore.exceptions
+
+
+# Custom exception for token expiry
+class TokenExpiredException(Exception):
+    pass
+
+
+# *****************************************************************************
+# Inventory of the keys of an S3 bucket
+# *****************************************************************************
+class S3Inventory:
+    """
+    Index of the keys existing in an S3 bucket, filled prefix by prefix.
+    Parameters:
+    bucket_name (str): Name of the S3 bucket.
+    profile_name (str): AWS profile used to list the bucket.
+    """
+
+    def __init__(self, bucket_name, profile_name='saml-pub'):
+        session = boto3.session.Session(profile_name=profile_name)
+        self.s3_client = session.client('s3')
+        self.bucket_name = bucket_name
+        self.keys = set()
+        self.prefixes = set()
+        self.n_list_calls = 0
+
+    # -------------------------------------------------------------------------
+    # Prefix of the chain (basin, exp, mod, stp) a key belongs to
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def chain_prefix(s3_key):
+        return "/".join(s3_key.split("/")[:4]) + "/"
+
+    # -------------------------------------------------------------------------
+    # List a prefix and replace the keys known under it
+    # -------------------------------------------------------------------------
+    def refresh(self, prefix):
+        keys = set()
+        paginator = self.s3_client.get_paginator('list_objects_v2')
+        try:
+            for page in paginator.paginate(Bucket=self.bucket_name,
+                                           Prefix=prefix):
+                self.n_list_calls += 1
+                keys.update(obj['Key'] for obj in page.get('Contents', []))
+        except botocore.exceptions.ClientError as e:
+            if e.response['Error']['Code'] == 'ExpiredToken':
+                raise TokenExpiredException("ERROR: AWS Token expired.")
+            raise
+        self.keys = {key for key in self.keys
+                     if not key.startswith(prefix)} | keys
+        if not any(prefix.startswith(known) for known in self.prefixes):
+            self.prefixes.add(prefix)
+        logging.info(f"Listed {len(keys)} keys under "
+                     f"s3://{self.bucket_name}/{prefix}")
+        return keys
+
+    # -------------------------------------------------------------------------
+    # List again all the prefixes already known
+    # -------------------------------------------------------------------------
+    def refresh_all(self):
+        for prefix in sorted(self.prefixes):
+            self.refresh(prefix)
+
+    # -------------------------------------------------------------------------
+    # Check if a key exists, listing its chain prefix on first use, or only
+    # its parent "folder" (e.g. one month) when refresh is requested
+    # -------------------------------------------------------------------------
+    def exists(self, s3_key, refresh=False):
+        if refresh:
+            self.refresh(s3_key.rsplit("/", 1)[0] + "/")
+        elif not any(s3_key.startswith(known) for known in self.prefixes):
+            self.refresh(self.chain_prefix(s3_key))
+        return s3_key in self.keys
+
+
+# *****************************************************************************
+# End
+# *****************************************************************************
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+# *****************************************************************************
+# batch_scheduler.py
+# *****************************************************************************
+
+# Purpose:
+# Dependency-aware scheduler for the batch simulators. Each node of the graph
+# is one (basin, exp, mod, stp, month) simulation, and depends on the output
+# of the previous month of the same chain (its Qinit). All independent chains
+# advance at once, with a limit on the number of simulations in flight, and
+# each successor is dispatched as soon as the output of its predecessor
+# appears.
+# Authors:
+# Manu Tom, Cedric H. David, 2023-2025
+
+import logging
+import time
+
+
+# *****************************************************************************
+# Scheduler of chains of dependent simulations
+# *****************************************************************************
+class ChainScheduler:
+    """
+    Parameters:
+    chains (dict): Months to simulate (list) for each chain key.
+    is_ready (callable): is_ready(key, month) is True when the input the
+        simulation of that month depends on exists.
+    dispatch (callable): dispatch(key, month) submits the simulation.
+    max_in_flight (int): Maximum number of simulations dispatched and not
+        completed yet.
+    poll_interval (float): Time to wait between two polls (in seconds).
+    max_wait (float): Time after which a chain that does not advance is
+        considered failed (in seconds).
+    flush (callable): Optional, called after each round of dispatches, e.g.
+        to send the submissions of the round in bulk.
+    """
+
+    def __init__(self, chains, is_ready, dispatch, max_in_flight=10,
+                 poll_interval=10, max_wait=250, flush=None):
+        self.chains = {key: list(months) for key, months in chains.items()}
+        self.is_ready = is_ready
+        self.dispatch = dispatch
+        self.max_in_flight = max_in_flight
+        self.poll_interval = poll_interval
+        self.max_wait = max_wait
+        self.flush = flush
+        self.failed = {}
+
+    # -------------------------------------------------------------------------
+    # Month following yyyy_mm, whose input is the output of yyyy_mm
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def next_month(yyyy_mm):
+        year, month = int(yyyy_mm[:4]), int(yyyy_mm[5:7])
+        if month == 12:
+            return f"{year + 1}-01"
+        return f"{year}-{month + 1:02d}"
+
+    # -------------------------------------------------------------------------
+    # Run all chains until they are completed or failed
+    # -------------------------------------------------------------------------
+    def run(self):
+        position = {key: 0 for key in self.chains}  # index of current node
+        in_flight = {}  # chain key -> time of dispatch of current node
+        waiting = {key: time.time() for key in self.chains}  # not dispatched
+        t_start = time.time()
+        n_dispatched = 0
+
+        while waiting or in_flight:
+            # Completed nodes: the input of their successor exists
+            for key in list(in_flight):
+                month = self.chains[key][position[key]]
+                if self.is_ready(key, self.next_month(month)):
+                    del in_flight[key]
+                    position[key] += 1
+                    if position[key] < len(self.chains[key]):
+                        # the successor is ready right away
+                        waiting[key] = None
+                    else:
+                        logging.info(f"Chain {key} completed")
+                elif time.time() - in_flight[key] > self.max_wait:
+                    self._fail(key, month, in_flight)
+
+            # Dispatch ready nodes, oldest waiting chains first
+            for key in list(waiting):
+                if len(in_flight) >= self.max_in_flight:
+                    break
+                month = self.chains[key][position[key]]
+                since = waiting[key]
+                if since is None or self.is_ready(key, month):
+                    del waiting[key]
+                    self.dispatch(key, month)
+                    in_flight[key] = time.time()
+                    n_dispatched += 1
+                elif time.time() - since > self.max_wait:
+                    self._fail(key, month, waiting)
+            if self.flush is not None:
+                self.flush()
+
+            if waiting or in_flight:
+                message = (
+                    f"{len(in_flight)} simulation(s) in flight, "
+                    f"{len(waiting)} chain(s) waiting, "
+                    f"{n_dispatched} dispatched"
+                    )
+                logging.info(message)
+                print(message)
+                time.sleep(self.poll_interval)
+
+        print(
+            f"[Profiling] Makespan: {time.time() - t_start:.2f} seconds "
+            f"for {len(self.chains)} chain(s)"
+            )
+        return self.failed
+
+    # -------------------------------------------------------------------------
+    # Stop a chain that did not advance in time
+    # -------------------------------------------------------------------------
+    def _fail(self, key, month, queue):
+        del queue[key]
+        self.failed[key] = month
+        error_message = (
+            f"Max waiting time reached for {month}, chain {key}. "
+            f"Stopping this chain."
+            )
+        logging.error(error_message)
+        print(error_message)
+
+
+# *****************************************************************************
+# End
+# *****************************************************************************
@@ -8,10 +8,12 @@
 # Authors:
 # Manu Tom, Cedric H. David, 2023-2025
 
-import subprocess
 import logging
 import os
 import time
+from batch_s3_inventory import S3Inventory, TokenExpiredException
+from batch_scheduler import ChainScheduler
+from batch_sqs_submitter import SQSSubmitter
 
 # Configure logging
 log_file_path = os.path.abspath(os.path.join(os.path.dirname(__file__),
@@ -33,26 +35,26 @@ basin_ids = ["74"]
 bucket_name = "currnt-data"
 # Time to wait between retries (in seconds)
 retry_interval = 10
+# Maximum number of monthly simulations in flight across all chains
+max_in_flight = 10
 
 
-# Custom exception for token expiry
-class TokenExpiredException(Exception):
-    pass
+# Inventory of the keys of the bucket, listed once per basin/model
+inventory = S3Inventory(bucket_name)
+# Submission of the simulations, sent in bulk once per scheduling round
+# (SQS queue from CURRNT_RAPID_QUEUE_URL, read at the first submission)
+submitter = SQSSubmitter(queue_url_env="CURRNT_RAPID_QUEUE_URL")
 
 
 # *****************************************************************************
 # Check if the file exists in the specified S3 bucket
 # *****************************************************************************
-def check_file_exists(bucket_name, file_path):
-    exists_command = (
-        f"aws s3 ls s3://{bucket_name}/{file_path} "
-        f"--profile saml-pub"
-            )
-    result = subprocess.run(exists_command, shell=True, stdout=subprocess.PIPE,
-                            stderr=subprocess.PIPE)
-    if "ExpiredToken" in result.stderr.decode():
-        raise TokenExpiredException("ERROR: AWS Token expired.")
-    return result.returncode == 0
+def check_file_exists(bucket_name, file_path, refresh=False):
+    """
+    Answer from the inventory of the bucket, listing the folder of the file
+    again first if refresh is True.
+    """
+    return inventory.exists(file_path, refresh=refresh)
 
 
 # *****************************************************************************
@@ -79,30 +81,14 @@ def process_files(basin_id, year, month, lsm_exp, lsm_mod, lsm_stp):
             )
         logging.info(message)
         print(message)
-        command = (
-            "awscurl --region us-west-2 --service execute-api "
-            "--profile saml-pub -X POST "
-            f"-d '{{\"basin_id\":\"{basin_id}\", "
-            f"\"lsm_exp\":\"{lsm_exp}\", "
-            f"\"lsm_mod\":\"{lsm_mod}\", "
-            f"\"lsm_stp\":\"{lsm_stp}\", "
-            f"\"s3_name\":\"{bucket_name}\", "
-            f"\"yyyy_mm\":\"{year}-{month}\"}}' "
-            "https://89uomm6sf8.execute-api.us-west-2.amazonaws.com/"
-            "dev/processes/dx1822/execution/sqs-post"
-            )
-        process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE,
-                                   stderr=subprocess.PIPE)
-        output, error = process.communicate()
-        if error:
-            error_message = (
-                f"Error processing files for {year}-{month}: "
-                f"{error.decode()}"
-                )
-            logging.error(error_message)
-            print(error_message)
-        else:
-            print("Output:", output.decode())
+        submitter.add({
+            "basin_id": basin_id,
+            "lsm_exp": lsm_exp,
+            "lsm_mod": lsm_mod,
+            "lsm_stp": lsm_stp,
+            "s3_name": bucket_name,
+            "yyyy_mm": f"{year}-{month}"
+            })
     elif not m3_exists:
         warning_message = (
             f"m3 file does not exist for {year}-{month}, "
@@ -138,67 +124,74 @@ def get_lsm_mods(lsm_exp):
 
 
 # *****************************************************************************
-# Multi-year simulations
+# Check if the Qinit file a monthly simulation depends on exists
+# *****************************************************************************
+def qinit_exists(chain_key, yyyy_mm):
+    basin_id, lsm_exp, lsm_mod, lsm_stp = chain_key
+    # No dependency within 1979 (spin-up year)
+    if yyyy_mm.startswith("1979"):
+        return True
+    qinit_file_path = (
+        f"pfaf_{basin_id}/{lsm_exp}/{lsm_mod}/"
+        f"{lsm_stp}/{yyyy_mm}/Qinit_pfaf_"
+        f"{basin_id}_{lsm_exp}_{lsm_mod}_"
+        f"{lsm_stp}_{yyyy_mm}.nc"
+    )
+    exists = check_file_exists(bucket_name, qinit_file_path, refresh=True)
+    if not exists:
+        message = (
+            f"Qinit file does not exist for {yyyy_mm}, Basin ID: "
+            f"{basin_id}, LSM Model: {lsm_mod}. Waiting and retrying."
+        )
+        logging.info(message)
+    return exists
+
+
+# *****************************************************************************
+# Submit a monthly simulation
+# *****************************************************************************
+def dispatch(chain_key, yyyy_mm):
+    basin_id, lsm_exp, lsm_mod, lsm_stp = chain_key
+    year, month = yyyy_mm.split("-")
+    process_files(basin_id, year, month, lsm_exp, lsm_mod, lsm_stp)
+
+
+# *****************************************************************************
+# Multi-year simulations: one chain of months per basin/LSM model, all chains
+# advancing concurrently
 # *****************************************************************************
 max_retry_attempts = 25  # Define a maximum number of retry attempts
+chains = {}
+for basin_id in basin_ids:
+    for lsm_exp in lsm_exps:
+        lsm_mods = get_lsm_mods(lsm_exp)
+        for lsm_mod in lsm_mods:
+            for lsm_stp in lsm_stps:
+                chains[(basin_id, lsm_exp, lsm_mod, lsm_stp)] = [
+                    f"{year}-{month}"
+                    for year in range(start_year, end_year + 1)
+                    for month in months
+                    ]
 try:
-    for basin_id in basin_ids:
-        for lsm_exp in lsm_exps:
-            lsm_mods = get_lsm_mods(lsm_exp)
-            for lsm_mod in lsm_mods:
-                for lsm_stp in lsm_stps:
-                    for year in range(start_year, end_year + 1):
-                        t_start = time.time()
-                        for month in months:
-                            if year == 1979:
-                                process_files(
-                                    basin_id, year, month, lsm_exp,
-                                    lsm_mod, lsm_stp
-                                )
-                            else:
-                                qinit_file_path = (
-                                    f"pfaf_{basin_id}/{lsm_exp}/{lsm_mod}/"
-                                    f"{lsm_stp}/{year}-{month}/Qinit_pfaf_"
-                                    f"{basin_id}_{lsm_exp}_{lsm_mod}_"
-                                    f"{lsm_stp}_{year}-{month}.nc"
-                                )
-                                retry_count = 0  # Initialize retry count
-                                while (
-                                    retry_count < max_retry_attempts and
-                                    not check_file_exists(
-                                        bucket_name, qinit_file_path
-                                    )
-                                ):
-                                    message = (
-                                        f"Qinit file does not exist for "
-                                        f"{year}-{month}, Basin ID: "
-                                        f"{basin_id}. "
-                                        f"Waiting and retrying."
-                                    )
-                                    logging.info(message)
-                                    print(message)  # Print the message
-                                    time.sleep(retry_interval)
-                                    retry_count += 1
-                                if retry_count == max_retry_attempts:
-                                    error_message = (
-                                        f"Max retry attempts reached for "
-                                        f"{year}-{month}, Basin ID: "
-                                        f"{basin_id}. Quitting."
-                                    )
-                                    logging.error(error_message)
-                                    print(error_message)
-                                    raise RuntimeError(error_message)
-                                else:
-                                    process_files(
-                                        basin_id, year, month, lsm_exp,
-                                        lsm_mod, lsm_stp
-                                    )
-                        t_end = time.time()
-                        total_runtime = t_end - t_start
-                        print(
-                            f"[Profiling] Total RunTime: "
-                            f"{total_runtime:.2f} seconds"
-                            )
+    t_start = time.time()
+    scheduler = ChainScheduler(chains, qinit_exists, dispatch,
+                               max_in_flight=max_in_flight,
+                               poll_interval=retry_interval,
+                               max_wait=max_retry_attempts * retry_interval,
+                               flush=submitter.flush)
+    failed = scheduler.run()
+    t_end = time.time()
+    total_runtime = t_end - t_start
+    print(f"[Profiling] Total RunTime: {total_runtime:.2f} seconds")
+    print(f"[Profiling] S3 list calls: {inventory.n_list_calls}")
+    if failed:
+        error_message = (
+            f"Max retry attempts reached for {len(failed)} chain(s): "
+            f"{failed}. Quitting."
+        )
+        logging.error(error_message)
+        print(error_message)
+        raise RuntimeError(error_message)
 except TokenExpiredException as e:
     logging.error(str(e))
     print(str(e))
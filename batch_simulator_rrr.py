@@ -8,9 +8,10 @@
 # Authors:
 # Manu Tom, Cedric H. David, 2023-2025
 
-import subprocess
 import logging
 import time
+from batch_s3_inventory import S3Inventory, TokenExpiredException
+from batch_sqs_submitter import SQSSubmitter
 
 # Define the start and end years
 start_year = 1980
@@ -27,57 +28,54 @@ bucket_name = "currnt-data"
 # Set up logging
 logging.basicConfig(filename='logs_rrr_simulations.txt', level=logging.INFO,
                     format='%(asctime)s - %(levelname)s - %(message)s')
+# Inventory of the keys of the bucket, listed once per basin/model
+inventory = S3Inventory(bucket_name)
+# Submission of the simulations, sent in bulk once per pass
+# (SQS queue from CURRNT_RRR_QUEUE_URL, read at the first submission)
+submitter = SQSSubmitter(queue_url_env="CURRNT_RRR_QUEUE_URL")
 
 
 # *****************************************************************************
 # Check if a file exists in S3
 # *****************************************************************************
 def s3_file_exists(s3_file_path):
-    check_command = f"aws s3 ls {s3_file_path} --profile saml-pub"
-    process = subprocess.Popen(check_command, shell=True,
-                               stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    output, error = process.communicate()
-    if error:
-        error_message = f"Error checking S3: {error.decode()}"
+    bucket, s3_key = s3_file_path[len("s3://"):].split("/", 1)
+    try:
+        return bucket == inventory.bucket_name and inventory.exists(s3_key)
+    except TokenExpiredException as e:
+        logging.error(str(e))
+        print(str(e))
+        raise
+    except Exception as e:
+        error_message = f"Error checking S3: {e}"
         logging.error(error_message)
         print(error_message)
         return False
-    return bool(output)
 
 
 # *****************************************************************************
-# Initiate the process by sending a POST request, API->SQS
+# Queue a simulation message, API->SQS replaced by direct SQS submission
 # *****************************************************************************
 def send_message(basin_id, lsm_exp, lsm_mod, lsm_stp, bucket_name,
                  year, month):
-    command = (
-        f"awscurl --region us-west-2 --service execute-api --profile saml-pub "
-        f"--data '{{\"messageGroupId\": \"default-group\"}}' -X POST "
-        f"-d '{{\"basin_id\":\"{basin_id}\", \"lsm_exp\":\"{lsm_exp}\", "
-        f"\"lsm_mod\":\"{lsm_mod}\", \"lsm_stp\":\"{lsm_stp}\", "
-        f"\"s3_name\":\"{bucket_name}\", \"yyyy_mm\":\"{year}-{month}\"}}' "
-        f"\"https://qs4oqdywqc.execute-api.us-west-2.amazonaws.com/"
-        f"dev/processes/dx1822/execution/sqs-post\""
+    submitter.add({
+        "basin_id": basin_id,
+        "lsm_exp": lsm_exp,
+        "lsm_mod": lsm_mod,
+        "lsm_stp": lsm_stp,
+        "s3_name": bucket_name,
+        "yyyy_mm": f"{year}-{month}"
+        })
+    message = (
+        f"Message queued for Basin ID: {basin_id}, "
+        f"LSM Experiment: {lsm_exp}, "
+        f"LSM Model: {lsm_mod}, "
+        f"LSM Step: {lsm_stp}, "
+        f"Year: {year}, "
+        f"Month: {month}."
         )
-    process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE,
-                               stderr=subprocess.PIPE)
-    output, error = process.communicate()
-    if error:
-        error_message = f"Error initiating process: {error.decode()}"
-        logging.error(error_message)
-        print(error_message)
-    else:
-        success_message = (
-            f"HTTP POST send for Basin ID: {basin_id}, "
-            f"LSM Experiment: {lsm_exp}, "
-            f"LSM Model: {lsm_mod}, "
-            f"LSM Step: {lsm_stp}, "
-            f"Year: {year}, "
-            f"Month: {month}. "
-            f"Response: {output.decode()}"
-            )
-        logging.info(success_message)
-        print(success_message)
+    logging.info(message)
+    print(message)
 
 
 # *****************************************************************************
@@ -118,6 +116,8 @@ for basin_id in basin_ids:
 # Process tasks until all files exist in S3
 # *****************************************************************************
 while tasks:
+    # List again the prefixes already known, once per pass
+    inventory.refresh_all()
     # Iterate over a copy of the tasks list to allow removal of tasks
     # while iterating
     for task in tasks[:]:
@@ -132,6 +132,8 @@ while tasks:
         else:
             send_message(basin_id, lsm_exp, lsm_mod, lsm_stp, bucket_name,
                          year, month)
+    # Send all the messages of this pass at once
+    submitter.flush()
     # If there are still tasks remaining, wait for 20 minutes before retrying
     if tasks:
         time.sleep(20*60)
@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+# *****************************************************************************
+# batch_sqs_submitter.py
+# *****************************************************************************
+
+# Purpose:
+# In-process submission of simulation messages to an SQS queue, used by the
+# batch simulators. Messages are sent in batches with SendMessageBatch
+# (optionally several messages per body, separated by newlines, which the
+# Lambda handlers split), batches are sent concurrently, and the entries
+# that failed are retried individually. On FIFO queues, the messages of a
+# chain (basin/LSM model) share a message group, so that the months of a
+# chain are received in order while independent chains run concurrently.
+# Authors:
+# Manu Tom, Cedric H. David, 2023-2025
+
+import os
+import json
+import hashlib
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+import boto3
+import botocore.exceptions
+from batch_s3_inventory import TokenExpiredException
+
+
+# Limits of SendMessageBatch
+MAX_BATCH_ENTRIES = 10
+MAX_BATCH_BYTES = 256 * 1024
+
+
+# *****************************************************************************
+# Message group of a message: its chain, e.g. pfaf_74_GLDAS_VIC_3H
+# *****************************************************************************
+def message_group(message):
+    basin_id = message.get('basin_id', message.get('basin_ids'))
+    if isinstance(basin_id, (list, tuple)):
+        basin_id = '-'.join(str(basin) for basin in basin_id)
+    return "pfaf_{}_{}_{}_{}".format(basin_id, message.get('lsm_exp'),
+                                     message.get('lsm_mod'),
+                                     message.get('lsm_stp'))
+
+
+# *****************************************************************************
+# Submitter of simulation messages to an SQS queue
+# *****************************************************************************
+class SQSSubmitter:
+    """
+    Parameters:
+    queue_url (str): URL of the SQS queue.
+    queue_url_env (str): Environment variable holding the URL of the SQS
+        queue, read at the first submission if queue_url is None.
+    profile_name (str): AWS profile used to send the messages.
+    region_name (str): AWS region of the queue.
+    messages_per_body (int): Number of messages packed in one SQS body.
+    max_workers (int): Number of batches sent concurrently.
+    max_attempts (int): Number of attempts for each entry.
+    message_group_id (str): Message group of all messages on FIFO queues,
+        one group per chain (see message_group) if None.
+    """
+
+    def __init__(self, queue_url=None, queue_url_env=None,
+                 profile_name='saml-pub', region_name='us-west-2',
+                 messages_per_body=1, max_workers=8, max_attempts=5,
+                 message_group_id=None):
+        self.queue_url = queue_url
+        self.queue_url_env = queue_url_env
+        self.profile_name = profile_name
+        self.region_name = region_name
+        self.messages_per_body = messages_per_body
+        self.max_workers = max_workers
+        self.max_attempts = max_attempts
+        self.message_group_id = message_group_id
+        self.sqs_client = None
+        self.pending = []
+
+    # -------------------------------------------------------------------------
+    # Resolve the queue and create the SQS client at the first submission, so
+    # that importing a simulator does not require the queue
+    # -------------------------------------------------------------------------
+    def _connect(self):
+        if self.sqs_client is not None:
+            return
+        if not self.queue_url and self.queue_url_env:
+            self.queue_url = os.environ.get(self.queue_url_env)
+        if not self.queue_url:
+            raise ValueError("No SQS queue URL given"
+                             + (f" (set {self.queue_url_env})"
+                                if self.queue_url_env else "") + ".")
+        session = boto3.session.Session(profile_name=self.profile_name,
+                                        region_name=self.region_name)
+        self.sqs_client = session.client('sqs')
+
+    @property
+    def fifo(self):
+        return bool(self.queue_url) and self.queue_url.endswith('.fifo')
+
+    # -------------------------------------------------------------------------
+    # Queue a message, sent with the next flush
+    # -------------------------------------------------------------------------
+    def add(self, message):
+        self.pending.append(message)
+
+    # -------------------------------------------------------------------------
+    # Send all queued messages
+    # -------------------------------------------------------------------------
+    def flush(self):
+        messages, self.pending = self.pending, []
+        if not messages:
+            return {'submitted': 0, 'failed': [], 'runtime_sec': 0.0,
+                    'messages_per_sec': 0.0}
+        try:
+            return self.submit(messages)
+        except Exception:
+            # e.g. expired token: the messages are queued again, not lost
+            self.pending = messages + self.pending
+            raise
+
+    # -------------------------------------------------------------------------
+    # Send a list of messages (dict) and return submission statistics
+    # -------------------------------------------------------------------------
+    def submit(self, messages):
+        self._connect()
+        t_start = time.time()
+        # Only messages of the same group share a body, in their order
+        groups = {}
+        for message in messages:
+            groups.setdefault(self._group(message), []).append(message)
+        bodies = [
+            (group, "\n".join(json.dumps(message) for message in
+                              group_messages[i:i + self.messages_per_body]))
+            for group, group_messages in groups.items()
+            for i in range(0, len(group_messages), self.messages_per_body)
+            ]
+        batches = self._batches(bodies)
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            failed = [body for batch_failed in
+                      executor.map(self._send_batch, batches)
+                      for body in batch_failed]
+        runtime = time.time() - t_start
+        submitted = len(messages) - sum(len(body.split("\n"))
+                                        for body in failed)
+        rate = submitted / runtime if runtime > 0 else 0.0
+        message = (
+            f"Submitted {submitted} of {len(messages)} message(s) in "
+            f"{len(bodies)} body(ies), {len(batches)} batch(es): "
+            f"{rate:.1f} messages per second"
+            )
+        logging.info(message)
+        print(message)
+        for body in failed:
+            error_message = f"Failed to submit: {body}"
+            logging.error(error_message)
+            print(error_message)
+        return {'submitted': submitted, 'failed': failed,
+                'runtime_sec': runtime, 'messages_per_sec': rate}
+
+    # -------------------------------------------------------------------------
+    # Message group of a message on FIFO queues
+    # -------------------------------------------------------------------------
+    def _group(self, message):
+        if self.message_group_id is not None:
+            return self.message_group_id
+        return message_group(message)
+
+    # -------------------------------------------------------------------------
+    # Group (group, body) pairs in batches within the limits of
+    # SendMessageBatch
+    # -------------------------------------------------------------------------
+    def _batches(self, bodies):
+        batches = [[]]
+        size = 0
+        for group, body in bodies:
+            body_size = len(body.encode())
+            if batches[-1] and (len(batches[-1]) == MAX_BATCH_ENTRIES or
+                                size + body_size > MAX_BATCH_BYTES):
+                batches.append([])
+                size = 0
+            batches[-1].append((group, body))
+            size += body_size
+        return [batch for batch in batches if batch]
+
+    # -------------------------------------------------------------------------
+    # Send one batch, retrying the failed entries, return bodies not sent
+    # -------------------------------------------------------------------------
+    def _send_batch(self, bodies):
+        groups = [group for group, _ in bodies]
+        remaining = dict(enumerate(body for _, body in bodies))
+        rejected = []
+        for attempt in range(self.max_attempts):
+            if not remaining:
+                break
+            if attempt > 0:
+                time.sleep(min(2 ** attempt * 0.1, 5))
+            entries = []
+            for idx, body in remaining.items():
+                entry = {'Id': str(idx), 'MessageBody': body}
+                if self.fifo:
+                    entry['MessageGroupId'] = groups[idx]
+                    entry['MessageDeduplicationId'] = hashlib.sha256(
+                        body.encode()).hexdigest()
+                entries.append(entry)
+            try:
+                response = self.sqs_client.send_message_batch(
+                    QueueUrl=self.queue_url, Entries=entries)
+            except botocore.exceptions.ClientError as e:
+                if e.response['Error']['Code'] == 'ExpiredToken':
+                    raise TokenExpiredException("ERROR: AWS Token expired.")
+                logging.warning(f"SendMessageBatch failed: {e}")
+                continue
+            except botocore.exceptions.BotoCoreError as e:
+                # e.g. EndpointConnectionError or ReadTimeoutError, transient
+                logging.warning(f"SendMessageBatch failed: {e}")
+                continue
+            for success in response.get('Successful', []):
+                del remaining[int(success['Id'])]
+            for failure in response.get('Failed', []):
+                # Entries rejected because of their content are not retried
+                if failure.get('SenderFault'):
+                    logging.error(f"Rejected message: {failure}")
+                    rejected.append(remaining.pop(int(failure['Id'])))
+        return rejected + list(remaining.values())
+
+
+# *****************************************************************************
+# End
+# *****************************************************************************
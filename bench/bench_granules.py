@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+# *****************************************************************************
+# bench_granules.py
+# *****************************************************************************
+
+# Purpose:
+# Offline benchmark of the granule downloader of drv_granules.py. Synthetic
+# granules are served by a local HTTPS stand-in (HTTP server with Range
+# requests) and by a local S3 stand-in (moto server) for the direct access
+# of us-west-2, and are downloaded with drv_download for each access mode.
+# The files are checked against their checksums, one partial file is resumed
+# and, with --fallback, one granule missing from S3 is read through HTTPS.
+# Authors:
+# Manu Tom, Cedric H. David, 2023-2025
+
+
+# *****************************************************************************
+# Example usage
+# *****************************************************************************
+# python3 bench/bench_granules.py --granules 16 --size-mb 8 \
+#     --access external,direct --fallback
+
+
+# *****************************************************************************
+# Import libraries
+# *****************************************************************************
+import os
+import sys
+import time
+import types
+import shutil
+import socket
+import hashlib
+import argparse
+import tempfile
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+# *****************************************************************************
+# set parameters
+# *****************************************************************************
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PROVIDER = 'GES_DISC'
+BUCKET = 'gesdisc-cumulus-prod-protected'
+PREFIX = 'GLDAS_NOAH025_3H.2.1'
+
+
+# *****************************************************************************
+# Helper functions
+# *****************************************************************************
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+# *****************************************************************************
+# Synthetic granules, with the UMM fields read by drv_granules
+# *****************************************************************************
+class BenchGranule(dict):
+    def data_links(self, access=None):
+        urls = [url['URL'] for url in self['umm']['RelatedUrls']]
+        if access == 'direct':
+            return [url for url in urls if url.startswith('s3://')]
+        return [url for url in urls if not url.startswith('s3://')]
+
+
+def make_granule(name, body, http_port):
+    return BenchGranule({
+        'meta': {'provider-id': PROVIDER},
+        'umm': {
+            'RelatedUrls': [
+                {'URL': f"http://127.0.0.1:{http_port}/{PREFIX}/{name}"},
+                {'URL': f"s3://{BUCKET}/{PREFIX}/{name}"}],
+            'DataGranule': {'ArchiveAndDistributionInformation': [
+                {'Name': name, 'SizeInBytes': len(body),
+                 'Checksum': {'Algorithm': 'SHA-256',
+                              'Value': hashlib.sha256(body).hexdigest()}}]}}})
+
+
+# *****************************************************************************
+# Local HTTPS stand-in of the DAAC, with Range requests
+# *****************************************************************************
+def serve_http(files, requests_served):
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            body = files.get(os.path.basename(self.path))
+            if body is None:
+                self.send_error(404)
+                return
+            requests_served.append(self.path)
+            start = 0
+            if 'Range' in self.headers:
+                start = int(self.headers['Range'].split('=')[1].split('-')[0])
+                if start >= len(body):
+                    self.send_error(416)
+                    return
+                self.send_response(206)
+                self.send_header('Content-Range',
+                                 f"bytes {start}-{len(body) - 1}/{len(body)}")
+            else:
+                self.send_response(200)
+            self.send_header('Content-Length', str(len(body) - start))
+            self.end_headers()
+            self.wfile.write(body[start:])
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+# *****************************************************************************
+# Stand-in of earthaccess: logged-in session and temporary S3 credentials
+# *****************************************************************************
+def stub_earthaccess(credentials_served):
+    import requests
+    earthaccess = types.ModuleType('earthaccess')
+    earthaccess.login = lambda **kwargs: None
+    earthaccess.get_requests_https_session = requests.Session
+
+    def get_s3_credentials(provider=None, **kwargs):
+        credentials_served.append(provider)
+        return {'accessKeyId': 'bench', 'secretAccessKey': 'bench',
+                'sessionToken': 'bench'}
+    earthaccess.get_s3_credentials = get_s3_credentials
+    sys.modules['earthaccess'] = earthaccess
+
+
+# *****************************************************************************
+# Download the granules with one access mode and check the files
+# *****************************************************************************
+def run_access(access, granules, files, work_fldr, workers, served):
+    import drv_granules
+    drv_granules.granule_access = access
+    local_path = os.path.join(work_fldr, access)
+    # a partial download of the first granule, resumed
+    os.makedirs(local_path)
+    name = sorted(files)[0]
+    with open(os.path.join(local_path, name + '.part'), 'wb') as f:
+        f.write(files[name][:len(files[name]) // 2])
+    stats_start = drv_granules.get_granule_stats()
+    n_http = len(served['http'])
+    t_start = time.time()
+    paths = drv_granules.drv_download(granules, local_path, workers)
+    runtime = time.time() - t_start
+    for path in paths:
+        with open(path, 'rb') as f:
+            if f.read() != files[os.path.basename(path)]:
+                raise ValueError(f"{path} differs from its granule")
+    stats = drv_granules.get_granule_stats()
+    return {'access': access,
+            'runtime_sec': runtime,
+            'mb_per_sec': (stats['granule_bytes']
+                           - stats_start['granule_bytes']) / 1e6
+            / max(runtime, 1e-6),
+            'files': len(paths),
+            'https_requests': len(served['http']) - n_http,
+            'retries': (stats['granule_retries']
+                        - stats_start['granule_retries'])}
+
+
+# *****************************************************************************
+# Main
+# *****************************************************************************
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--granules', type=int, default=8)
+    parser.add_argument('--size-mb', type=float, default=4.0)
+    parser.add_argument('--workers', type=int, default=None,
+                        help="CURRNT_DOWNLOAD_WORKERS by default")
+    parser.add_argument('--access', default='external,direct',
+                        help="Comma-separated access modes (external, "
+                        "direct)")
+    parser.add_argument('--fallback', action='store_true',
+                        help="Leave the last granule out of S3, to be read "
+                        "through HTTPS with direct access")
+    args = parser.parse_args()
+
+    # moto is only needed for the benchmarks
+    import logging
+    from moto.server import ThreadedMotoServer
+    port = free_port()
+    s3_server = ThreadedMotoServer(ip_address='127.0.0.1', port=port,
+                                   verbose=False)
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    s3_server.start()
+    os.environ.update({
+        'AWS_ENDPOINT_URL': f"http://127.0.0.1:{port}",
+        'AWS_ACCESS_KEY_ID': 'bench', 'AWS_SECRET_ACCESS_KEY': 'bench',
+        'AWS_REGION': 'us-west-2', 'CURRNT_DOWNLOAD_ATTEMPTS': '2'})
+    sys.path.insert(0, os.path.join(ROOT, 'drv'))
+    served = {'http': [], 'credentials': []}
+    stub_earthaccess(served['credentials'])
+
+    size = int(args.size_mb * 1e6)
+    files = {f"GLDAS_NOAH025_3H.A2000{i:04d}.021.nc4":
+             os.urandom(size + i) for i in range(args.granules)}
+    http_server = serve_http(files, served['http'])
+    import boto3
+    s3 = boto3.client('s3')
+    s3.create_bucket(Bucket=BUCKET, CreateBucketConfiguration={
+        'LocationConstraint': 'us-west-2'})
+    names = sorted(files)
+    for name in names[:-1] if args.fallback else names:
+        s3.put_object(Bucket=BUCKET, Key=f"{PREFIX}/{name}",
+                      Body=files[name])
+    granules = [make_granule(name, files[name], http_server.server_port)
+                for name in names]
+
+    work_fldr = tempfile.mkdtemp(prefix='currnt_granules_')
+    results = []
+    try:
+        for access in args.access.split(','):
+            results.append(run_access(access, granules, files, work_fldr,
+                                      args.workers, served))
+    finally:
+        shutil.rmtree(work_fldr, ignore_errors=True)
+        http_server.shutdown()
+        s3_server.stop()
+
+    print(f"{'access':<10} {'files':>6} {'runtime':>10} {'MB/s':>8} "
+          f"{'HTTPS':>6} {'retries':>8}")
+    for result in results:
+        print(f"{result['access']:<10} {result['files']:>6} "
+              f"{result['runtime_sec']:>8.2f} s "
+              f"{result['mb_per_sec']:>8.1f} "
+              f"{result['https_requests']:>6} {result['retries']:>8}")
+    print(f"S3 credentials requested: {len(served['credentials'])}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,433 @@
+#!/usr/bin/env python3
+# *****************************************************************************
+# bench_handlers.py
+# *****************************************************************************
+
+# Purpose:
+# Offline end-to-end benchmarks of lambda_function_rapid and
+# lambda_function_rrr. The handlers run in-process (one child process per
+# case, for a clean peak memory) against a local S3 stand-in (moto server),
+# with synthetic inputs (gen_synthetic.py) and stub RAPID/RRR drivers whose
+# cost scales with the number of reaches.
+# The latency of each phase, the peak memory and the bytes moved are
+# recorded for a matrix of basin sizes and batch shapes, and compared with a
+# baseline.
+# Authors:
+# Manu Tom, Cedric H. David, 2023-2025
+
+
+# *****************************************************************************
+# Example usage
+# *****************************************************************************
+# python3 bench/bench_handlers.py --reaches 1000,10000 --shapes 1x1,2x3 \
+#     --save-baseline bench_baseline.json
+# python3 bench/bench_handlers.py --reaches 1000,10000 --shapes 1x1,2x3 \
+#     --baseline bench_baseline.json --tolerance 0.25
+
+
+# *****************************************************************************
+# Import libraries
+# *****************************************************************************
+import os
+import sys
+import json
+import time
+import socket
+import shutil
+import argparse
+import resource
+import platform
+import tempfile
+import subprocess
+import gen_synthetic
+
+
+# *****************************************************************************
+# set parameters
+# *****************************************************************************
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STUB_FLDR = os.path.join(ROOT, 'bench', 'stub')
+LSM = gen_synthetic.LSM
+FIRST_MONTH = '2000-01'
+# Metrics compared with the baseline, with the absolute slack allowed on top
+# of the relative tolerance (timing and memory noise)
+METRICS = {'runtime_total_sec': 0.05, 'peak_rss_mb': 5.0, 'bytes_moved': 0}
+# Volumes of a basin of 3 reaches on a 2 x 3 LDAS grid (2 time steps of 3
+# hours), computed by hand: m3 = (RUNSF + RUNSB) (kg m-2 s-1) x 10800 s x
+# area (km2) x 1000. Reach 12 drains 2 cells, reach 13 none (index 0).
+VOL_FIXTURE = {
+    # rivid, area (km2), 1-based lon index, 1-based lat index
+    'coupling': [(11, 2.0, 1, 1), (12, 0.5, 3, 2), (12, 1.5, 2, 1),
+                 (13, 1.0, 0, 0)],
+    'time': [0.0, 3.0],
+    'RUNSF': [[[1e-4] * 3] * 2, [[2e-4] * 3] * 2],
+    'RUNSB': [[[0.0] * 3, [0.0, 0.0, 1e-4]]] * 2,
+    'rivid': [11, 12, 13],
+    'time_bnds': [[0.0, 3.0], [3.0, 6.0]],
+    # 11: 1e-4 x 10800 x 2.0 x 1000 = 2160
+    # 12: (1e-4 + 1e-4) x 10800 x 0.5 x 1000 + 1e-4 x 10800 x 1.5 x 1000
+    #     = 1080 + 1620 = 2700
+    'm3_riv': [[2160.0, 2700.0, 0.0], [4320.0, 4860.0, 0.0]],
+    }
+
+
+# *****************************************************************************
+# Helper functions
+# *****************************************************************************
+def month_list(n_month):
+    year, month = int(FIRST_MONTH[:4]), int(FIRST_MONTH[5:7])
+    months = []
+    for _ in range(n_month):
+        months.append(f"{year}-{month:02d}")
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return months
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def basin_ids(n_basin):
+    return [str(74 + i) for i in range(n_basin)]
+
+
+# *****************************************************************************
+# Peak memory of this process (kB). On Linux, ru_maxrss is inherited from
+# the parent process at fork, so the high water mark of /proc is used instead
+# *****************************************************************************
+def peak_rss_kb():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+# *****************************************************************************
+# Prepare a case: synthetic inputs, and S3 objects for RAPID
+# *****************************************************************************
+def prepare_case(case, s3_client, work_fldr):
+    case_fldr = os.path.join(work_fldr, case['name'])
+    s3_client.create_bucket(Bucket=case['bucket'])
+    for basin_id in basin_ids(case['n_basin']):
+        s3_fldr = gen_synthetic.generate_basin(
+            case_fldr, basin_id, case['n_reach'], case['depth'],
+            case['n_lat'], case['n_lon'], month_list(case['n_month']),
+            case['n_time'])
+    # RRR computes the LDAS and m3 files itself (stub drivers)
+    if case['handler'] == 'rapid':
+        gen_synthetic.upload_tree(s3_client, case['bucket'], s3_fldr,
+                                  prefixes=('pfaf_',))
+    return case_fldr
+
+
+# *****************************************************************************
+# Check the m3 files of the drv_vol engine against volumes computed by hand,
+# from a global LDAS file and from the clipped LDAS file of the basin
+# *****************************************************************************
+def check_vol():
+    """
+    Returns:
+    float: Largest difference of m3_riv with VOL_FIXTURE, relative to the
+        largest volume of VOL_FIXTURE.
+    """
+    import numpy as np
+    import netCDF4 as nc
+    import drv_static
+    import drv_vol
+    scratch = tempfile.mkdtemp(prefix='check_vol_', dir='/tmp')
+    vol_cache_fldr = drv_vol.vol_cache_fldr
+    drv_vol.vol_cache_fldr = os.path.join(scratch, 'vol')
+    expected = np.array(VOL_FIXTURE['m3_riv'])
+    max_rel_diff = 0.0
+    try:
+        cpl_csv = os.path.join(scratch, 'rapid_coupling_pfaf_0_GLDAS.csv')
+        np.savetxt(cpl_csv, VOL_FIXTURE['coupling'],
+                   fmt=['%d', '%.4f', '%d', '%d'], delimiter=',')
+        drv_static.drv_static_build(scratch)
+        ldas_file = os.path.join(scratch, 'GLDAS_VIC_3H_2000-01_utc.nc4')
+        with nc.Dataset(ldas_file, 'w') as ldas:
+            ldas.createDimension('time', None)
+            ldas.createDimension('lat', 2)
+            ldas.createDimension('lon', 3)
+            var = ldas.createVariable('time', 'f8', ('time',))
+            var.units = 'hours since 2000-01-01 00:00:00'
+            var[:] = VOL_FIXTURE['time']
+            for name in ('RUNSF', 'RUNSB'):
+                var = ldas.createVariable(name, 'f4', ('time', 'lat', 'lon'))
+                var.units = 'kg m-2 s-1'
+                var[:] = VOL_FIXTURE[name]
+        m3_file = os.path.join(scratch, 'm3_global.nc4')
+        m3_clip_file = os.path.join(scratch, 'm3_clipped.nc4')
+        clip_file = os.path.join(scratch, 'clip.nc4')
+        drv_vol.drv_vol_multi(ldas_file, [cpl_csv], [m3_file],
+                              clip_files=[clip_file])
+        drv_vol.drv_vol_clipped([clip_file], [cpl_csv], [m3_clip_file])
+        for path in (m3_file, m3_clip_file):
+            with nc.Dataset(path) as m3:
+                if (not np.array_equal(m3['rivid'][:], VOL_FIXTURE['rivid'])
+                        or m3['time'].dtype != np.float64
+                        or not np.array_equal(m3['time_bnds'][:],
+                                              VOL_FIXTURE['time_bnds'])):
+                    raise ValueError(f"rivid, time or time_bnds of {path} "
+                                     f"differ from the fixture")
+                max_rel_diff = max(max_rel_diff, float(
+                    np.max(np.abs(m3['m3_riv'][:] - expected))
+                    / np.max(np.abs(expected))))
+    finally:
+        drv_vol.vol_cache_fldr = vol_cache_fldr
+        shutil.rmtree(scratch, ignore_errors=True)
+    return max_rel_diff
+
+
+# *****************************************************************************
+# Run a case in this (child) process and return its metrics
+# *****************************************************************************
+def run_case(case):
+    sys.path[:0] = [STUB_FLDR, os.path.join(ROOT, 'src'),
+                    os.path.join(ROOT, 'drv')]
+    import importlib
+    handler = importlib.import_module(f"lambda_function_{case['handler']}")
+    import drv_s3
+    if case.get('multi_basin'):
+        # One message per month, for all the basins
+        records = [{
+            'messageId': 'all',
+            'body': "\n".join(json.dumps(dict(
+                basin_ids=basin_ids(case['n_basin']), yyyy_mm=yyyy_mm,
+                s3_name=case['bucket'], **LSM))
+                for yyyy_mm in month_list(case['n_month']))
+            }]
+    else:
+        # Ensemble messages run the hig/low/nrm members of each month
+        extra = {'ensemble': True} if case.get('ensemble') else {}
+        records = [{
+            'messageId': basin_id,
+            'body': "\n".join(json.dumps(dict(
+                basin_id=basin_id, yyyy_mm=yyyy_mm, s3_name=case['bucket'],
+                **LSM, **extra)) for yyyy_mm in month_list(case['n_month']))
+            } for basin_id in basin_ids(case['n_basin'])]
+
+    t_start = time.time()
+    response = handler.lambda_handler({'Records': records}, None)
+    runtime = time.time() - t_start
+
+    phases = response['profiling'].get('phases', {})
+    peak_rss_mb = max(peak_rss_kb(),
+                      resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+                      ) / 1024
+    return {
+        'status': response['status'],
+        'failed_records': len(response.get('batchItemFailures', [])),
+        'runtime_total_sec': runtime,
+        'runtime_init_sec': response['profiling']['runtime_init_sec'],
+        'peak_rss_mb': peak_rss_mb,
+        # top-level spans include the bytes of their children
+        'bytes_moved': sum(phase['bytes'] for path, phase in phases.items()
+                           if '/' not in path),
+        's3_bytes_downloaded': drv_s3.get_s3_stats()['s3_bytes_downloaded'],
+        'phases_sec': {path: phase['duration_sec']
+                       for path, phase in phases.items()},
+        }
+
+
+# *****************************************************************************
+# Run a case in a child process, with the environment of the benchmark
+# *****************************************************************************
+def spawn_case(case, endpoint_url, work_fldr, case_fldr, verbose):
+    env = dict(os.environ)
+    env.update({
+        'AWS_ENDPOINT_URL': endpoint_url,
+        'AWS_ACCESS_KEY_ID': 'bench',
+        'AWS_SECRET_ACCESS_KEY': 'bench',
+        'AWS_DEFAULT_REGION': 'us-east-1',
+        'CURRNT_CACHE_DIR': os.path.join(work_fldr, 'cache', case['name']),
+        'CURRNT_GRANULE_CACHE_DIR': os.path.join(work_fldr, 'cache',
+                                                 case['name'], 'granules'),
+        'CURRNT_BENCH_EARTHDATA_DIR': os.path.join(work_fldr, 'earthdata'),
+        'CURRNT_STATIC_CACHE_DIR': os.path.join(work_fldr, 'static'),
+        'CURRNT_MAX_WORKERS': str(case['workers']),
+        'CURRNT_TRACE': 'off',
+        'CURRNT_BENCH_RAPID_INPUT_DIR': os.path.join(case_fldr, 'rapid',
+                                                     'input'),
+        'CURRNT_RAPID_INPUT_DIR': os.path.join(case_fldr, 'rapid',
+                                               'input'),
+        'CURRNT_RRR_INPUT_DIR': os.path.join(case_fldr, 'rrr', 'input'),
+        'CURRNT_BENCH_LDAS_NLAT': str(case['n_lat']),
+        'CURRNT_BENCH_LDAS_NLON': str(case['n_lon']),
+        })
+    proc = subprocess.run([sys.executable, os.path.abspath(__file__),
+                           '--child', json.dumps(case)],
+                          env=env, capture_output=True, text=True)
+    log_file = os.path.join(work_fldr, f"{case['name']}.log")
+    with open(log_file, 'w') as f:
+        f.write(proc.stdout + proc.stderr)
+    if verbose:
+        print(proc.stdout + proc.stderr)
+    for line in reversed(proc.stdout.splitlines()):
+        if line.startswith('BENCH_RESULT '):
+            return json.loads(line[len('BENCH_RESULT '):])
+    raise RuntimeError(f"Case {case['name']} crashed, see {log_file}:\n"
+                       f"{proc.stderr[-2000:]}")
+
+
+# *****************************************************************************
+# Compare the metrics with a baseline, return the regressions
+# *****************************************************************************
+def compare(cases, baseline, tolerance):
+    regressions = []
+    for name, metrics in cases.items():
+        base = baseline.get('cases', {}).get(name)
+        if base is None:
+            print(f"No baseline for {name}")
+            continue
+        for metric, slack in METRICS.items():
+            limit = base[metric] * (1 + tolerance) + slack
+            if metrics[metric] > limit:
+                regressions.append(
+                    f"{name}: {metric} = {metrics[metric]:.3f} > "
+                    f"{limit:.3f} (baseline {base[metric]:.3f})")
+    return regressions
+
+
+# *****************************************************************************
+# Main
+# *****************************************************************************
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--handlers', default='rapid,rrr',
+                        help="Handlers benchmarked (rapid, rrr)")
+    parser.add_argument('--reaches', default='1000,10000',
+                        help="Numbers of reaches per basin")
+    parser.add_argument('--shapes', default='1x1,1x3,2x2',
+                        help="Batch shapes: basins x months per basin")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="CURRNT_MAX_WORKERS of the handlers")
+    parser.add_argument('--depth', type=int, default=20,
+                        help="Number of levels of the river networks")
+    parser.add_argument('--nlat', type=int, default=30,
+                        help="Number of latitudes of the LDAS grid")
+    parser.add_argument('--nlon', type=int, default=60,
+                        help="Number of longitudes of the LDAS grid")
+    parser.add_argument('--ntime', type=int, default=0,
+                        help="Time steps of the m3 files of RAPID per "
+                        "month (0: 3-hourly)")
+    parser.add_argument('--multi-basin', action='store_true',
+                        help="RRR messages listing all the basins of a "
+                        "month (basin_ids)")
+    parser.add_argument('--check-vol', type=float, metavar='TOLERANCE',
+                        help="Check the m3 files of drv_vol against volumes "
+                        "computed by hand, relative tolerance, e.g. 1e-6")
+    parser.add_argument('--ensemble', action='store_true',
+                        help="RAPID messages running the hig/low/nrm "
+                        "ensemble of each month")
+    parser.add_argument('--output', help="JSON file of the results")
+    parser.add_argument('--save-baseline', help="Save results as baseline")
+    parser.add_argument('--baseline', help="Baseline JSON file to compare")
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help="Relative regression allowed")
+    parser.add_argument('--work-dir', default=os.path.join(ROOT, 'bench'),
+                        help="Folder of the inputs, outside of /tmp (the "
+                        "handlers relocate the paths under /tmp)")
+    parser.add_argument('--verbose', action='store_true',
+                        help="Print the output of the handlers")
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print('BENCH_RESULT ' + json.dumps(run_case(json.loads(args.child))))
+        return 0
+
+    if args.check_vol is not None:
+        vol_max_rel_diff = check_vol()
+        print(f"m3 of drv_vol vs volumes computed by hand: relative "
+              f"difference {vol_max_rel_diff:.2e}")
+        if vol_max_rel_diff > args.check_vol:
+            print(f"Volumes differ by more than {args.check_vol}")
+            return 1
+
+    # moto is only needed for the benchmarks
+    import logging
+    import boto3
+    from moto.server import ThreadedMotoServer
+    port = free_port()
+    server = ThreadedMotoServer(ip_address='127.0.0.1', port=port,
+                                verbose=False)
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    server.start()
+    endpoint_url = f"http://127.0.0.1:{port}"
+    s3_client = boto3.client('s3', endpoint_url=endpoint_url,
+                             aws_access_key_id='bench',
+                             aws_secret_access_key='bench',
+                             region_name='us-east-1')
+    work_fldr = tempfile.mkdtemp(prefix='currnt_bench_', dir=args.work_dir)
+
+    cases = {}
+    try:
+        for handler in args.handlers.split(','):
+            for n_reach in [int(n) for n in args.reaches.split(',')]:
+                for shape in args.shapes.split(','):
+                    n_basin, n_month = (int(n) for n in shape.split('x'))
+                    multi_basin = args.multi_basin and handler == 'rrr'
+                    ensemble = args.ensemble and handler == 'rapid'
+                    name = (f"{handler}-r{n_reach}-{shape}"
+                            f"{'-mb' if multi_basin else ''}"
+                            f"{'-ens' if ensemble else ''}")
+                    case = {'name': name, 'handler': handler,
+                            'n_reach': n_reach, 'n_basin': n_basin,
+                            'n_month': n_month, 'n_time': args.ntime,
+                            'depth': args.depth, 'n_lat': args.nlat,
+                            'n_lon': args.nlon,
+                            'workers': args.workers,
+                            'multi_basin': multi_basin,
+                            'ensemble': ensemble,
+                            'bucket': f"bench-{len(cases)}"}
+                    case_fldr = prepare_case(case, s3_client, work_fldr)
+                    metrics = spawn_case(case, endpoint_url, work_fldr,
+                                         case_fldr, args.verbose)
+                    cases[name] = metrics
+                    print(f"{name:<24} {metrics['status']:<8} "
+                          f"{metrics['runtime_total_sec']:8.2f} s "
+                          f"{metrics['peak_rss_mb']:8.1f} MB "
+                          f"{metrics['bytes_moved'] / 2**20:8.1f} MiB")
+    finally:
+        server.stop()
+        shutil.rmtree(work_fldr, ignore_errors=True)
+
+    results = {'python': platform.python_version(),
+               'machine': platform.machine(),
+               'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+               'cases': cases}
+    for path in (args.output, args.save_baseline):
+        if path:
+            with open(path, 'w') as f:
+                json.dump(results, f, indent=2)
+
+    n_failed = sum(metrics['status'] != 'Success' or metrics['failed_records']
+                   for metrics in cases.values())
+    if n_failed:
+        print(f"{n_failed} case(s) did not succeed")
+        return 1
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(cases, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"Regression: {regression}")
+        if regressions:
+            return 1
+        print("No regression")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
+
+
+# *****************************************************************************
+# End
+# *****************************************************************************
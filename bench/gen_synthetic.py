@@ -0,0 +1,347 @@
+#!/usr/bin/env python3
+# *****************************************************************************
+# gen_synthetic.py
+# *****************************************************************************
+
+# Purpose:
+# Generate consistent synthetic inputs of RAPID and RRR for scale testing,
+# without downloading anything: river network (rapid_connect, riv_bas_id),
+# coordinates, coupling with the LDAS grid, k/x/kfac parameters, monthly LDAS
+# files, m3 files computed from the LDAS files and the coupling, and the
+# Qinit file of the first month. The files follow the naming scheme of the
+# Dockerfiles (static inputs) and of the S3 bucket (drv_rapid.drv_s3_key and
+# lambda_function_rrr), and can be uploaded to a bucket.
+# Authors:
+# Manu Tom, Cedric H. David, 2023-2025
+
+
+# *****************************************************************************
+# Example usage
+# *****************************************************************************
+# python3 bench/gen_synthetic.py --basin-ids 74 --reaches 1000000 \
+#     --depth 200 --nlat 600 --nlon 1440 --months 2000-01,2000-02 \
+#     --output /data/synthetic
+# Creates:
+# /data/synthetic/rapid/input/pfaf_74/  (k, x, kfac, connect, riv_bas_id)
+# /data/synthetic/rrr/input/pfaf_74/    (connect, coords, coupling)
+# (CSV files, and their arrays converted with drv_static)
+# /data/synthetic/s3/                   (LDAS, m3 and Qinit, as in S3)
+
+
+# *****************************************************************************
+# Import libraries
+# *****************************************************************************
+import os
+import sys
+import calendar
+import argparse
+import numpy as np
+import netCDF4 as nc
+
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'drv'))
+import drv_rapid  # noqa: E402
+import drv_static  # noqa: E402
+
+
+# *****************************************************************************
+# set parameters
+# *****************************************************************************
+LSM = {'lsm_exp': 'GLDAS', 'lsm_mod': 'VIC', 'lsm_stp': '3H'}
+# Lower left corner and resolution (degrees) of the LDAS grid
+LON_0, LAT_0, RES = -180.0, -60.0, 0.25
+# Time step of the LDAS and m3 files (seconds)
+DT = 10800
+# Number of time steps written at once
+BLOCK = 8
+
+
+# *****************************************************************************
+# River network: n_reach reaches over depth levels, each reach flowing into a
+# random reach of the level below, the reaches of level 0 being outlets
+# *****************************************************************************
+def generate_network(n_reach, depth, seed=0):
+    """
+    Parameters:
+    n_reach (int): Number of reaches.
+    depth (int): Number of levels, i.e. of reaches from the most upstream
+        reaches to the outlets.
+    Returns:
+    tuple: rivid, downstream rivid (0 for outlets), level of each reach.
+    """
+    rng = np.random.default_rng(seed)
+    depth = max(1, min(depth, n_reach))
+    rivid = np.arange(1, n_reach + 1, dtype=np.int64)
+    level = (np.arange(n_reach) * depth) // n_reach
+    # first index of each level (the reaches are sorted by level)
+    starts = np.searchsorted(level, np.arange(depth + 1))
+    downstream = np.zeros(n_reach, dtype=np.int64)
+    for lvl in range(1, depth):
+        lo, hi = starts[lvl - 1], starts[lvl]
+        n = starts[lvl + 1] - starts[lvl]
+        downstream[starts[lvl]:starts[lvl + 1]] = rivid[
+            rng.integers(lo, hi, n)]
+    return rivid, downstream, level
+
+
+# *****************************************************************************
+# Write the connectivity file: rivid, downstream rivid, number of upstream
+# reaches and upstream rivids (padded with 0)
+# *****************************************************************************
+def write_connect(path, rivid, downstream):
+    # rivids are 1..n_reach, so the position of a reach is its rivid - 1
+    down_pos = downstream[downstream > 0] - 1
+    up_rivid = rivid[downstream > 0]
+    n_up = np.bincount(down_pos, minlength=len(rivid))
+    order = np.argsort(down_pos, kind='stable')
+    down_pos, up_rivid = down_pos[order], up_rivid[order]
+    rank = np.arange(len(down_pos)) - np.searchsorted(down_pos, down_pos)
+    ups = np.zeros((len(rivid), max(1, int(n_up.max()))), dtype=np.int64)
+    ups[down_pos, rank] = up_rivid
+    np.savetxt(path, np.column_stack([rivid, downstream, n_up, ups]),
+               fmt='%d', delimiter=',')
+
+
+# *****************************************************************************
+# Write the static inputs of a basin, for RAPID and for RRR
+# *****************************************************************************
+def write_static(out_fldr, basin_id, rivid, downstream, level, n_lat, n_lon,
+                 seed=0):
+    """
+    Returns:
+    tuple: Area (km2), 0-based longitude and latitude indices in the LDAS
+        grid of each reach, used to compute the m3 files.
+    """
+    rng = np.random.default_rng(seed)
+    n_reach = len(rivid)
+    rapid_fldr = os.path.join(out_fldr, 'rapid', 'input', f"pfaf_{basin_id}")
+    rrr_fldr = os.path.join(out_fldr, 'rrr', 'input', f"pfaf_{basin_id}")
+    os.makedirs(rapid_fldr, exist_ok=True)
+    os.makedirs(rrr_fldr, exist_ok=True)
+
+    # RAPID: parameters for the hig/low/nrm ensemble, k = length / celerity
+    length = rng.uniform(1000, 10000, n_reach)
+    for suffix, celerity, x in (('hig', 2.0, 0.4), ('low', 0.5, 0.2),
+                                ('nrm', 1.0, 0.3)):
+        np.savetxt(os.path.join(rapid_fldr,
+                                f"k_pfaf_{basin_id}_{suffix}.csv"),
+                   length / celerity, fmt='%.3f')
+        np.savetxt(os.path.join(rapid_fldr,
+                                f"x_pfaf_{basin_id}_{suffix}.csv"),
+                   np.full(n_reach, x), fmt='%.1f')
+    # time to travel the reach at 1 km/h
+    np.savetxt(os.path.join(rapid_fldr,
+                            f"kfac_pfaf_{basin_id}_1km_hour.csv"),
+               length / 1000 * 3600, fmt='%.3f')
+    write_connect(os.path.join(rapid_fldr,
+                               f"rapid_connect_pfaf_{basin_id}.csv"),
+                  rivid, downstream)
+    # upstream reaches first
+    np.savetxt(os.path.join(rapid_fldr,
+                            f"riv_bas_id_pfaf_{basin_id}_topo.csv"),
+               rivid[np.argsort(-level, kind='stable')], fmt='%d')
+
+    # RRR: coordinates inside the LDAS grid, and coupling (1-based indices)
+    i_lon = rng.integers(0, n_lon, n_reach)
+    i_lat = rng.integers(0, n_lat, n_reach)
+    lon = LON_0 + RES * (i_lon + rng.random(n_reach))
+    lat = LAT_0 + RES * (i_lat + rng.random(n_reach))
+    area = rng.uniform(1, 100, n_reach)
+    write_connect(os.path.join(rrr_fldr,
+                               f"rapid_connect_pfaf_{basin_id}.csv"),
+                  rivid, downstream)
+    np.savetxt(os.path.join(rrr_fldr, f"coords_pfaf_{basin_id}.csv"),
+               np.column_stack([rivid, lon, lat]),
+               fmt=['%d', '%.6f', '%.6f'], delimiter=',')
+    np.savetxt(os.path.join(rrr_fldr,
+                            f"rapid_coupling_pfaf_{basin_id}_"
+                            f"{LSM['lsm_exp']}.csv"),
+               np.column_stack([rivid, area, i_lon + 1, i_lat + 1]),
+               fmt=['%d', '%.4f', '%d', '%d'], delimiter=',')
+    # arrays converted when building the images
+    drv_static.drv_static_build(rapid_fldr)
+    drv_static.drv_static_build(rrr_fldr)
+    return area, i_lon, i_lat
+
+
+# *****************************************************************************
+# Number of time steps and first time (seconds since epoch) of a month
+# *****************************************************************************
+def month_times(yyyy_mm, n_time=0):
+    year, month = int(yyyy_mm[:4]), int(yyyy_mm[5:7])
+    n_time = n_time or 86400 // DT * calendar.monthrange(year, month)[1]
+    t_start = calendar.timegm((year, month, 1, 0, 0, 0))
+    return t_start + DT * np.arange(n_time)
+
+
+# *****************************************************************************
+# Write a monthly LDAS file (surface and subsurface runoff)
+# *****************************************************************************
+def write_ldas(path, yyyy_mm, n_lat, n_lon, n_time=0, seed=0):
+    rng = np.random.default_rng(seed)
+    times = month_times(yyyy_mm, n_time)
+    with nc.Dataset(path, 'w', format='NETCDF4') as ds:
+        ds.createDimension('time', len(times))
+        ds.createDimension('lat', n_lat)
+        ds.createDimension('lon', n_lon)
+        var = ds.createVariable('time', 'i4', ('time',))
+        var.units = 'seconds since 1970-01-01 00:00:00 +00:00'
+        var[:] = times
+        ds.createVariable('lat', 'f4', ('lat',))[:] = \
+            LAT_0 + RES * (np.arange(n_lat) + 0.5)
+        ds.createVariable('lon', 'f4', ('lon',))[:] = \
+            LON_0 + RES * (np.arange(n_lon) + 0.5)
+        for name, scale in (('RUNSF', 2e-5), ('RUNSB', 1e-5)):
+            var = ds.createVariable(name, 'f4', ('time', 'lat', 'lon'),
+                                    zlib=True, complevel=1,
+                                    chunksizes=(1, n_lat, n_lon))
+            var.units = 'kg m-2 s-1'
+            for i_time in range(0, len(times), BLOCK):
+                n = min(BLOCK, len(times) - i_time)
+                var[i_time:i_time + n] = scale * rng.random(
+                    (n, n_lat, n_lon), dtype=np.float32)
+
+
+# *****************************************************************************
+# Write a m3 file from a LDAS file and the coupling of a basin
+# *****************************************************************************
+def write_m3(path, ldas_file, rivid, area, i_lon, i_lat):
+    with nc.Dataset(ldas_file) as ldas, \
+            nc.Dataset(path, 'w', format='NETCDF4') as ds:
+        times = ldas['time'][:]
+        ds.createDimension('time', len(times))
+        ds.createDimension('rivid', len(rivid))
+        ds.createVariable('rivid', 'i4', ('rivid',))[:] = rivid
+        var = ds.createVariable('time', 'i4', ('time',))
+        var.units = ldas['time'].units
+        var[:] = times
+        var = ds.createVariable('m3_riv', 'f4', ('time', 'rivid'),
+                                fill_value=-9999.0)
+        var.units = 'm3'
+        for i_time in range(0, len(times), BLOCK):
+            block = slice(i_time, min(i_time + BLOCK, len(times)))
+            runoff = ldas['RUNSF'][block] + ldas['RUNSB'][block]
+            # kg m-2 s-1 x time step x km2 -> m3
+            var[block] = runoff[:, i_lat, i_lon] * DT * area * 1000.0
+
+
+# *****************************************************************************
+# Write a Qinit file (zero discharge) of a basin
+# *****************************************************************************
+def write_qinit(path, rivid):
+    with nc.Dataset(path, 'w', format='NETCDF4') as ds:
+        ds.createDimension('time', None)
+        ds.createDimension('rivid', len(rivid))
+        ds.createVariable('rivid', 'i4', ('rivid',))[:] = rivid
+        ds.createVariable('time', 'i4', ('time',))[:] = [0]
+        var = ds.createVariable('Qout', 'f4', ('time', 'rivid'),
+                                fill_value=-9999.0)
+        var.units = 'm3 s-1'
+        var[:] = np.zeros((1, len(rivid)), dtype=np.float32)
+
+
+# *****************************************************************************
+# S3 key of a monthly LDAS file (as in lambda_function_rrr)
+# *****************************************************************************
+def ldas_s3_key(lsm_exp, lsm_mod, lsm_stp, yyyy_mm):
+    return (f"{lsm_exp}/{lsm_mod}/{lsm_stp}/{yyyy_mm}/"
+            f"{lsm_exp}_{lsm_mod}_{lsm_stp}_{yyyy_mm}_utc.nc4")
+
+
+# *****************************************************************************
+# Generate all the inputs of a basin
+# *****************************************************************************
+def generate_basin(out_fldr, basin_id, n_reach, depth, n_lat, n_lon, months,
+                   n_time=0):
+    """
+    Generate the static inputs of a basin, and its LDAS, m3 and first Qinit
+    files under out_fldr/s3/ with their S3 keys. The LDAS files are shared
+    by all the basins (same grid), and only generated once.
+    Parameters:
+    out_fldr (str): Output folder.
+    basin_id (str): Basin ID, e.g. '74'.
+    n_reach (int): Number of reaches.
+    depth (int): Number of levels of the river network.
+    n_lat, n_lon (int): Size of the LDAS grid.
+    months (list): Months, e.g. ['2000-01', '2000-02'].
+    n_time (int): Time steps per month, 0 for all the 3-hourly steps.
+    Returns:
+    str: Folder of the files to upload to S3.
+    """
+    seed = int(basin_id)
+    rivid, downstream, level = generate_network(n_reach, depth, seed)
+    area, i_lon, i_lat = write_static(out_fldr, basin_id, rivid, downstream,
+                                      level, n_lat, n_lon, seed)
+    s3_fldr = os.path.join(out_fldr, 's3')
+    for i_month, yyyy_mm in enumerate(months):
+        ldas_file = os.path.join(s3_fldr, ldas_s3_key(yyyy_mm=yyyy_mm, **LSM))
+        if not os.path.exists(ldas_file):
+            os.makedirs(os.path.dirname(ldas_file), exist_ok=True)
+            write_ldas(ldas_file, yyyy_mm, n_lat, n_lon, n_time,
+                       int(yyyy_mm.replace('-', '')))
+        m3_file = os.path.join(s3_fldr, drv_rapid.drv_s3_key(
+            basin_id, yyyy_mm=yyyy_mm, file_type='m3', **LSM))
+        os.makedirs(os.path.dirname(m3_file), exist_ok=True)
+        write_m3(m3_file, ldas_file, rivid, area, i_lon, i_lat)
+        if i_month == 0:
+            write_qinit(os.path.join(s3_fldr, drv_rapid.drv_s3_key(
+                basin_id, yyyy_mm=yyyy_mm, file_type='Qinit', **LSM)), rivid)
+    return s3_fldr
+
+
+# *****************************************************************************
+# Upload a folder to a S3 bucket, with the relative paths as keys
+# *****************************************************************************
+def upload_tree(s3_client, bucket, s3_fldr, prefixes=('',)):
+    for root, dirs, files in os.walk(s3_fldr):
+        for name in files:
+            path = os.path.join(root, name)
+            key = os.path.relpath(path, s3_fldr)
+            if key.startswith(tuple(prefixes)):
+                s3_client.upload_file(path, bucket, key)
+
+
+# *****************************************************************************
+# Main
+# *****************************************************************************
+def main():
+    parser = argparse.ArgumentParser(
+        description="Generate synthetic inputs of RAPID and RRR")
+    parser.add_argument('--basin-ids', default='74',
+                        help="Basin IDs, e.g. 74,75")
+    parser.add_argument('--reaches', type=int, default=1000,
+                        help="Number of reaches per basin")
+    parser.add_argument('--depth', type=int, default=20,
+                        help="Number of levels of the river network")
+    parser.add_argument('--nlat', type=int, default=30,
+                        help="Number of latitudes of the LDAS grid")
+    parser.add_argument('--nlon', type=int, default=60,
+                        help="Number of longitudes of the LDAS grid")
+    parser.add_argument('--ntime', type=int, default=0,
+                        help="Time steps per month (0: 3-hourly)")
+    parser.add_argument('--months', default='2000-01',
+                        help="Months, e.g. 2000-01,2000-02")
+    parser.add_argument('--output', required=True, help="Output folder")
+    parser.add_argument('--bucket',
+                        help="Upload the S3 files to this bucket")
+    args = parser.parse_args()
+
+    months = args.months.split(',')
+    for basin_id in args.basin_ids.split(','):
+        print(f"Generating basin {basin_id}: {args.reaches} reaches")
+        s3_fldr = generate_basin(args.output, basin_id, args.reaches,
+                                 args.depth, args.nlat, args.nlon, months,
+                                 args.ntime)
+    if args.bucket:
+        import boto3
+        print(f"Uploading {s3_fldr} to {args.bucket}")
+        upload_tree(boto3.client('s3'), args.bucket, s3_fldr)
+
+
+if __name__ == '__main__':
+    main()
+
+
+# *****************************************************************************
+# End
+# *****************************************************************************
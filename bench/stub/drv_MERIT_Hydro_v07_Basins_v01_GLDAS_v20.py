@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+# *****************************************************************************
+# drv_MERIT_Hydro_v07_Basins_v01_GLDAS_v20.py (benchmark stub)
+# *****************************************************************************
+
+# Purpose:
+# Stand-in for the RAPID driver of the czarmanu/rapid image, used by the
+# offline benchmarks of lambda_function_rapid. It reads the m3 and Qinit
+# files and writes the Qout and Qfinal files like RAPID does, with a
+# computational cost proportional to the number of reaches and time steps.
+# Authors:
+# Manu Tom, Cedric H. David, 2023-2025
+
+
+# *****************************************************************************
+# Import libraries
+# *****************************************************************************
+import os
+import netCDF4 as nc
+import numpy as np
+
+
+# *****************************************************************************
+# set parameters
+# *****************************************************************************
+inpt_root = os.environ.get('CURRNT_BENCH_RAPID_INPUT_DIR', '/rapid/input')
+# Number of routing sub-steps per time step of the m3 file
+n_sub_steps = int(os.environ.get('CURRNT_BENCH_RAPID_SUB_STEPS', '12'))
+
+
+# *****************************************************************************
+# RAPID object: file paths and parameters of 1 basin, 1 month
+# *****************************************************************************
+class RAPID:
+    def __init__(self, basin_id, lsm_mod, lsm_stp, yyyy_mm):
+        tag = f"pfaf_{basin_id}_GLDAS_{lsm_mod}_{lsm_stp}_{yyyy_mm}"
+        inpt_fldr = os.path.join(inpt_root, f"pfaf_{basin_id}")
+        self.basin_id = basin_id
+        self.yyyy_mm = yyyy_mm
+        self.k_file = os.path.join(inpt_fldr, f"k_pfaf_{basin_id}_nrm.csv")
+        self.x_file = os.path.join(inpt_fldr, f"x_pfaf_{basin_id}_nrm.csv")
+        self.m3_file = f"/tmp/m3_riv_{tag}_utc.nc4"
+        self.qinit_file = f"/tmp/Qinit_{tag}_utc.nc"
+        self.qout_file = f"/tmp/Qout_{tag}_utc.nc"
+        self.qfinal_file = f"/tmp/Qfinal_{tag}_utc.nc"
+        self.namelist_file = f"/tmp/rapid_namelist_{tag}"
+
+
+# *****************************************************************************
+# Write the namelist file
+# *****************************************************************************
+def drv_write_namelist(rapid):
+    with open(rapid.namelist_file, 'w') as f:
+        for name, value in sorted(vars(rapid).items()):
+            f.write(f"{name} = '{value}'\n")
+
+
+# *****************************************************************************
+# Write a discharge file with the structure of the RAPID outputs
+# *****************************************************************************
+def _write_q(path, rivid, times, q):
+    with nc.Dataset(path, 'w', format='NETCDF4') as ds:
+        ds.createDimension('time', None)
+        ds.createDimension('rivid', len(rivid))
+        var = ds.createVariable('rivid', 'i4', ('rivid',))
+        var[:] = rivid
+        var = ds.createVariable('time', 'i4', ('time',))
+        var.units = 'seconds since 1970-01-01 00:00:00 +00:00'
+        var[:] = times
+        var = ds.createVariable('Qout', 'f4', ('time', 'rivid'),
+                                fill_value=-9999.0)
+        var.units = 'm3 s-1'
+        var[:] = q
+
+
+# *****************************************************************************
+# Run the routing: linear reservoirs (Muskingum with x = 0) on each reach
+# *****************************************************************************
+def drv_run(rapid):
+    # parsed at each run, like the RAPID executable does
+    k = np.loadtxt(rapid.k_file, delimiter=',', ndmin=1)
+    with nc.Dataset(rapid.m3_file) as ds:
+        rivid = ds.variables['rivid'][:]
+        times = ds.variables['time'][:]
+        m3 = ds.variables['m3_riv'][:]
+    q = np.zeros(len(rivid), dtype=np.float64)
+    if os.path.exists(rapid.qinit_file):
+        with nc.Dataset(rapid.qinit_file) as ds:
+            q[:] = ds.variables['Qout'][0, :]
+    dt = 10800.0 / n_sub_steps
+    coef = np.exp(-dt / np.maximum(k, dt))
+    q_out = np.empty(m3.shape, dtype=np.float32)
+    for i_time in range(m3.shape[0]):
+        inflow = m3[i_time, :] / 10800.0
+        q_mean = np.zeros_like(q)
+        for _ in range(n_sub_steps):
+            q = coef * q + (1.0 - coef) * inflow
+            q_mean += q
+        q_out[i_time, :] = q_mean / n_sub_steps
+    _write_q(rapid.qout_file, rivid, times, q_out)
+    _write_q(rapid.qfinal_file, rivid, times[-1:], q[np.newaxis, :])
+
+
+# *****************************************************************************
+# End
+# *****************************************************************************
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+# *****************************************************************************
+# earthaccess (benchmark stub)
+# *****************************************************************************
+
+# Purpose:
+# Stand-in for the earthaccess library, used by the offline benchmarks of
+# lambda_function_rrr. The searches of a month generate its 3H LDAS granules
+# (surface and subsurface runoff accumulated over 3 hours) in a local
+# folder, served over HTTP, so that they are downloaded by drv_granules like
+# the granules of Earthdata.
+# Authors:
+# Manu Tom, Cedric H. David, 2023-2025
+
+
+# *****************************************************************************
+# Import libraries
+# *****************************************************************************
+import os
+import shutil
+import hashlib
+import calendar
+import functools
+import threading
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+import netCDF4 as nc
+import numpy as np
+from earthaccess.results import DataGranule
+
+
+# *****************************************************************************
+# set parameters
+# *****************************************************************************
+earthdata_fldr = os.environ.get('CURRNT_BENCH_EARTHDATA_DIR',
+                                '/tmp/bench_earthdata')
+n_lat = int(os.environ.get('CURRNT_BENCH_LDAS_NLAT', '30'))
+n_lon = int(os.environ.get('CURRNT_BENCH_LDAS_NLON', '60'))
+# Number of 3H granules per month, 8 per day by default
+n_granules = int(os.environ.get('CURRNT_BENCH_LDAS_NTIME', '0'))
+
+
+# *****************************************************************************
+# Module state
+# *****************************************************************************
+_server = None
+_lock = threading.Lock()
+
+
+# *****************************************************************************
+# Session and credentials of the logged-in user
+# *****************************************************************************
+def login(**kwargs):
+    return True
+
+
+def get_requests_https_session():
+    import requests
+    return requests.Session()
+
+
+def get_s3_credentials(provider=None, **kwargs):
+    return {'accessKeyId': 'bench', 'secretAccessKey': 'bench',
+            'sessionToken': 'bench'}
+
+
+# *****************************************************************************
+# Local HTTP server of the granules
+# *****************************************************************************
+def _get_server():
+    global _server
+    with _lock:
+        if _server is None:
+            class Handler(SimpleHTTPRequestHandler):
+                def log_message(self, *args):
+                    pass
+            os.makedirs(earthdata_fldr, exist_ok=True)
+            _server = ThreadingHTTPServer(
+                ('127.0.0.1', 0),
+                functools.partial(Handler, directory=earthdata_fldr))
+            threading.Thread(target=_server.serve_forever,
+                             daemon=True).start()
+    return _server
+
+
+# *****************************************************************************
+# Generate the granules of a month (once)
+# *****************************************************************************
+def _granule_paths(short_name, yyyy_mm):
+    year, month = int(yyyy_mm[:4]), int(yyyy_mm[5:7])
+    n_time = n_granules or 8 * calendar.monthrange(year, month)[1]
+    fldr = os.path.join(earthdata_fldr, short_name, yyyy_mm)
+    paths = [os.path.join(fldr, f"{short_name}.A{year}{month:02d}"
+                          f"{1 + i_time // 8:02d}.{3 * (i_time % 8):02d}00"
+                          f".020.nc4") for i_time in range(n_time)]
+    if not os.path.exists(fldr):
+        tmp_fldr = f"{fldr}.tmp{os.getpid()}"
+        os.makedirs(tmp_fldr, exist_ok=True)
+        rng = np.random.default_rng(year * 100 + month)
+        for path in paths:
+            with nc.Dataset(os.path.join(tmp_fldr, os.path.basename(path)),
+                            'w', format='NETCDF4') as ds:
+                ds.createDimension('lat', n_lat)
+                ds.createDimension('lon', n_lon)
+                for name in ('Qs_acc', 'Qsb_acc'):
+                    var = ds.createVariable(name, 'f4', ('lat', 'lon'))
+                    var.units = 'kg m-2'
+                    var[:] = rng.random((n_lat, n_lon), dtype=np.float32)
+        try:
+            os.rename(tmp_fldr, fldr)
+        except OSError:
+            # generated meanwhile by another process
+            shutil.rmtree(tmp_fldr)
+    return paths
+
+
+# *****************************************************************************
+# Search the granules of a month
+# *****************************************************************************
+def search_data(short_name, temporal, count=-1, **kwargs):
+    paths = _granule_paths(short_name, temporal[0][:7])
+    if count > 0:
+        paths = paths[:count]
+    port = _get_server().server_port
+    granules = []
+    for path in paths:
+        with open(path, 'rb') as f:
+            checksum = hashlib.sha256(f.read()).hexdigest()
+        name = os.path.basename(path)
+        url = (f"http://127.0.0.1:{port}/"
+               f"{os.path.relpath(path, earthdata_fldr)}")
+        granules.append(DataGranule({
+            'meta': {'provider-id': 'GES_DISC'},
+            'umm': {
+                'RelatedUrls': [{'URL': url}],
+                'DataGranule': {'ArchiveAndDistributionInformation': [
+                    {'Name': name, 'SizeInBytes': os.path.getsize(path),
+                     'Checksum': {'Algorithm': 'SHA-256',
+                                  'Value': checksum}}]}}},
+            cloud_hosted=True))
+    return granules
@@ -0,0 +1,25 @@
+#!/usr/bin/env python3
+# *****************************************************************************
+# earthaccess.results (benchmark stub)
+# *****************************************************************************
+
+# Purpose:
+# Stand-in for the granules returned by earthaccess.search_data: the UMM
+# metadata, and the links of the files.
+# Authors:
+# Manu Tom, Cedric H. David, 2023-2025
+
+
+# *****************************************************************************
+# Granule: UMM metadata and links of its files
+# *****************************************************************************
+class DataGranule(dict):
+    def __init__(self, collection, fields=None, cloud_hosted=False):
+        super().__init__(collection)
+        self.cloud_hosted = cloud_hosted
+
+    def data_links(self, access=None):
+        urls = [url['URL'] for url in self['umm'].get('RelatedUrls', [])]
+        if access == 'direct':
+            return [url for url in urls if url.startswith('s3://')]
+        return [url for url in urls if not url.startswith('s3://')]
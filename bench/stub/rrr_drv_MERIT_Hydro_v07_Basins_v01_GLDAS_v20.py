@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+# *****************************************************************************
+# rrr_drv_MERIT_Hydro_v07_Basins_v01_GLDAS_v20.py (benchmark stub)
+# *****************************************************************************
+
+# Purpose:
+# Stand-in for the RRR driver of the czarmanu/rrr image, used by the offline
+# benchmarks of lambda_function_rrr. The LSM driver concatenates the 3H
+# LDAS granules (downloaded by the handler from the earthaccess stub) into
+# the monthly LDAS file and the volume driver computes the m3 file from the
+# coupling file, with a computational cost proportional to the number of
+# reaches and time steps.
+# Authors:
+# Manu Tom, Cedric H. David, 2023-2025
+
+
+# *****************************************************************************
+# Import libraries
+# *****************************************************************************
+import os
+import calendar
+import netCDF4 as nc
+import numpy as np
+
+
+# *****************************************************************************
+# set parameters
+# *****************************************************************************
+n_lat = int(os.environ.get('CURRNT_BENCH_LDAS_NLAT', '30'))
+n_lon = int(os.environ.get('CURRNT_BENCH_LDAS_NLON', '60'))
+
+
+# *****************************************************************************
+# RRR object: file paths of 1 basin, 1 month
+# *****************************************************************************
+class RRR:
+    def __init__(self, basin_id, lsm_mod, lsm_stp, yyyy_mm):
+        year, month = int(yyyy_mm[:4]), int(yyyy_mm[5:7])
+        self.basin_id = basin_id
+        self.yyyy_mm = yyyy_mm
+        self.t_start = calendar.timegm((year, month, 1, 0, 0, 0))
+        self.ldas_fldr = (f"/tmp/input/pfaf_{basin_id}/GLDAS20/{lsm_mod}/"
+                          f"{lsm_stp}/{yyyy_mm}")
+        self.ldas_file = f"/tmp/GLDAS_{lsm_mod}_{lsm_stp}_{yyyy_mm}_utc.nc4"
+        self.cpl_file = f"/tmp/rapid_coupling_pfaf_{basin_id}_GLDAS.csv"
+        self.m3_file = (f"/tmp/m3_riv_pfaf_{basin_id}_GLDAS_{lsm_mod}_"
+                        f"{lsm_stp}_{yyyy_mm}_utc.nc4")
+
+
+# *****************************************************************************
+# LSM driver: concatenate the granules into the monthly LDAS file
+# *****************************************************************************
+def drv_lsm(rrr):
+    # granules in chronological order, e.g. GLDAS_VIC10_3H.A20000101.0300...
+    paths = sorted(os.path.join(rrr.ldas_fldr, name)
+                   for name in os.listdir(rrr.ldas_fldr)
+                   if name.endswith('.nc4'))
+    with nc.Dataset(rrr.ldas_file, 'w', format='NETCDF4') as out:
+        out.createDimension('time', len(paths))
+        out.createDimension('lat', n_lat)
+        out.createDimension('lon', n_lon)
+        var = out.createVariable('time', 'i4', ('time',))
+        var[:] = rrr.t_start + 10800 * np.arange(len(paths))
+        for name in ('RUNSF', 'RUNSB'):
+            var = out.createVariable(name, 'f4', ('time', 'lat', 'lon'),
+                                     zlib=True)
+            var.units = 'kg m-2 s-1'
+        for i_time, path in enumerate(paths):
+            with nc.Dataset(path) as ds:
+                out['RUNSF'][i_time] = ds['Qs_acc'][:] / 10800.0
+                out['RUNSB'][i_time] = ds['Qsb_acc'][:] / 10800.0
+
+
+# *****************************************************************************
+# Volume driver: m3 = (surface + subsurface runoff) x area of the catchment
+# *****************************************************************************
+def drv_vol(rrr):
+    # parsed at each run, like the RRR driver does
+    cpl = np.loadtxt(rrr.cpl_file, delimiter=',', ndmin=2)
+    rivid = cpl[:, 0].astype(np.int32)
+    area = cpl[:, 1]
+    i_lon = cpl[:, 2].astype(np.int64) - 1
+    i_lat = cpl[:, 3].astype(np.int64) - 1
+    with nc.Dataset(rrr.ldas_file) as ds:
+        times = ds['time'][:]
+        with nc.Dataset(rrr.m3_file, 'w', format='NETCDF4') as out:
+            out.createDimension('time', len(times))
+            out.createDimension('rivid', len(rivid))
+            var = out.createVariable('rivid', 'i4', ('rivid',))
+            var[:] = rivid
+            var = out.createVariable('time', 'i4', ('time',))
+            var.units = 'seconds since 1970-01-01 00:00:00 +00:00'
+            var[:] = times
+            var = out.createVariable('m3_riv', 'f4', ('time', 'rivid'),
+                                     fill_value=-9999.0)
+            var.units = 'm3'
+            for i_time in range(len(times)):
+                runoff = ds['RUNSF'][i_time] + ds['RUNSB'][i_time]
+                # kg m-2 s-1 x 3 hours x km2 -> m3
+                var[i_time, :] = (runoff[i_lat, i_lon] * 10800.0 * area
+                                  * 1000.0)
+
+
+# *****************************************************************************
+# End
+# *****************************************************************************
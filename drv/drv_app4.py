@@ -15,7 +15,7 @@
 # Import libraries
 # *****************************************************************************
 import os
-import earthaccess
+import drv_granules
 import subprocess
 import boto3
 
@@ -27,14 +27,13 @@ def drv_dwn_ED(yyyy_mm):
     # *************************************************************************
     # earth access parameters from input events
     # *************************************************************************
-    date_beg = yyyy_mm+"-01T00:00:00"  # eg. "2000-01-01T00:00:00"
-    # eg. "2000-02-01T00:00:00"
-    date_end = date_beg.split("-")[0] + "-" + \
-        str(int(date_beg.split("-")[1])+1).zfill(2)
+    # eg. "2000-01-01T00:00:00" to "2000-02"
+    date_beg, date_end = drv_granules.drv_month_window(yyyy_mm)
     # *************************************************************************
     # search for LDAS data
     # *************************************************************************
-    results = earthaccess.search_data(
+    # (answered from the cache of previous searches when possible)
+    results = drv_granules.drv_search_data(
         short_name='GLDAS_VIC10_3H',
         cloud_hosted=True,
         bounding_box=(-180, -60, 180, 90),
@@ -47,7 +46,7 @@ def drv_dwn_ED(yyyy_mm):
     dwnld_fldr = "/tmp"
     if not os.path.exists(dwnld_fldr):
         os.makedirs(dwnld_fldr)
-    files = earthaccess.download(results, dwnld_fldr)
+    files = drv_granules.drv_download(results, dwnld_fldr)
     print("Files downloaded: ", files)
     # *************************************************************************
     # check downloaded files
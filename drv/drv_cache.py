@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+# *****************************************************************************
+# drv_cache.py
+# *****************************************************************************
+
+# Purpose:
+# Python driver keeping a size-bounded, least-recently-used cache of S3
+# objects in /tmp, so that warm AWS Lambda containers do not download again
+# the inputs (m3, Qinit, LDAS) they already have. Cached objects are
+# validated against the ETag of the S3 object before being reused.
+# Authors:
+# Manu Tom, Cedric H. David, 2023-2025
+
+
+# *****************************************************************************
+# Import libraries
+# *****************************************************************************
+import os
+import json
+import shutil
+import hashlib
+import drv_s3
+
+
+# *****************************************************************************
+# set parameters (can be overridden with environment variables)
+# *****************************************************************************
+MB = 1024 * 1024
+cache_enabled = os.environ.get('CURRNT_CACHE', '1') != '0'
+cache_fldr = os.environ.get('CURRNT_CACHE_DIR', '/tmp/cache')
+# Maximum size of the cache, defaults to half of the ephemeral storage
+cache_max_mb = float(os.environ.get('CURRNT_CACHE_MAX_MB', '0'))
+# Free space always left in the ephemeral storage for the simulations
+cache_reserve_mb = float(os.environ.get('CURRNT_CACHE_RESERVE_MB', '256'))
+
+
+# *****************************************************************************
+# Module state, kept across invocations of a warm container
+# *****************************************************************************
+_stats = {'cache_hits': 0, 'cache_misses': 0, 'cache_bytes_hit': 0,
+          'cache_evictions': 0}
+
+
+# *****************************************************************************
+# Helper functions
+# *****************************************************************************
+def _cache_paths(s3_bucket_name, s3_key):
+    name = hashlib.sha1(f"{s3_bucket_name}/{s3_key}".encode()).hexdigest()
+    return (os.path.join(cache_fldr, name),
+            os.path.join(cache_fldr, name + '.json'))
+
+
+def _cache_max_bytes():
+    total = shutil.disk_usage(cache_fldr).total
+    if cache_max_mb > 0:
+        return min(cache_max_mb * MB, total)
+    return total // 2
+
+
+def _cache_entries():
+    """
+    Return the (mtime, size, data_path, meta_path) of all cached objects,
+    least recently used first. The files themselves are the index, so that
+    the processes of a concurrent invocation share the same cache.
+    """
+    entries = []
+    for filename in os.listdir(cache_fldr):
+        if not filename.endswith('.json'):
+            continue
+        meta_path = os.path.join(cache_fldr, filename)
+        data_path = meta_path[:-len('.json')]
+        try:
+            st = os.stat(data_path)
+        except FileNotFoundError:
+            os.remove(meta_path)
+            continue
+        entries.append((st.st_mtime, st.st_size, data_path, meta_path))
+    return sorted(entries)
+
+
+def _cache_make_room(size):
+    """
+    Evict least recently used objects until size bytes fit in the cache and
+    in the ephemeral storage. Return False if the object cannot be cached.
+    """
+    max_bytes = _cache_max_bytes()
+    if size > max_bytes:
+        return False
+    entries = _cache_entries()
+    used = sum(entry[1] for entry in entries)
+    while entries and (
+            used + size > max_bytes or
+            shutil.disk_usage(cache_fldr).free - size < cache_reserve_mb * MB):
+        _, entry_size, data_path, meta_path = entries.pop(0)
+        for path in (meta_path, data_path):
+            if os.path.exists(path):
+                os.remove(path)
+        used -= entry_size
+        _stats['cache_evictions'] += 1
+    return shutil.disk_usage(cache_fldr).free - size >= cache_reserve_mb * MB
+
+
+def _cache_link(data_path, file_local):
+    """
+    Expose a cached object at file_local with a hard link (no copy), or
+    copy it when the link is not possible.
+    """
+    if os.path.lexists(file_local):
+        os.remove(file_local)
+    try:
+        os.link(data_path, file_local)
+    except OSError:
+        shutil.copyfile(data_path, file_local)
+
+
+# *****************************************************************************
+# Driver for downloading from s3 bucket through the local cache
+# *****************************************************************************
+def drv_cached_download(s3_bucket_name, s3_key, file_local):
+    """
+    Download an S3 object to file_local, reusing the cached copy if its ETag
+    still matches the one of the S3 object.
+    Parameters:
+    s3_bucket_name (str): Name of the S3 bucket.
+    s3_key (str): Key (path) of the file in S3.
+    file_local (str): Local path of the downloaded file.
+    Returns:
+    bool: True if the file came from the cache, False otherwise.
+    """
+    if not cache_enabled:
+        drv_s3.drv_s3_download(s3_bucket_name, s3_key, file_local)
+        return False
+
+    os.makedirs(cache_fldr, exist_ok=True)
+    data_path, meta_path = _cache_paths(s3_bucket_name, s3_key)
+    head = drv_s3.get_s3_client().head_object(Bucket=s3_bucket_name,
+                                              Key=s3_key)
+    etag = head['ETag']
+    size = head['ContentLength']
+
+    # *************************************************************************
+    # Cache hit: same ETag and same size as the S3 object
+    # *************************************************************************
+    try:
+        with open(meta_path) as f:
+            meta = json.load(f)
+        if meta['etag'] == etag and os.path.getsize(data_path) == size:
+            os.utime(data_path)  # mark as most recently used
+            _cache_link(data_path, file_local)
+            _stats['cache_hits'] += 1
+            _stats['cache_bytes_hit'] += size
+            print(f"File found in cache: {s3_key}")
+            return True
+    except (FileNotFoundError, ValueError, KeyError):
+        pass
+
+    # *************************************************************************
+    # Cache miss: download, then keep a copy if it fits in the cache
+    # *************************************************************************
+    _stats['cache_misses'] += 1
+    for path in (meta_path, data_path):
+        if os.path.exists(path):
+            os.remove(path)
+    if not _cache_make_room(size):
+        print(f"File too large for the cache: {s3_key}")
+        drv_s3.drv_s3_download(s3_bucket_name, s3_key, file_local, head)
+        return False
+    data_part = f"{data_path}.{os.getpid()}.part"
+    drv_s3.drv_s3_download(s3_bucket_name, s3_key, data_part, head)
+    os.replace(data_part, data_path)
+    with open(meta_path, 'w') as f:
+        json.dump({'bucket': s3_bucket_name, 'key': s3_key, 'etag': etag,
+                   'size': size}, f)
+    _cache_link(data_path, file_local)
+    return False
+
+
+# *****************************************************************************
+# Return the statistics of the cache, for profiling
+# *****************************************************************************
+def get_cache_stats():
+    return dict(_stats)
+
+
+# *****************************************************************************
+# End
+# *****************************************************************************
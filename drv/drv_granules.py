@@ -0,0 +1,461 @@
+#!/usr/bin/env python3
+# *****************************************************************************
+# drv_granules.py
+# *****************************************************************************
+
+# Purpose:
+# Python driver caching the results of Earthdata granule searches
+# (earthaccess.search_data) on local disk and optionally in S3, keyed by the
+# search parameters (short_name, version, temporal window, bounding box,
+# ...). The granule list of a past month never changes once published, so
+# complete entries answer the searches offline, without a round trip to CMR.
+# The granules found are downloaded by a pool of workers, resuming partial
+# files, skipping the files already downloaded (same size and checksum) and
+# retrying failed granules. In us-west-2, where the Earthdata cloud is, the
+# files are read directly from S3, otherwise through their HTTPS links.
+# Authors:
+# Manu Tom, Cedric H. David, 2023-2025
+
+
+# *****************************************************************************
+# Example usage (prefetch of the searches of a range of months)
+# *****************************************************************************
+# CURRNT_GRANULE_CACHE_S3=s3://currnt-data/granules \
+#     python3 drv_granules.py GLDAS_VIC10_3H 2000-01 2009-12
+# CURRNT_GRANULE_CACHE_S3=s3://currnt-data/granules \
+#     python3 drv_granules.py GLDAS_VIC10_3H 2000-01 2009-12 1
+
+
+# *****************************************************************************
+# Import libraries
+# *****************************************************************************
+import os
+import sys
+import json
+import time
+import hashlib
+import datetime
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+# *****************************************************************************
+# set parameters (can be overridden with environment variables)
+# *****************************************************************************
+cache_fldr = os.environ.get('CURRNT_GRANULE_CACHE_DIR', '/tmp/granules')
+# Optional S3 location shared by all containers, e.g. s3://bucket/granules
+cache_s3 = os.environ.get('CURRNT_GRANULE_CACHE_S3', '')
+# A search is complete (never repeated) when its temporal window ended more
+# than this number of days ago, i.e. when all its granules are published
+latency_days = float(os.environ.get('CURRNT_GRANULE_LATENCY_DAYS', '90'))
+# Parameters of the searches of the LDAS files
+DEFAULT_SEARCH = {'cloud_hosted': True, 'bounding_box': (-180, -60, 180, 90)}
+# Number of granules downloaded at the same time
+download_workers = int(os.environ.get('CURRNT_DOWNLOAD_WORKERS', '8'))
+# Number of attempts per granule, waiting 1, 2, 4, ... seconds in between
+download_attempts = int(os.environ.get('CURRNT_DOWNLOAD_ATTEMPTS', '4'))
+download_chunk = 256 * 1024
+# direct (S3, only in us-west-2), external (HTTPS) or auto (direct when the
+# function runs in us-west-2, external otherwise)
+granule_access = os.environ.get('CURRNT_GRANULE_ACCESS', 'auto')
+# The temporary S3 credentials of a DAAC are valid 1 hour, renewed before
+DAAC_CREDENTIALS_SEC = 50 * 60
+
+
+# *****************************************************************************
+# Module state, kept across invocations of a warm container
+# *****************************************************************************
+_entries = {}
+_session = None
+_daac_clients = {}  # provider: (S3 client, time of its credentials)
+_daac_lock = threading.Lock()
+_stats = {'granule_cache_hits': 0, 'granule_cache_misses': 0,
+          'granule_downloads': 0, 'granule_skipped': 0, 'granule_retries': 0,
+          'granule_bytes': 0}
+_stats_lock = threading.Lock()
+
+
+# *****************************************************************************
+# Helper functions
+# *****************************************************************************
+def _cache_key(kwargs):
+    return hashlib.sha256(json.dumps(kwargs, sort_keys=True,
+                                     default=str).encode()).hexdigest()
+
+
+def _parse_time(value):
+    if isinstance(value, datetime.datetime):
+        return value.replace(tzinfo=None)
+    if isinstance(value, datetime.date):
+        return datetime.datetime(value.year, value.month, value.day)
+    for fmt in ('%Y-%m-%dT%H:%M:%S', '%Y-%m-%dT%H:%M:%SZ', '%Y-%m-%d',
+                '%Y-%m'):
+        try:
+            return datetime.datetime.strptime(str(value), fmt)
+        except ValueError:
+            pass
+    return None
+
+
+def _is_complete(kwargs, n_granules):
+    temporal = kwargs.get('temporal')
+    if not temporal or len(temporal) < 2 or n_granules == 0:
+        return False
+    t_end = _parse_time(temporal[1])
+    now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+    return (t_end is not None
+            and t_end < now - datetime.timedelta(days=latency_days))
+
+
+def _s3_location(key):
+    bucket, _, prefix = cache_s3[len('s3://'):].partition('/')
+    return bucket, f"{prefix.rstrip('/')}/{key}.json".lstrip('/')
+
+
+def _get_s3_client():
+    # shared tuned client, imported here as boto3 is only needed with S3
+    import drv_s3
+    return drv_s3.get_s3_client()
+
+
+# *****************************************************************************
+# Read and write the cache entries (memory, local disk, S3)
+# *****************************************************************************
+def _read_entry(key):
+    if key in _entries:
+        return _entries[key]
+    entry = None
+    path = os.path.join(cache_fldr, f"{key}.json")
+    if os.path.exists(path):
+        with open(path) as f:
+            entry = json.load(f)
+    elif cache_s3:
+        bucket, s3_key = _s3_location(key)
+        try:
+            body = _get_s3_client().get_object(Bucket=bucket, Key=s3_key)
+            entry = json.loads(body['Body'].read())
+        except Exception:
+            entry = None
+        if entry is not None:
+            _write_entry(key, entry, upload=False)
+    if entry is not None:
+        _entries[key] = entry
+    return entry
+
+
+def _write_entry(key, entry, upload=True):
+    _entries[key] = entry
+    os.makedirs(cache_fldr, exist_ok=True)
+    path = os.path.join(cache_fldr, f"{key}.json")
+    with open(path + '.tmp', 'w') as f:
+        json.dump(entry, f)
+    os.replace(path + '.tmp', path)
+    if upload and cache_s3:
+        bucket, s3_key = _s3_location(key)
+        try:
+            _get_s3_client().put_object(Bucket=bucket, Key=s3_key,
+                                        Body=json.dumps(entry).encode())
+        except Exception as e:
+            print(f"Granule search not saved to {cache_s3}: {e}")
+
+
+# *****************************************************************************
+# Search granules, answered from the cache when possible
+# *****************************************************************************
+def drv_search_data(**kwargs):
+    """
+    Same as earthaccess.search_data(**kwargs), e.g.
+    drv_search_data(short_name='GLDAS_VIC10_3H', cloud_hosted=True,
+                    bounding_box=(-180, -60, 180, 90),
+                    temporal=("2000-01-01T00:00:00", "2000-02"), count=1)
+    The results of a complete search (temporal window ended long enough
+    ago, at least one granule) are cached, and returned without searching
+    CMR again.
+    Returns:
+    list: earthaccess.results.DataGranule objects.
+    """
+    import earthaccess
+    from earthaccess.results import DataGranule
+    key = _cache_key(kwargs)
+    entry = _read_entry(key)
+    if entry is not None and entry['complete']:
+        _stats['granule_cache_hits'] += 1
+        print(f"Granule search answered from the cache ({key[:12]})")
+        return [DataGranule(granule, cloud_hosted=cloud_hosted)
+                for granule, cloud_hosted in entry['granules']]
+    _stats['granule_cache_misses'] += 1
+    results = earthaccess.search_data(**kwargs)
+    _write_entry(key, {
+        'search': json.loads(json.dumps(kwargs, default=str)),
+        'complete': _is_complete(kwargs, len(results)),
+        'granules': [(dict(granule), getattr(granule, 'cloud_hosted', True))
+                     for granule in results],
+        })
+    return results
+
+
+# *****************************************************************************
+# Download helpers: URL, expected size and checksum of the file of a granule
+# *****************************************************************************
+def _direct_access():
+    if granule_access != 'auto':
+        return granule_access == 'direct'
+    return os.environ.get('AWS_REGION',
+                          os.environ.get('AWS_DEFAULT_REGION')) == 'us-west-2'
+
+
+def _granule_files(granule):
+    """
+    Return (url, size in bytes or None, (algorithm, checksum) or None,
+    provider, HTTPS url) for each file of a granule (or of a URL), sizes and
+    checksums from the UMM metadata. With direct access, url is the S3 link
+    and the HTTPS link is the fallback.
+    """
+    if isinstance(granule, str):
+        return [(granule, None, None, None, granule)]
+    infos = {}
+    umm = granule.get('umm', {}).get('DataGranule', {})
+    for info in umm.get('ArchiveAndDistributionInformation', []):
+        infos[info.get('Name')] = info
+    provider = granule.get('meta', {}).get('provider-id')
+    external = {os.path.basename(url): url
+                for url in granule.data_links(access='external')}
+    urls = external
+    if _direct_access():
+        direct = {os.path.basename(url): url
+                  for url in granule.data_links(access='direct')
+                  if url.startswith('s3://')}
+        urls = {**external, **direct}
+    files = []
+    for name, url in urls.items():
+        info = infos.get(name, {})
+        checksum = info.get('Checksum')
+        if checksum:
+            checksum = (checksum['Algorithm'].lower().replace('-', ''),
+                        checksum['Value'].lower())
+        files.append((url, info.get('SizeInBytes'), checksum, provider,
+                      external.get(name, url)))
+    return files
+
+
+def _count(name, value=1):
+    with _stats_lock:
+        _stats[name] += value
+
+
+def _get_session():
+    global _session
+    if _session is None:
+        import earthaccess
+        try:
+            _session = earthaccess.get_requests_https_session()
+        except Exception:
+            # not logged in yet (EARTHDATA_USERNAME/PASSWORD or .netrc)
+            earthaccess.login()
+            _session = earthaccess.get_requests_https_session()
+    return _session
+
+
+def _get_daac_client(provider):
+    """
+    S3 client of a DAAC (e.g. GES_DISC), with its temporary credentials and
+    the tuned configuration of drv_s3.
+    """
+    with _daac_lock:
+        client, t_credentials = _daac_clients.get(provider, (None, 0.0))
+        if client is None or time.time() - t_credentials > \
+                DAAC_CREDENTIALS_SEC:
+            import earthaccess
+            import drv_s3
+            _get_session()  # logged in
+            credentials = earthaccess.get_s3_credentials(provider=provider)
+            client = drv_s3.drv_s3_client(
+                aws_access_key_id=credentials['accessKeyId'],
+                aws_secret_access_key=credentials['secretAccessKey'],
+                aws_session_token=credentials['sessionToken'],
+                region_name='us-west-2')
+            _daac_clients[provider] = (client, time.time())
+        return client
+
+
+def _open(url, provider, offset):
+    """
+    Return (blocks of the file from offset, True if the blocks start at
+    offset), or (None, True) if offset is the end of the file.
+    """
+    if url.startswith('s3://'):
+        bucket, _, s3_key = url[len('s3://'):].partition('/')
+        client = _get_daac_client(provider)
+        try:
+            args = {'Range': f"bytes={offset}-"} if offset else {}
+            body = client.get_object(Bucket=bucket, Key=s3_key, **args)['Body']
+        except client.exceptions.ClientError as e:
+            if e.response['Error']['Code'] == 'InvalidRange':
+                return None, True
+            raise
+        return body.iter_chunks(download_chunk), True
+    headers = {'Range': f"bytes={offset}-"} if offset else {}
+    response = _get_session().get(url, headers=headers, stream=True,
+                                  timeout=60)
+    if response.status_code == 416:
+        # range not satisfiable: the partial file is complete
+        response.close()
+        return None, True
+    response.raise_for_status()
+    return response.iter_content(download_chunk), response.status_code == 206
+
+
+def _is_valid(path, size, checksum):
+    if not os.path.exists(path):
+        return False
+    if size is not None and os.path.getsize(path) != size:
+        return False
+    if checksum is not None and checksum[0] in hashlib.algorithms_available:
+        sha = hashlib.new(checksum[0])
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(download_chunk), b''):
+                sha.update(block)
+        return sha.hexdigest() == checksum[1]
+    return size is not None or os.path.getsize(path) > 0
+
+
+# *****************************************************************************
+# Download the file of a granule, resuming a partial download
+# *****************************************************************************
+def _download_file(url, size, checksum, provider, https_url, local_path):
+    path = os.path.join(local_path, os.path.basename(url))
+    if _is_valid(path, size, checksum):
+        _count('granule_skipped')
+        print(f"Already downloaded: {path}")
+        return path
+    part_path = path + '.part'
+    for attempt in range(download_attempts):
+        t_start = time.time()
+        offset = (os.path.getsize(part_path)
+                  if os.path.exists(part_path) else 0)
+        try:
+            blocks, resumed = _open(url, provider, offset)
+            if blocks is not None:
+                if not resumed:
+                    offset = 0
+                with open(part_path, 'ab' if offset else 'wb') as f:
+                    for block in blocks:
+                        f.write(block)
+            if not _is_valid(part_path, size, checksum):
+                os.remove(part_path)
+                raise IOError(f"size or checksum of {url} does not match")
+            os.replace(part_path, path)
+        except Exception as e:
+            if attempt == download_attempts - 1:
+                raise
+            _count('granule_retries')
+            print(f"Download of {url} failed ({e}), attempt {attempt + 2}/"
+                  f"{download_attempts} in {2 ** attempt} s")
+            if url != https_url:
+                # direct access failed, e.g. no credentials: use HTTPS
+                print(f"Falling back to {https_url}")
+                url = https_url
+            time.sleep(2 ** attempt)
+            continue
+        n_bytes = os.path.getsize(path) - offset
+        runtime = max(time.time() - t_start, 1e-6)
+        _count('granule_downloads')
+        _count('granule_bytes', n_bytes)
+        print(f"Downloaded {path}: {n_bytes / 1e6:.1f} MB in "
+              f"{runtime:.2f} s ({n_bytes / 1e6 / runtime:.1f} MB/s)")
+        return path
+
+
+# *****************************************************************************
+# Download the files of granules with a pool of workers
+# *****************************************************************************
+def drv_download(granules, local_path, workers=None):
+    """
+    Same as earthaccess.download(granules, local_path), with a bounded pool
+    of workers. Files already in local_path with the expected size (and
+    checksum, when the metadata gives one) are not downloaded again, partial
+    files (.part) are resumed, and each file is attempted
+    CURRNT_DOWNLOAD_ATTEMPTS times with exponential backoff.
+    Parameters:
+    granules (list): DataGranule objects (or URLs).
+    local_path (str): Folder where the files are downloaded.
+    workers (int): Number of files downloaded at the same time.
+    Returns:
+    list: Paths to the files downloaded, in the order of the granules.
+    """
+    os.makedirs(local_path, exist_ok=True)
+    files = [file for granule in granules
+             for file in _granule_files(granule)]
+    if files:
+        _get_session()  # log in once, before the workers start
+    t_start = time.time()
+    bytes_start = _stats['granule_bytes']
+    with ThreadPoolExecutor(
+            max_workers=max(1, min(workers or download_workers,
+                                   len(files) or 1))) as executor:
+        paths = list(executor.map(
+            lambda file: _download_file(*file, local_path), files))
+    n_bytes = _stats['granule_bytes'] - bytes_start
+    runtime = max(time.time() - t_start, 1e-6)
+    print(f"Downloaded {len(paths)} files: {n_bytes / 1e6:.1f} MB in "
+          f"{runtime:.2f} s ({n_bytes / 1e6 / runtime:.1f} MB/s)")
+    return paths
+
+
+# *****************************************************************************
+# Temporal window of the search of a month, e.g. 2000-01-01T00:00:00 to
+# 2000-02
+# *****************************************************************************
+def drv_month_window(yyyy_mm):
+    year, month = int(yyyy_mm[:4]), int(yyyy_mm[5:7])
+    year_end, month_end = (year + 1, 1) if month == 12 else (year, month + 1)
+    return (f"{yyyy_mm}-01T00:00:00", f"{year_end}-{month_end:02d}")
+
+
+# *****************************************************************************
+# Prefetch the searches of a range of months
+# *****************************************************************************
+def drv_prefetch(short_name, yyyy_mm_start, yyyy_mm_end, **kwargs):
+    """
+    Search (and cache) the granules of each month of a range, with the
+    parameters used by the download drivers (DEFAULT_SEARCH, overridden by
+    kwargs, e.g. count=1).
+    Returns:
+    int: Number of months whose search is complete.
+    """
+    search = dict(DEFAULT_SEARCH, short_name=short_name, **kwargs)
+    year, month = int(yyyy_mm_start[:4]), int(yyyy_mm_start[5:7])
+    n_complete = 0
+    while f"{year}-{month:02d}" <= yyyy_mm_end:
+        yyyy_mm = f"{year}-{month:02d}"
+        search_month = dict(search, temporal=drv_month_window(yyyy_mm))
+        results = drv_search_data(**search_month)
+        complete = _read_entry(_cache_key(search_month))['complete']
+        n_complete += complete
+        print(f"{short_name} {yyyy_mm}: {len(results)} granules"
+              f"{'' if complete else ' (incomplete, searched again)'}")
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return n_complete
+
+
+# *****************************************************************************
+# Return the statistics of this module, for profiling
+# *****************************************************************************
+def get_granule_stats():
+    return dict(_stats)
+
+
+# *****************************************************************************
+# Main: prefetch the searches of a range of months
+# *****************************************************************************
+if __name__ == '__main__':
+    # e.g. GLDAS_VIC10_3H 2000-01 2009-12 [count], count=1 for drv_app3/4/5
+    if len(sys.argv) > 4:
+        drv_prefetch(*sys.argv[1:4], count=int(sys.argv[4]))
+    else:
+        drv_prefetch(*sys.argv[1:4])
+
+
+# *****************************************************************************
+# End
+# *****************************************************************************
@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+# *****************************************************************************
+# drv_lease.py
+# *****************************************************************************
+
+# Purpose:
+# Python driver making sure that only one of the concurrent invocations
+# prepares an object shared by all of them (e.g. the LDAS file of a month,
+# needed by all basins), while the others wait and then read the result. The
+# lease is a lock object created with an S3 conditional write (If-None-Match),
+# or a lock file when all invocations share a file system, and expires after
+# a time to live so that the lease of a crashed invocation can be taken over.
+# Authors:
+# Manu Tom, Cedric H. David, 2023-2025
+
+
+# *****************************************************************************
+# Import libraries
+# *****************************************************************************
+import os
+import json
+import time
+import uuid
+import random
+import socket
+import hashlib
+import threading
+import drv_s3
+
+
+# *****************************************************************************
+# set parameters (can be overridden with environment variables)
+# *****************************************************************************
+# s3 (lock objects next to the data), local (lock files) or off (no lease)
+lease_backend = os.environ.get('CURRNT_LEASE', 's3')
+lease_prefix = os.environ.get('CURRNT_LEASE_PREFIX', 'leases/')
+lease_fldr = os.environ.get('CURRNT_LEASE_DIR', '/tmp/leases')
+# A lease not released after this time belongs to a crashed invocation (the
+# default is the maximum duration of a Lambda invocation)
+lease_ttl = float(os.environ.get('CURRNT_LEASE_TTL_SEC', '900'))
+# After this time, an invocation stops waiting and prepares the object itself
+lease_max_wait = float(os.environ.get('CURRNT_LEASE_MAX_WAIT_SEC', '600'))
+# First wait between two checks, doubled up to lease_max_poll
+lease_poll = float(os.environ.get('CURRNT_LEASE_POLL_SEC', '2'))
+lease_max_poll = float(os.environ.get('CURRNT_LEASE_MAX_POLL_SEC', '30'))
+
+
+# *****************************************************************************
+# Module state, kept across invocations of a warm container
+# *****************************************************************************
+_stats_lock = threading.Lock()
+_stats = {'lease_acquired': 0, 'lease_taken_over': 0, 'lease_waited': 0,
+          'lease_wait_sec': 0.0}
+
+
+def _count(name, value=1):
+    with _stats_lock:
+        _stats[name] += value
+
+
+def _is_conflict(e):
+    return e.response.get('Error', {}).get('Code') in (
+        'PreconditionFailed', 'ConditionalRequestConflict')
+
+
+# *****************************************************************************
+# Lease on a shared object
+# *****************************************************************************
+class Lease:
+    """
+    Lease on the preparation of an object, e.g. the LDAS file of a month.
+    Parameters:
+    s3_bucket_name (str): Bucket of the object (and of its lock object).
+    s3_key (str): Key of the object.
+    """
+
+    def __init__(self, s3_bucket_name, s3_key):
+        self.s3_bucket_name = s3_bucket_name
+        self.s3_key = s3_key
+        self.lock_key = f"{lease_prefix}{s3_key}.lease"
+        self.lock_path = os.path.join(lease_fldr, hashlib.sha256(
+            f"{s3_bucket_name}/{s3_key}".encode()).hexdigest() + '.lease')
+        self.owner = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4()}"
+        self.held = False
+        self._release_lock = threading.Lock()
+
+    def _body(self):
+        return json.dumps({'owner': self.owner, 'key': self.s3_key,
+                           'expires': time.time() + lease_ttl})
+
+    # -------------------------------------------------------------------------
+    # Try to acquire the lease once, taking over an expired lease, return
+    # True if it is held
+    # -------------------------------------------------------------------------
+    def acquire(self):
+        if lease_backend == 's3':
+            self.held = self._acquire_s3()
+        elif lease_backend == 'local':
+            self.held = self._acquire_local()
+        else:
+            self.held = True
+        if self.held:
+            _count('lease_acquired')
+        return self.held
+
+    def _acquire_s3(self):
+        s3_client = drv_s3.get_s3_client()
+        try:
+            s3_client.put_object(Bucket=self.s3_bucket_name,
+                                 Key=self.lock_key, Body=self._body(),
+                                 IfNoneMatch='*')
+            return True
+        except s3_client.exceptions.ClientError as e:
+            if not _is_conflict(e):
+                raise
+        try:
+            response = s3_client.get_object(Bucket=self.s3_bucket_name,
+                                            Key=self.lock_key)
+        except s3_client.exceptions.NoSuchKey:
+            return False  # released meanwhile, acquired at the next attempt
+        lease = json.loads(response['Body'].read())
+        if lease['expires'] > time.time():
+            return False
+        # Expired: replace it, only if nobody replaced it before
+        try:
+            s3_client.put_object(Bucket=self.s3_bucket_name,
+                                 Key=self.lock_key, Body=self._body(),
+                                 IfMatch=response['ETag'])
+        except s3_client.exceptions.ClientError as e:
+            if not _is_conflict(e):
+                raise
+            return False
+        _count('lease_taken_over')
+        print(f"Took over the expired lease of {lease['owner']} on "
+              f"{self.s3_key}")
+        return True
+
+    def _acquire_local(self):
+        os.makedirs(lease_fldr, exist_ok=True)
+        try:
+            fd = os.open(self.lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            try:
+                with open(self.lock_path) as f:
+                    lease = json.load(f)
+            except (FileNotFoundError, ValueError):
+                return False  # released or being written
+            if lease['expires'] > time.time():
+                return False
+            # Expired: only one invocation can move it away
+            try:
+                os.rename(self.lock_path, f"{self.lock_path}.{self.owner}")
+            except FileNotFoundError:
+                return False
+            os.remove(f"{self.lock_path}.{self.owner}")
+            _count('lease_taken_over')
+            print(f"Took over the expired lease of {lease['owner']} on "
+                  f"{self.s3_key}")
+            return self._acquire_local()
+        with os.fdopen(fd, 'w') as f:
+            f.write(self._body())
+        return True
+
+    # -------------------------------------------------------------------------
+    # Release the lease (if still held by this invocation), can be called
+    # several times
+    # -------------------------------------------------------------------------
+    def release(self):
+        with self._release_lock:
+            if not self.held:
+                return
+            self.held = False
+        try:
+            if lease_backend == 's3':
+                s3_client = drv_s3.get_s3_client()
+                response = s3_client.get_object(Bucket=self.s3_bucket_name,
+                                                Key=self.lock_key)
+                if json.loads(response['Body'].read())['owner'] == self.owner:
+                    s3_client.delete_object(Bucket=self.s3_bucket_name,
+                                            Key=self.lock_key)
+            elif lease_backend == 'local':
+                with open(self.lock_path) as f:
+                    if json.load(f)['owner'] == self.owner:
+                        os.remove(self.lock_path)
+        except FileNotFoundError:
+            pass  # taken over and released by another invocation
+        except Exception as e:
+            if 'NoSuchKey' not in str(e):
+                # it expires anyway
+                print(f"Lease on {self.s3_key} not released: {e}")
+
+
+# *****************************************************************************
+# Prepare a shared object once: acquire its lease, or wait for it
+# *****************************************************************************
+def drv_single_flight(s3_bucket_name, s3_key, ready):
+    """
+    Make sure that only one invocation prepares a shared object. Either the
+    lease of the object is acquired, and the caller prepares the object and
+    then releases the lease once the object is in S3, or another invocation
+    holds it, and the object is waited for (with exponential backoff) until
+    ready() finds it. The lease of a crashed invocation expires after
+    CURRNT_LEASE_TTL_SEC, and the caller prepares the object itself after
+    CURRNT_LEASE_MAX_WAIT_SEC.
+    Parameters:
+    s3_bucket_name (str): Bucket of the object.
+    s3_key (str): Key of the object.
+    ready (callable): Returns the object (e.g. its head) if it exists in S3,
+    None otherwise.
+    Returns:
+    tuple: (lease, None) if the caller prepares the object, or (None, the
+    result of ready()) if another invocation prepared it.
+    """
+    t_start = time.time()
+    poll = lease_poll
+    waited = False
+    while True:
+        lease = Lease(s3_bucket_name, s3_key)
+        if lease.acquire():
+            # The object may have been published since ready() was called
+            result = ready()
+            if result is not None:
+                lease.release()
+                return None, result
+            break
+        t_wait = time.time() - t_start
+        if t_wait > lease_max_wait:
+            print(f"Waited {t_wait:.0f} s for {s3_key}, preparing it")
+            break
+        if not waited:
+            waited = True
+            _count('lease_waited')
+            print(f"{s3_key} is being prepared by another invocation, "
+                  "waiting")
+        time.sleep(poll * random.uniform(0.5, 1.0))
+        poll = min(2 * poll, lease_max_poll)
+        result = ready()
+        if result is not None:
+            _count('lease_wait_sec', time.time() - t_start)
+            print(f"{s3_key} prepared by another invocation after "
+                  f"{time.time() - t_start:.1f} s")
+            return None, result
+    _count('lease_wait_sec', time.time() - t_start)
+    return lease, None
+
+
+# *****************************************************************************
+# Return the statistics of this module, for profiling
+# *****************************************************************************
+def get_lease_stats():
+    return dict(_stats)
+
+
+# *****************************************************************************
+# End
+# *****************************************************************************
@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+# *****************************************************************************
+# drv_provenance.py
+# *****************************************************************************
+
+# Purpose:
+# Python driver computing the provenance fingerprint of a RAPID or RRR run
+# (input objects, model parameters, static inputs and image version), stored
+# as metadata of the outputs in S3, so that the handlers only recompute the
+# outputs whose inputs changed.
+# Authors:
+# Manu Tom, Cedric H. David, 2023-2025
+
+
+# *****************************************************************************
+# Example usage (at build time, table of the hashes of the static inputs)
+# *****************************************************************************
+# python3 drv_provenance.py /rapid/input
+
+
+# *****************************************************************************
+# Import libraries
+# *****************************************************************************
+import os
+import sys
+import json
+import hashlib
+import drv_s3
+
+
+# *****************************************************************************
+# set parameters (can be overridden with environment variables)
+# *****************************************************************************
+# Version of the image (RAPID/RRR executables and drivers), set at build time
+image_version = os.environ.get('CURRNT_IMAGE_VERSION', 'unknown')
+# Name of the S3 user metadata holding the fingerprint
+META_KEY = 'currnt-fingerprint'
+# Table of the hashes of the static inputs of a folder, computed at build time
+HASH_TABLE = 'file_hashes.json'
+# Recompute the outputs produced before fingerprints were recorded (legacy),
+# which are otherwise kept as is; a message can also set 'rerun_legacy'
+rerun_legacy = os.environ.get('CURRNT_RERUN_LEGACY', '0') == '1'
+
+
+# *****************************************************************************
+# Module state, kept across invocations of a warm container
+# *****************************************************************************
+_file_hashes = {}
+
+
+# *****************************************************************************
+# Return the head of an S3 object, or None if it does not exist
+# *****************************************************************************
+def drv_head(s3_bucket_name, s3_key):
+    s3_client = drv_s3.get_s3_client()
+    try:
+        return s3_client.head_object(Bucket=s3_bucket_name, Key=s3_key)
+    except s3_client.exceptions.ClientError as e:
+        if e.response['Error']['Code'] not in ("404", "NoSuchKey"):
+            raise
+        return None
+
+
+# *****************************************************************************
+# Identity of an input object: the fingerprint of the run that produced it,
+# or its ETag
+# *****************************************************************************
+def drv_object_id(head):
+    if head is None:
+        return None
+    return head.get('Metadata', {}).get(META_KEY) or head['ETag'].strip('"')
+
+
+# *****************************************************************************
+# Hash of the contents of static input files
+# *****************************************************************************
+def drv_file_hashes(paths):
+    """
+    Return the hash of the contents of files (e.g. the k and x parameter
+    files), kept for the lifetime of the container.
+    Parameters:
+    paths (list): Paths of the files.
+    Returns:
+    dict: {file name: sha256 of its contents}
+    """
+    hashes = {}
+    for path in paths:
+        st = os.stat(path)
+        cache_key = (os.path.normpath(path), st.st_mtime, st.st_size)
+        if cache_key not in _file_hashes:
+            sha = hashlib.sha256()
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                    sha.update(chunk)
+            _file_hashes[cache_key] = sha.hexdigest()
+        hashes[os.path.basename(path)] = _file_hashes[cache_key]
+    return hashes
+
+
+# *****************************************************************************
+# Hash all the static input files of a folder and save the table in it (e.g.
+# when building the image)
+# *****************************************************************************
+def drv_build_hash_table(inpt_fldr, suffix='.csv'):
+    paths = sorted(os.path.join(root, name)
+                   for root, dirs, files in os.walk(inpt_fldr)
+                   for name in files if name.endswith(suffix))
+    hashes = drv_file_hashes(paths)
+    table = []
+    for path in paths:
+        st = os.stat(path)
+        table.append({'path': os.path.normpath(path), 'mtime': st.st_mtime,
+                      'size': st.st_size,
+                      'sha256': hashes[os.path.basename(path)]})
+    with open(os.path.join(inpt_fldr, HASH_TABLE), 'w') as f:
+        json.dump(table, f)
+    print(f"Hashed {len(paths)} files of {inpt_fldr}")
+    return len(paths)
+
+
+# *****************************************************************************
+# Load the table of hashes computed at build time, e.g. during the init phase
+# of the container: the files are not read, those changed or missing from the
+# table are hashed when first used
+# *****************************************************************************
+def drv_load_hash_table(inpt_fldr):
+    try:
+        with open(os.path.join(inpt_fldr, HASH_TABLE)) as f:
+            table = json.load(f)
+    except FileNotFoundError:
+        return 0
+    for entry in table:
+        _file_hashes[(os.path.normpath(entry['path']), entry['mtime'],
+                      entry['size'])] = entry['sha256']
+    return len(table)
+
+
+# *****************************************************************************
+# Hash of the contents of the input files referenced by an object
+# *****************************************************************************
+def drv_input_files(obj, inpt_fldr):
+    """
+    Return the hash of the contents of the files of inpt_fldr (e.g. the k and
+    x parameter files) referenced by the attributes of an object (e.g. a
+    RAPID object).
+    """
+    return drv_file_hashes([value for value in vars(obj).values()
+                            if isinstance(value, str)
+                            and value.startswith(inpt_fldr)
+                            and os.path.isfile(value)])
+
+
+# *****************************************************************************
+# Parameters of an object (e.g. a RAPID object, from which the namelist is
+# written), with the scratch folder removed from the file paths
+# *****************************************************************************
+def drv_object_params(obj, tmp_fldr='/tmp'):
+    return {name: str(value).replace(tmp_fldr.rstrip('/'), '/tmp')
+            for name, value in sorted(vars(obj).items())}
+
+
+# *****************************************************************************
+# Fingerprint of a run
+# *****************************************************************************
+def drv_fingerprint(**inputs):
+    """
+    Parameters:
+    inputs: Everything the outputs depend on, e.g. model, input object
+        identities, parameters. The image version is always included.
+    Returns:
+    str: sha256 of the inputs.
+    """
+    inputs['image_version'] = image_version
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True,
+                                     default=str).encode()).hexdigest()
+
+
+# *****************************************************************************
+# Extra arguments of an upload storing the fingerprint as metadata
+# *****************************************************************************
+def drv_upload_args(fingerprint):
+    if fingerprint is None:
+        return None
+    return {'Metadata': {META_KEY: fingerprint}}
+
+
+# *****************************************************************************
+# State of an output in S3 compared with the fingerprint of a new run
+# *****************************************************************************
+def drv_output_state(head, fingerprint, rerun=None):
+    """
+    Parameters:
+    rerun (bool): Treat the legacy outputs as stale, CURRNT_RERUN_LEGACY if
+        None.
+    Returns:
+    str: 'missing' if there is no output, 'match' if it was produced with
+        the same inputs, 'stale' if its inputs changed, 'legacy' if it was
+        produced before fingerprints were recorded (kept as is, unless
+        rerun).
+    """
+    if head is None:
+        return 'missing'
+    stored = head.get('Metadata', {}).get(META_KEY)
+    if stored is None:
+        if rerun is None:
+            rerun = rerun_legacy
+        return 'stale' if rerun else 'legacy'
+    return 'match' if stored == fingerprint else 'stale'
+
+
+# *****************************************************************************
+# Main: hash the static inputs of the folders given as arguments
+# *****************************************************************************
+if __name__ == '__main__':
+    for fldr in sys.argv[1:]:
+        drv_build_hash_table(fldr)
+
+
+# *****************************************************************************
+# End
+# *****************************************************************************
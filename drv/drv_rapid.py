@@ -13,22 +13,44 @@
 # Import libraries
 # *****************************************************************************
 import os
-import subprocess
-import boto3
+import re
 import logging
+import multiprocessing
+import multiprocessing.connection
+import traceback
+import drv_s3
+import drv_cache
+import drv_trace
+import drv_provenance
 
-# Following libs needed only for the one time job of 1980-01 Qinit creation
-import shutil
-import netCDF4 as nc
-import numpy as np
+
+# *****************************************************************************
+# set parameters (can be overridden with environment variables)
+# *****************************************************************************
+# Number of values written at once when creating state files
+state_chunk_elems = int(os.environ.get('CURRNT_STATE_CHUNK_ELEMS', '1048576'))
+# Compression of the outputs (Qout, Qinit) before their upload, '0': uploaded
+# as written by RAPID
+compress_enabled = os.environ.get('CURRNT_COMPRESS', '0') == '1'
+compress_level = int(os.environ.get('CURRNT_COMPRESS_LEVEL', '4'))
+# Significant digits kept in Qout (lossy quantization), '': lossless
+compress_digits = int(os.environ.get('CURRNT_COMPRESS_DIGITS', '0') or '0')
+# Reaches per chunk, each chunk holding the whole time series of its reaches
+compress_chunk_reaches = int(
+    os.environ.get('CURRNT_COMPRESS_CHUNK_REACHES', '512'))
+
+
+# *****************************************************************************
+# Module state, kept across invocations of a warm container
+# *****************************************************************************
+_stats = {'compress_bytes_in': 0, 'compress_bytes_out': 0}
 
 
 # *****************************************************************************
 # Driver for uploading from /tmp to s3 bucket
 # *****************************************************************************
 def drv_upl_S3(s3_bucket_name, f_upld, subfolder, basin_id, lsm_exp, lsm_mod,
-               lsm_stp, yyyy_mm):
-    s3_res = boto3.resource('s3')
+               lsm_stp, yyyy_mm, fingerprint=None):
     file_type = f_upld.split('/')[-1].split('_')[0]
     try:
         # Construct the desired filename for upload
@@ -40,12 +62,72 @@ def drv_upl_S3(s3_bucket_name, f_upld, subfolder, basin_id, lsm_exp, lsm_mod,
 
         # Upload to S3 bucket with the specified subfolder
         s3_key = "{}/{}".format(subfolder, qout_filename)
-        s3_res.Bucket(s3_bucket_name).upload_file(f_upld, s3_key)
+        # The provenance fingerprint of the run is stored as metadata
+        drv_s3.drv_s3_upload(f_upld, s3_bucket_name, s3_key,
+                             drv_provenance.drv_upload_args(fingerprint))
 
         print("File uploaded to S3:", s3_key)
+        return True
 
     except Exception as e:
         print(f"Error uploading file to S3: {e}")
+        return False
+
+
+# *****************************************************************************
+# Return the S3 key of the m3, Qinit or Qout file of a month, the files of a
+# member of an ensemble (e.g. hig) being in its own subfolder of the month
+# *****************************************************************************
+def drv_s3_key(basin_id, lsm_exp, lsm_mod, lsm_stp, yyyy_mm, file_type,
+               member=None):
+    subfolder = "pfaf_{}/{}/{}/{}/{}/".format(basin_id, lsm_exp, lsm_mod,
+                                              lsm_stp, yyyy_mm)
+    if member is not None and file_type != 'm3':
+        subfolder += member + '/'
+    if file_type == 'm3':
+        return subfolder + "m3_riv_pfaf_{}_{}_{}_{}_{}_utc.nc4".format(
+            basin_id, lsm_exp, lsm_mod, lsm_stp, yyyy_mm)
+    return subfolder + "{}_pfaf_{}_{}_{}_{}_{}.nc".format(
+        file_type, basin_id, lsm_exp, lsm_mod, lsm_stp, yyyy_mm)
+
+
+# *****************************************************************************
+# Driver for checking if the outputs of a month already exist in s3 bucket
+# *****************************************************************************
+def drv_month_done(s3_bucket_name, basin_id, lsm_exp, lsm_mod, lsm_stp,
+                   yyyy_mm, fingerprint=None, member=None, rerun=None):
+    """
+    Check if a month was already simulated, i.e. if its Qout file and the
+    Qinit file of the next month (uploaded last) exist in the S3 bucket, so
+    that a redelivered message does not run the month again. If the
+    fingerprint of the run is given, the outputs must also have been
+    produced with the same inputs (or before fingerprints were recorded).
+    Parameters:
+    member (str): Member of an ensemble (e.g. hig), whose outputs are in its
+        own subfolder.
+    rerun (bool): Run again the months produced before fingerprints were
+        recorded, or whose inputs cannot be checked (no fingerprint),
+        CURRNT_RERUN_LEGACY if None.
+    Returns:
+    bool: True if the month is done, False otherwise.
+    """
+    if rerun is None:
+        rerun = drv_provenance.rerun_legacy
+    for file_type, month in (('Qout', yyyy_mm),
+                             ('Qinit', drv_next_month(yyyy_mm))):
+        head = drv_provenance.drv_head(
+            s3_bucket_name, drv_s3_key(basin_id, lsm_exp, lsm_mod, lsm_stp,
+                                       month, file_type, member))
+        state = drv_provenance.drv_output_state(head, fingerprint, rerun)
+        if state == 'missing':
+            return False
+        if state == 'stale' and (fingerprint is not None or rerun):
+            print(f"Inputs of {yyyy_mm} changed for basin {basin_id}"
+                  + (f" ({member})" if member else ""))
+            return False
+    print(f"Outputs of {yyyy_mm} already in S3 for basin {basin_id}"
+          + (f" ({member})" if member else ""))
+    return True
 
 
 # *****************************************************************************
@@ -67,9 +149,7 @@ def suppress_debug_logging():
 # Driver for downloading from s3 bucket to /tmp
 # *****************************************************************************
 def drv_dwn_S3(s3_bucket_name, basin_id, lsm_exp, lsm_mod, lsm_stp, yyyy_mm,
-               file_type):
-    s3_res = boto3.resource('s3')
-
+               file_type, tmp_fldr='/tmp', member=None):
     # Suppress debug logging for boto3 and related components
     suppress_debug_logging()
 
@@ -85,19 +165,19 @@ def drv_dwn_S3(s3_bucket_name, basin_id, lsm_exp, lsm_mod, lsm_stp, yyyy_mm,
             )
 
             # Create the local file path in /tmp directory
-            file_local = os.path.join('/tmp',
+            file_local = os.path.join(tmp_fldr,
                                       "m3_riv_pfaf_{}_{}_{}_{}_{}_utc.nc4"
                                       .format(basin_id, lsm_exp, lsm_mod,
                                               lsm_stp, yyyy_mm))
 
         elif file_type == 'Qinit':
-            s3_key = "pfaf_{}/{}/{}/{}/{}/Qinit_pfaf_{}_{}_{}_{}_{}.nc".format(
-                basin_id, lsm_exp, lsm_mod, lsm_stp, yyyy_mm,
-                basin_id, lsm_exp, lsm_mod, lsm_stp, yyyy_mm)
+            # The state of a member of an ensemble is in its own subfolder
+            s3_key = drv_s3_key(basin_id, lsm_exp, lsm_mod, lsm_stp, yyyy_mm,
+                                'Qinit', member)
 
             # Create the local file path in /tmp directory
             file_local = os.path.join(
-                '/tmp',
+                tmp_fldr,
                 "Qinit_pfaf_{}_{}_{}_{}_{}_utc.nc".format(
                     basin_id, lsm_exp, lsm_mod, lsm_stp, yyyy_mm
                     )
@@ -106,14 +186,12 @@ def drv_dwn_S3(s3_bucket_name, basin_id, lsm_exp, lsm_mod, lsm_stp, yyyy_mm,
         else:
             raise ValueError("Invalid file_type. Use 'm3' or 'Qinit'.")
 
-        # Download file from S3 bucket
-        s3_res.Bucket(s3_bucket_name).download_file(s3_key, file_local)
+        # Download file from S3 bucket, or reuse the cached copy
+        drv_cache.drv_cached_download(s3_bucket_name, s3_key, file_local)
         print("File downloaded from S3:", s3_key)
 
-        # Check downloaded file
-        result_chk_dwnld = subprocess.run(["ls", "-lR", "/tmp"],
-                                          capture_output=True, text=True)
-        print("Checking download folder contents:\n", result_chk_dwnld.stdout)
+        # Check downloaded file (only when debugging)
+        drv_trace.drv_debug_listing(tmp_fldr)
 
         # Return the subfolder for later use
         return "/".join(s3_key.split("/")[:-1])
@@ -123,39 +201,228 @@ def drv_dwn_S3(s3_bucket_name, basin_id, lsm_exp, lsm_mod, lsm_stp, yyyy_mm,
         return None  # Return None if an error occurs
 
 
+# *****************************************************************************
+# Driver for writing a state file (e.g. Qinit) with the structure of another
+# *****************************************************************************
+def drv_write_state(template_path, state_path, value=0.0, var_name='Qout',
+                    chunk_elems=None):
+    """
+    Create a NetCDF state file with the dimensions, attributes, data types
+    and storage settings of a template (e.g. a Qfinal file), with var_name
+    set to a constant value. The values of var_name are never read from the
+    template, the other variables (rivid, time, lat, lon, ...) are copied.
+    All values are written in chunks, so that the memory used does not
+    depend on the size of the basin.
+
+    Parameters:
+    template_path (str): Path to the NetCDF file used as template.
+    state_path (str): Path to the new NetCDF file to be created.
+    value (float): Value of all the elements of var_name.
+    var_name (str): Name of the state variable.
+    chunk_elems (int): Number of elements written at once.
+    """
+    # Only needed for the creation of the initial Qinit files (1979-12), so
+    # not imported when the container starts
+    import netCDF4 as nc
+    import numpy as np
+
+    chunk_elems = chunk_elems or state_chunk_elems
+    with nc.Dataset(template_path, 'r') as src, \
+            nc.Dataset(state_path, 'w', format=src.data_model) as dst:
+        src.set_auto_mask(False)
+        dst.setncatts({name: src.getncattr(name) for name in src.ncattrs()})
+        for name, dim in src.dimensions.items():
+            dst.createDimension(name, None if dim.isunlimited() else len(dim))
+        for name, src_var in src.variables.items():
+            kwargs = {}
+            if src.data_model.startswith('NETCDF4'):
+                kwargs.update({filter_name: setting for filter_name, setting
+                               in (src_var.filters() or {}).items()
+                               if filter_name in ('zlib', 'complevel',
+                                                  'shuffle', 'fletcher32')})
+                chunking = src_var.chunking()
+                if chunking == 'contiguous':
+                    kwargs['contiguous'] = True
+                elif chunking:
+                    kwargs['chunksizes'] = chunking
+            attrs = {attr: src_var.getncattr(attr)
+                     for attr in src_var.ncattrs()}
+            dst_var = dst.createVariable(name, src_var.datatype,
+                                         src_var.dimensions,
+                                         fill_value=attrs.pop('_FillValue',
+                                                              None),
+                                         **kwargs)
+            dst_var.setncatts(attrs)
+            dst_var.set_auto_mask(False)
+            if src_var.ndim == 0:
+                if name != var_name:
+                    dst_var.assignValue(src_var.getValue())
+                else:
+                    dst_var.assignValue(value)
+                continue
+
+            # Write blocks along the longest dimension (rivid for Qout)
+            shape = src_var.shape
+            axis = max(range(len(shape)), key=lambda i: shape[i])
+            n_other = max(1, int(np.prod(shape)) // max(shape[axis], 1))
+            block = max(1, chunk_elems // n_other)
+            for start in range(0, shape[axis], block):
+                index = [slice(None)] * len(shape)
+                index[axis] = slice(start, min(start + block, shape[axis]))
+                index = tuple(index)
+                if name == var_name:
+                    block_shape = list(shape)
+                    block_shape[axis] = index[axis].stop - start
+                    dst_var[index] = np.full(block_shape, value,
+                                             dtype=src_var.dtype)
+                else:
+                    dst_var[index] = src_var[index]
+    print(f"State file created: {state_path} ({var_name} = {value})")
+
+
 # *****************************************************************************
 # Driver for generating initial Qinits (Qout populated with zeros)
 # *****************************************************************************
 def drv_generate_initial_Qinit(qfinal_path, qinit_zeros_file_path):
     """
-    Set all Qout values to zero in the specified NetCDF file while preserving
-    the original precision and data type,
-    and save the modified data to a new NetCDF file.
+    Create a Qinit file with all Qout values set to zero, with the same
+    structure, precision and data type as a Qfinal file.
 
     Parameters:
     qfinal_path (str): Path to the original NetCDF file.
     qinit_zeros_file_path (str): Path to the new NetCDF file to be created.
     """
-    # Copy the original file to the new file
-    shutil.copyfile(qfinal_path, qinit_zeros_file_path)
+    drv_write_state(qfinal_path, qinit_zeros_file_path, value=0.0,
+                    var_name='Qout')
 
-    # Open the new NetCDF file in read-write mode
-    with nc.Dataset(qinit_zeros_file_path, 'r+') as ds:
-        # Print original Qout values for verification
-        print("Original Qout values (first 10 values):")
-        print(ds.variables['Qout'][:, :10])
 
-        # Get the data type of the Qout variable
-        qout_dtype = ds.variables['Qout'].dtype
+# *****************************************************************************
+# Driver for generating the initial Qinits of many basins in one call
+# *****************************************************************************
+def drv_generate_initial_Qinits(file_pairs, value=0.0, max_workers=1):
+    """
+    Create the Qinit files of several basins, e.g. for the preparation of a
+    spin-up, each with the memory footprint of one chunk.
+
+    Parameters:
+    file_pairs (list): (qfinal_path, qinit_path) of each basin.
+    value (float): Initial value of Qout.
+    max_workers (int): Number of files created concurrently.
+    Returns:
+    list: Paths of the Qinit files created.
+    """
+    drv_run_parallel(drv_write_state,
+                     [(qfinal_path, qinit_path, value, 'Qout')
+                      for qfinal_path, qinit_path in file_pairs],
+                     max_workers)
+    return [qinit_path for _, qinit_path in file_pairs]
 
-        # Set all Qout values to zero while preserving
-        # the original data type and precision
-        ds.variables['Qout'][:] = np.zeros_like(ds.variables['Qout'][:],
-                                                dtype=qout_dtype)
 
-        # Print modified Qout values for verification
-        print("Modified Qout values (first 10 values):")
-        print(ds.variables['Qout'][:, :10])
+# *****************************************************************************
+# Helper function copying the contents of a NetCDF file with compression
+# *****************************************************************************
+def _drv_copy_compressed(src, dst, lossy_var, significant_digits, complevel,
+                         chunk_reaches, chunk_elems):
+    src.set_auto_maskandscale(False)
+    dst.setncatts({name: src.getncattr(name) for name in src.ncattrs()})
+    for name, dim in src.dimensions.items():
+        dst.createDimension(name, None if dim.isunlimited() else len(dim))
+    for name, src_var in src.variables.items():
+        shape = src_var.shape
+        kwargs = {}
+        if src_var.ndim > 0 and src_var.dtype.kind in 'iuf':
+            kwargs.update(zlib=True, complevel=complevel, shuffle=True)
+            if src_var.ndim > 1 and all(shape):
+                kwargs['chunksizes'] = (list(shape[:-1])
+                                        + [min(shape[-1], chunk_reaches)])
+            if (name == lossy_var and significant_digits
+                    and src_var.dtype.kind == 'f'):
+                kwargs['significant_digits'] = significant_digits
+        attrs = {attr: src_var.getncattr(attr)
+                 for attr in src_var.ncattrs()}
+        dst_var = dst.createVariable(name, src_var.datatype,
+                                     src_var.dimensions,
+                                     fill_value=attrs.pop('_FillValue', None),
+                                     **kwargs)
+        dst_var.setncatts(attrs)
+        dst_var.set_auto_maskandscale(False)
+        if src_var.ndim == 0:
+            dst_var.assignValue(src_var.getValue())
+            continue
+
+        # Copy blocks of whole chunks along the last dimension (rivid)
+        n_other = 1
+        for size in shape[:-1]:
+            n_other *= max(size, 1)
+        block = max(1, chunk_elems // n_other)
+        if src_var.ndim > 1:
+            block = max(chunk_reaches, block // chunk_reaches * chunk_reaches)
+        for start in range(0, shape[-1], block):
+            index = (Ellipsis, slice(start, min(start + block, shape[-1])))
+            dst_var[index] = src_var[index]
+
+
+# *****************************************************************************
+# Driver for compressing a NetCDF output file in place
+# *****************************************************************************
+def drv_compress_nc(nc_path, lossy_var=None, significant_digits=None,
+                    complevel=None, chunk_reaches=None, chunk_elems=None):
+    """
+    Rewrite a NetCDF file (e.g. Qout) as NetCDF4 with zlib and shuffle
+    filters. The variables with several dimensions are chunked by blocks of
+    reaches (last dimension) holding their whole time series, so that the
+    time series of a reach is read from a single chunk. The values are copied
+    in blocks of whole chunks, so that the memory used does not depend on
+    the size of the basin.
+
+    Parameters:
+    nc_path (str): Path to the NetCDF file, replaced by its compressed copy
+        unless the copy is not smaller.
+    lossy_var (str): Variable quantized to significant_digits (e.g. Qout).
+    significant_digits (int): Significant digits kept, lossless if None/0.
+    complevel (int): zlib compression level (1-9).
+    chunk_reaches (int): Number of reaches per chunk.
+    chunk_elems (int): Number of elements copied at once.
+    Returns:
+    tuple: Sizes (bytes) of the file before and after compression.
+    """
+    # Only needed when the compression is enabled
+    import netCDF4 as nc
+
+    size_in = os.path.getsize(nc_path)
+    tmp_path = nc_path + '.zip.nc'
+    try:
+        with nc.Dataset(nc_path, 'r') as src, \
+                nc.Dataset(tmp_path, 'w', format='NETCDF4') as dst:
+            _drv_copy_compressed(src, dst, lossy_var, significant_digits,
+                                 complevel or compress_level,
+                                 chunk_reaches or compress_chunk_reaches,
+                                 chunk_elems or state_chunk_elems)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    size_out = os.path.getsize(tmp_path)
+    if size_out >= size_in:
+        # e.g. small NETCDF3 files, whose NetCDF4 copy only adds headers
+        os.remove(tmp_path)
+        size_out = size_in
+        print(f"Kept {os.path.basename(nc_path)} as is: not smaller once "
+              f"compressed")
+    else:
+        os.replace(tmp_path, nc_path)
+        print(f"Compressed {os.path.basename(nc_path)}: {size_in} -> "
+              f"{size_out} bytes ({size_in / max(size_out, 1):.1f}x)")
+    _stats['compress_bytes_in'] += size_in
+    _stats['compress_bytes_out'] += size_out
+    return size_in, size_out
+
+
+# *****************************************************************************
+# Return the statistics of this module, for profiling
+# *****************************************************************************
+def get_compress_stats():
+    return dict(_stats)
 
 
 # *****************************************************************************
@@ -173,6 +440,153 @@ def drv_del_file(file_path):
         print(f"Error occurred while deleting file {file_path}: {e}")
 
 
+# *****************************************************************************
+# Driver for moving the /tmp files of a RAPID object to a scratch folder
+# *****************************************************************************
+def drv_relocate_tmp(obj, tmp_fldr):
+    """
+    Replace the /tmp prefix of all the file paths stored as attributes of an
+    object (e.g. a RAPID object) by a scratch folder, so that several objects
+    of the same basin/model can coexist in /tmp.
+
+    Parameters:
+    obj (object): Object whose string attributes are file paths.
+    tmp_fldr (str): Scratch folder replacing /tmp.
+    """
+    if tmp_fldr.rstrip('/') == '/tmp':
+        return
+    for name, value in vars(obj).items():
+        if isinstance(value, str) and value.startswith('/tmp/'):
+            setattr(obj, name, os.path.join(tmp_fldr, value[len('/tmp/'):]))
+
+
+# *****************************************************************************
+# Check that an object relocated to a scratch folder, and the namelist written
+# from it, no longer reference files of /tmp outside of the scratch folder
+# *****************************************************************************
+def drv_check_tmp(obj, tmp_fldr, namelist_file=None):
+    """
+    Raise an AssertionError if a /tmp path of the attributes of an object
+    (e.g. a RAPID object relocated with drv_relocate_tmp) or of its namelist
+    file is outside of the scratch folder, before running the model.
+
+    Parameters:
+    obj (object): Object whose string attributes are file paths.
+    tmp_fldr (str): Scratch folder replacing /tmp.
+    namelist_file (str): Namelist file written from the object.
+    """
+    if tmp_fldr.rstrip('/') == '/tmp':
+        return
+    paths = [value for value in vars(obj).values()
+             if isinstance(value, str) and value.startswith('/tmp/')]
+    if namelist_file is not None:
+        with open(namelist_file) as f:
+            paths += re.findall(r"""['"](/tmp/[^'"]*)['"]""", f.read())
+    scratch = os.path.join(os.path.normpath(tmp_fldr), '')
+    outside = sorted({path for path in paths
+                      if not os.path.normpath(path).startswith(scratch)})
+    if outside:
+        raise AssertionError(f"Paths outside of {tmp_fldr}: {outside}")
+
+
+# *****************************************************************************
+# Helper function running a task in a child process
+# *****************************************************************************
+def _drv_run_child(func, args, conn):
+    try:
+        conn.send((True, func(*args)))
+    except Exception:
+        conn.send((False, traceback.format_exc()))
+    finally:
+        conn.close()
+
+
+# *****************************************************************************
+# Driver for running tasks on a bounded pool of processes
+# *****************************************************************************
+def drv_run_parallel(func, args_list, max_workers, raise_errors=True):
+    """
+    Run func(*args) for each tuple of args_list, using at most max_workers
+    child processes at a time, and return the results in the order of
+    args_list. With max_workers <= 1, the tasks run in the current process.
+
+    Note: multiprocessing.Pool and concurrent.futures.ProcessPoolExecutor rely
+    on /dev/shm, which is not available on AWS Lambda, hence Process and Pipe.
+
+    Parameters:
+    func (callable): Function to run, must be defined at module level.
+    args_list (list): List of argument tuples, one per task.
+    max_workers (int): Maximum number of concurrent processes.
+    raise_errors (bool): Raise an error if any task failed, otherwise the
+        result of the failed tasks is None.
+    Returns:
+    list: Results of func, in the order of args_list.
+    """
+    if max_workers <= 1:
+        results = []
+        for idx, args in enumerate(args_list):
+            try:
+                results.append(func(*args))
+            except Exception:
+                if raise_errors:
+                    raise
+                print(f"Task {idx} failed:\n{traceback.format_exc()}")
+                results.append(None)
+        return results
+
+    results = [None] * len(args_list)
+    errors = []
+    pending = list(enumerate(args_list))
+    running = {}
+    while pending or running:
+        while pending and len(running) < max_workers:
+            idx, args = pending.pop(0)
+            conn_recv, conn_send = multiprocessing.Pipe(duplex=False)
+            proc = multiprocessing.Process(target=_drv_run_child,
+                                           args=(func, args, conn_send))
+            proc.start()
+            conn_send.close()
+            running[conn_recv] = (idx, proc)
+        for conn in multiprocessing.connection.wait(list(running)):
+            idx, proc = running.pop(conn)
+            try:
+                success, value = conn.recv()
+            except EOFError:
+                success, value = False, "worker exited without a result"
+            conn.close()
+            proc.join()
+            if success:
+                results[idx] = value
+            else:
+                print(f"Task {idx} failed:\n{value}")
+                errors.append(idx)
+    if errors and raise_errors:
+        raise RuntimeError(f"{len(errors)} of {len(args_list)} tasks failed")
+    return results
+
+
+# *****************************************************************************
+# Helper function returning the month following yyyy_mm
+# *****************************************************************************
+def drv_next_month(yyyy_mm):
+    if yyyy_mm.endswith('12'):  # for December to January transition
+        return str(int(yyyy_mm[:4]) + 1) + '-01'
+    return yyyy_mm[:5] + str(int(yyyy_mm[5:]) + 1).zfill(2)
+
+
+# *****************************************************************************
+# Helper function returning the months from yyyy_mm_start to yyyy_mm_end
+# *****************************************************************************
+def drv_month_range(yyyy_mm_start, yyyy_mm_end):
+    if yyyy_mm_end < yyyy_mm_start:
+        raise ValueError(f"Invalid month range: {yyyy_mm_start} to "
+                         f"{yyyy_mm_end}")
+    months = [yyyy_mm_start]
+    while months[-1] < yyyy_mm_end:
+        months.append(drv_next_month(months[-1]))
+    return months
+
+
 # *****************************************************************************
 # End
 # *****************************************************************************
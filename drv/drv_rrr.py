@@ -12,9 +12,13 @@
 # *****************************************************************************
 # Import libraries
 # *****************************************************************************
-import boto3
 import os
 import shutil
+from concurrent.futures import ThreadPoolExecutor
+import drv_s3
+import drv_trace
+import drv_granules
+import drv_provenance
 
 
 # *****************************************************************************
@@ -49,6 +53,30 @@ def drv_del_folder(folder_path):
               {folder_path}: {e}")
 
 
+# *****************************************************************************
+# Driver for downloading the LDAS granules of a month from Earthdata
+# *****************************************************************************
+def drv_dwn_ED(short_name, yyyy_mm, ldas_fldr):
+    """
+    Download the granules of a LDAS collection for one month. The search is
+    answered from the cache of drv_granules when possible, and the files are
+    downloaded by its pool of workers (resumed, verified and retried).
+    Parameters:
+    short_name (str): Earthdata collection, e.g. GLDAS_VIC10_3H.
+    yyyy_mm (str): Month, e.g. 2000-01.
+    ldas_fldr (str): Folder where the LSM driver reads the granules.
+    Returns:
+    list: Paths to the granules downloaded.
+    """
+    results = drv_granules.drv_search_data(
+        short_name=short_name,
+        temporal=drv_granules.drv_month_window(yyyy_mm),
+        **drv_granules.DEFAULT_SEARCH)
+    if not results:
+        raise FileNotFoundError(f"No {short_name} granules for {yyyy_mm}")
+    return drv_granules.drv_download(results, ldas_fldr)
+
+
 # *****************************************************************************
 # Driver for checking if file exists in S3
 # *****************************************************************************
@@ -61,7 +89,7 @@ def drv_s3_file_exists(s3_bucket_name, s3_key):
     Returns:
     bool: True if the file exists, False otherwise.
     """
-    s3_client = boto3.client('s3')
+    s3_client = drv_s3.get_s3_client()
     try:
         s3_client.head_object(Bucket=s3_bucket_name, Key=s3_key)
         print(f"File found in S3: {s3_key}")
@@ -78,9 +106,8 @@ def drv_s3_file_exists(s3_bucket_name, s3_key):
 # Driver for uploading from /tmp to s3 bucket
 # *****************************************************************************
 def drv_upl_S3(s3_bucket_name, f_upld, basin_id, lsm_exp, lsm_mod, lsm_stp,
-               yyyy_mm, file_label):
-    s3_res = boto3.resource('s3')
-    s3_client = boto3.client('s3')
+               yyyy_mm, file_label, fingerprint=None):
+    s3_client = drv_s3.get_s3_client()
     try:
         # Extract filename from file path
         fn_upld = os.path.basename(f_upld)
@@ -92,10 +119,15 @@ def drv_upl_S3(s3_bucket_name, f_upld, basin_id, lsm_exp, lsm_mod, lsm_stp,
         elif file_label == 'LDAS':
             s3_key = "{}/{}/{}/{}/{}".format(lsm_exp, lsm_mod, lsm_stp,
                                              yyyy_mm, fn_upld)
+        elif file_label == 'clip':
+            s3_key = "{}/{}/{}/{}/clip/{}".format(lsm_exp, lsm_mod, lsm_stp,
+                                                  yyyy_mm, fn_upld)
         else:
             print('unknown file label')
-        # Upload the file to S3 bucket
-        s3_res.Bucket(s3_bucket_name).upload_file(f_upld, s3_key)
+        # Upload the file to S3 bucket, with the provenance fingerprint of
+        # the run as metadata
+        drv_s3.drv_s3_upload(f_upld, s3_bucket_name, s3_key,
+                             drv_provenance.drv_upload_args(fingerprint))
         print("File uploaded to S3:", s3_key)
         # Verify file size
         local_file_size = os.path.getsize(f_upld)
@@ -139,6 +171,65 @@ def get_s3_file_size(s3_client, bucket_name, key):
         return -1
 
 
+# *****************************************************************************
+# Background queue of uploads from /tmp to s3 bucket
+# *****************************************************************************
+class TransferQueue:
+    """
+    Upload files on background threads as soon as they are final, so that
+    the uploads overlap with the computations, and delete each file locally
+    once its upload has been verified.
+    Parameters:
+    max_workers (int): Number of files uploaded concurrently.
+    """
+
+    def __init__(self, max_workers=4):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.futures = []
+        self.latest = {}  # latest upload of each file
+
+    # -------------------------------------------------------------------------
+    # Upload (and delete) a file in the background, return the future of
+    # the upload (its result is True if it succeeded)
+    # -------------------------------------------------------------------------
+    def submit_upload(self, s3_bucket_name, f_upld, basin_id, lsm_exp,
+                      lsm_mod, lsm_stp, yyyy_mm, file_label,
+                      fingerprint=None):
+        def upload():
+            # Traced as a top-level span, it runs in a thread of the queue
+            with drv_trace.span('upload', file_type=file_label):
+                uploaded = drv_upl_S3(s3_bucket_name, f_upld, basin_id,
+                                      lsm_exp, lsm_mod, lsm_stp, yyyy_mm,
+                                      file_label, fingerprint)
+            if uploaded:
+                drv_del_file(f_upld)
+                return True
+            print(f"Failed to upload {file_label} file: {f_upld}")
+            return False
+        future = self.executor.submit(upload)
+        self.futures.append(future)
+        self.latest[f_upld] = future
+        return future
+
+    # -------------------------------------------------------------------------
+    # Wait for the upload of one file, if any, return its success
+    # -------------------------------------------------------------------------
+    def wait_for(self, f_upld):
+        future = self.latest.get(f_upld)
+        return future.result() if future is not None else None
+
+    # -------------------------------------------------------------------------
+    # Wait for all uploads and stop the threads, return the numbers of
+    # succeeded and failed uploads
+    # -------------------------------------------------------------------------
+    def wait(self):
+        results = [future.result() for future in self.futures]
+        self.futures = []
+        self.latest = {}
+        self.executor.shutdown()
+        return results.count(True), results.count(False)
+
+
 # *****************************************************************************
 # End
 # *****************************************************************************
@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+# *****************************************************************************
+# drv_s3.py
+# *****************************************************************************
+
+# Purpose:
+# Python driver sharing one tuned S3 client and transfer configuration for
+# the whole lifetime of a (warm) AWS Lambda container
+# Authors:
+# Manu Tom, Cedric H. David, 2023-2025
+
+
+# *****************************************************************************
+# Import libraries
+# *****************************************************************************
+import os
+import time
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import boto3
+import drv_trace
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+
+
+# *****************************************************************************
+# set parameters (can be overridden with environment variables)
+# *****************************************************************************
+MB = 1024 * 1024
+max_pool_connections = int(os.environ.get('CURRNT_S3_MAX_POOL', '32'))
+multipart_threshold = int(
+    os.environ.get('CURRNT_S3_MULTIPART_THRESHOLD_MB', '16')) * MB
+multipart_chunksize = int(
+    os.environ.get('CURRNT_S3_MULTIPART_CHUNKSIZE_MB', '16')) * MB
+max_concurrency = int(os.environ.get('CURRNT_S3_MAX_CONCURRENCY', '10'))
+# Objects at least this large are downloaded with parallel byte ranges
+ranged_threshold = int(
+    os.environ.get('CURRNT_S3_RANGED_THRESHOLD_MB', '64')) * MB
+ranged_part_size = int(os.environ.get('CURRNT_S3_RANGED_PART_MB', '16')) * MB
+ranged_max_workers = int(os.environ.get('CURRNT_S3_RANGED_WORKERS', '16'))
+
+
+# *****************************************************************************
+# Module state, kept across invocations of a warm container
+# *****************************************************************************
+_lock = threading.Lock()
+_client = None
+_client_pid = None
+_transfer_config = None
+_stats = {'s3_clients_created': 0, 's3_ranged_downloads': 0,
+          's3_bytes_downloaded': 0}
+
+
+# *****************************************************************************
+# Return the S3 client of this container (and process)
+# *****************************************************************************
+def get_s3_client():
+    """
+    Return the S3 client shared by all the calls made in this process, and
+    create it on first use. A new client is created in child processes
+    because connection pools must not be shared across a fork.
+    Returns:
+    botocore.client.S3: The shared S3 client.
+    """
+    global _client, _client_pid
+    with _lock:
+        if _client is None or _client_pid != os.getpid():
+            _client = drv_s3_client()
+            _client_pid = os.getpid()
+    return _client
+
+
+# *****************************************************************************
+# Create an S3 client with the tuned configuration of the shared client
+# *****************************************************************************
+def drv_s3_client(**session_args):
+    """
+    Create an S3 client with the connection pool and retries of the shared
+    client, e.g. with the temporary credentials of an Earthdata DAAC.
+    Parameters:
+    session_args: Arguments of boto3.session.Session (aws_access_key_id,
+        aws_secret_access_key, aws_session_token, region_name, ...).
+    Returns:
+    botocore.client.S3: A new S3 client.
+    """
+    config = Config(max_pool_connections=max_pool_connections,
+                    retries={'max_attempts': 5, 'mode': 'standard'},
+                    tcp_keepalive=True)
+    _stats['s3_clients_created'] += 1
+    return boto3.session.Session(**session_args).client('s3', config=config)
+
+
+# *****************************************************************************
+# Return the transfer configuration shared by all uploads and downloads
+# *****************************************************************************
+def get_transfer_config():
+    global _transfer_config
+    if _transfer_config is None:
+        _transfer_config = TransferConfig(
+            multipart_threshold=multipart_threshold,
+            multipart_chunksize=multipart_chunksize,
+            max_concurrency=min(max_concurrency, max_pool_connections),
+            use_threads=True)
+    return _transfer_config
+
+
+# *****************************************************************************
+# Create the S3 client and transfer configuration during the init phase of
+# the container, instead of during the first invocation
+# *****************************************************************************
+def drv_s3_warmup():
+    try:
+        get_s3_client()
+        get_transfer_config()
+    except Exception as e:
+        # The client is created again on first use
+        print(f"S3 client not created at init: {e}")
+
+
+# *****************************************************************************
+# Driver for uploading a local file to s3 bucket
+# *****************************************************************************
+def drv_s3_upload(f_upld, s3_bucket_name, s3_key, extra_args=None):
+    get_s3_client().upload_file(f_upld, s3_bucket_name, s3_key,
+                                ExtraArgs=extra_args,
+                                Config=get_transfer_config())
+    drv_trace.add_bytes(os.path.getsize(f_upld))
+
+
+# *****************************************************************************
+# Driver for downloading from s3 bucket to a local file
+# *****************************************************************************
+def drv_s3_download(s3_bucket_name, s3_key, file_local, head=None):
+    """
+    Download an S3 object to a local file. If the response of a head_object
+    request is given and the object is large, the download uses parallel
+    byte ranges.
+    """
+    if head is not None and head['ContentLength'] >= ranged_threshold:
+        drv_s3_download_ranged(s3_bucket_name, s3_key, file_local, head=head)
+        return
+    get_s3_client().download_file(s3_bucket_name, s3_key, file_local,
+                                  Config=get_transfer_config())
+    _stats['s3_bytes_downloaded'] += os.path.getsize(file_local)
+    drv_trace.add_bytes(os.path.getsize(file_local))
+
+
+# *****************************************************************************
+# Driver for downloading from s3 bucket with parallel byte ranges
+# *****************************************************************************
+def drv_s3_download_ranged(s3_bucket_name, s3_key, file_local,
+                           part_size=None, max_workers=None, head=None):
+    """
+    Download an S3 object by splitting it in byte ranges fetched on a pool of
+    threads and written in place into a preallocated file, then verify the
+    result against the ETag of the object.
+    Parameters:
+    s3_bucket_name (str): Name of the S3 bucket.
+    s3_key (str): Key (path) of the file in S3.
+    file_local (str): Local path of the downloaded file.
+    part_size (int): Size of the byte ranges (in bytes).
+    max_workers (int): Number of ranges downloaded concurrently.
+    head (dict): Response of head_object for this object, if already known.
+    Returns:
+    float: Throughput of the transfer (in MB/s).
+    """
+    s3_client = get_s3_client()
+    t_start = time.time()
+    if head is None:
+        head = s3_client.head_object(Bucket=s3_bucket_name, Key=s3_key)
+    size = head['ContentLength']
+    etag = head['ETag']
+    part_size = part_size or ranged_part_size
+    max_workers = max_workers or ranged_max_workers
+
+    # *************************************************************************
+    # For objects uploaded in several parts, use the part size of the upload,
+    # so that the ETag can be checked from the MD5 of each range
+    # *************************************************************************
+    n_upload_parts = int(etag.strip('"').split('-')[1]) \
+        if '-' in etag else 0
+    if n_upload_parts > 0:
+        part_size = s3_client.head_object(Bucket=s3_bucket_name, Key=s3_key,
+                                          PartNumber=1)['ContentLength']
+    ranges = [(start, min(start + part_size, size) - 1)
+              for start in range(0, size, part_size)]
+
+    # *************************************************************************
+    # Download the ranges into the preallocated file
+    # *************************************************************************
+    def fetch(byte_range):
+        start, end = byte_range
+        response = s3_client.get_object(Bucket=s3_bucket_name, Key=s3_key,
+                                        Range=f"bytes={start}-{end}",
+                                        IfMatch=etag)
+        md5 = hashlib.md5()
+        offset = start
+        for chunk in response['Body'].iter_chunks(chunk_size=MB):
+            os.pwrite(fd, chunk, offset)
+            md5.update(chunk)
+            offset += len(chunk)
+        if offset != end + 1:
+            raise IOError(f"Incomplete range {start}-{end} of {s3_key}")
+        return md5.digest()
+
+    fd = os.open(file_local, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        os.ftruncate(fd, size)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            digests = list(executor.map(fetch, ranges))
+    except Exception:
+        os.close(fd)
+        os.remove(file_local)
+        raise
+    os.close(fd)
+
+    # *************************************************************************
+    # Verify the downloaded file against the ETag (not an MD5 with SSE-KMS)
+    # *************************************************************************
+    if os.path.getsize(file_local) != size:
+        os.remove(file_local)
+        raise IOError(f"Size mismatch for {s3_key}")
+    if head.get('ServerSideEncryption') != 'aws:kms':
+        if n_upload_parts > 0:
+            md5 = hashlib.md5(b"".join(digests)).hexdigest()
+            expected = f"{md5}-{len(digests)}"
+        else:
+            md5 = hashlib.md5()
+            with open(file_local, 'rb') as f:
+                for chunk in iter(lambda: f.read(8 * MB), b""):
+                    md5.update(chunk)
+            expected = md5.hexdigest()
+        if expected != etag.strip('"'):
+            os.remove(file_local)
+            raise IOError(f"ETag mismatch for {s3_key}: {expected} instead "
+                          f"of {etag}")
+
+    runtime = time.time() - t_start
+    throughput = size / MB / runtime if runtime > 0 else 0.0
+    _stats['s3_ranged_downloads'] += 1
+    _stats['s3_bytes_downloaded'] += size
+    drv_trace.add_bytes(size)
+    print(f"[Profiling] Downloaded {s3_key}: {size / MB:.1f} MB in "
+          f"{runtime:.2f} seconds ({throughput:.1f} MB/s, {len(ranges)} "
+          f"ranges, {max_workers} threads)")
+    return throughput
+
+
+# *****************************************************************************
+# Return the statistics of this module, for profiling
+# *****************************************************************************
+def get_s3_stats():
+    return dict(_stats)
+
+
+# *****************************************************************************
+# End
+# *****************************************************************************
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+# *****************************************************************************
+# drv_static.py
+# *****************************************************************************
+
+# Purpose:
+# Python driver converting the static inputs of a basin (rapid_connect,
+# coords, rapid_coupling, k, x, kfac, riv_bas_id CSV files) once into binary
+# NumPy arrays, memory-mapped read-only from the image (converted at build
+# time) or from a local cache, so that the drivers get typed arrays without
+# parsing or copying the CSV files at each invocation.
+# Authors:
+# Manu Tom, Cedric H. David, 2023-2025
+
+
+# *****************************************************************************
+# Example usage (at build time)
+# *****************************************************************************
+# python3 drv_static.py /rrr/input
+
+
+# *****************************************************************************
+# Import libraries
+# *****************************************************************************
+import os
+import sys
+import hashlib
+import numpy as np
+
+
+# *****************************************************************************
+# set parameters (can be overridden with environment variables)
+# *****************************************************************************
+# Arrays of CSV files without an up-to-date array next to them (e.g. in a
+# read-only image) are stored here
+static_cache_fldr = os.environ.get('CURRNT_STATIC_CACHE_DIR', '/tmp/static')
+
+
+# *****************************************************************************
+# Module state, kept across invocations of a warm container
+# *****************************************************************************
+_arrays = {}
+
+
+# *****************************************************************************
+# Path of the array next to a CSV file (e.g. k_pfaf_74_nrm.npy)
+# *****************************************************************************
+def drv_static_npy_path(csv_path):
+    return os.path.splitext(os.path.realpath(csv_path))[0] + '.npy'
+
+
+def _up_to_date(npy_path, csv_path):
+    return (os.path.exists(npy_path)
+            and os.path.getmtime(npy_path) >= os.path.getmtime(csv_path))
+
+
+# *****************************************************************************
+# Convert a CSV file into a binary NumPy array
+# *****************************************************************************
+def drv_static_convert(csv_path, npy_path=None):
+    """
+    Parse a CSV file of numbers and save it as a .npy array: int64 if all
+    values are integers (e.g. rapid_connect), float64 otherwise, 1-D for
+    files with one column (e.g. k, x).
+    Parameters:
+    csv_path (str): Path to the CSV file.
+    npy_path (str): Path to the array, next to the CSV file by default.
+    Returns:
+    str: Path to the array.
+    """
+    npy_path = npy_path or drv_static_npy_path(csv_path)
+    values = np.loadtxt(csv_path, delimiter=',', ndmin=2)
+    if values.shape[1] == 1:
+        values = values[:, 0]
+    if values.size and np.all(np.mod(values, 1) == 0):
+        values = values.astype(np.int64)
+    tmp_path = npy_path + '.tmp.npy'
+    np.save(tmp_path, values)
+    os.replace(tmp_path, npy_path)
+    return npy_path
+
+
+# *****************************************************************************
+# Convert all the CSV files of a folder (e.g. when building the image)
+# *****************************************************************************
+def drv_static_build(inpt_fldr):
+    npy_paths = []
+    for root, dirs, files in os.walk(inpt_fldr):
+        for name in sorted(files):
+            if name.endswith('.csv'):
+                npy_paths.append(drv_static_convert(os.path.join(root, name)))
+    print(f"Converted {len(npy_paths)} CSV files of {inpt_fldr}")
+    return npy_paths
+
+
+# *****************************************************************************
+# Array of a CSV file, memory-mapped read-only
+# *****************************************************************************
+def drv_static_array(csv_path):
+    """
+    Return the contents of a CSV file as a read-only memory-mapped array,
+    from the array converted next to it (e.g. in the image) or from the
+    local cache, where it is converted on first use if needed. The arrays
+    are kept for the lifetime of the container.
+    Parameters:
+    csv_path (str): Path to the CSV file (or to a symbolic link to it).
+    Returns:
+    numpy.memmap: The values of the CSV file.
+    """
+    csv_path = os.path.realpath(csv_path)
+    cache_key = (csv_path, os.path.getmtime(csv_path))
+    if cache_key not in _arrays:
+        npy_path = drv_static_npy_path(csv_path)
+        if not _up_to_date(npy_path, csv_path):
+            # one cached array per CSV path, e.g. /rrr/input/pfaf_74/...
+            fldr = os.path.join(static_cache_fldr, hashlib.sha256(
+                os.path.dirname(csv_path).encode()).hexdigest()[:16])
+            os.makedirs(fldr, exist_ok=True)
+            npy_path = os.path.join(fldr, os.path.basename(npy_path))
+            if not _up_to_date(npy_path, csv_path):
+                drv_static_convert(csv_path, npy_path)
+        _arrays[cache_key] = np.load(npy_path, mmap_mode='r')
+    return _arrays[cache_key]
+
+
+# *****************************************************************************
+# Map the arrays already converted in a folder, e.g. during the init phase
+# *****************************************************************************
+def drv_static_warmup(inpt_fldr):
+    n_arrays = 0
+    for root, dirs, files in os.walk(inpt_fldr):
+        for name in files:
+            csv_path = os.path.join(root, name)
+            if (name.endswith('.csv')
+                    and _up_to_date(drv_static_npy_path(csv_path), csv_path)):
+                drv_static_array(csv_path)
+                n_arrays += 1
+    return n_arrays
+
+
+# *****************************************************************************
+# Make a static input available in a folder (e.g. /tmp) without copying it
+# *****************************************************************************
+def drv_static_link(csv_path, otpt_fldr):
+    """
+    Create symbolic links to a CSV file and to its array (if converted) in
+    otpt_fldr, replacing the existing files.
+    Returns:
+    str: Path to the link to the CSV file.
+    """
+    links = [(os.path.realpath(csv_path),
+              os.path.join(otpt_fldr, os.path.basename(csv_path)))]
+    npy_path = drv_static_npy_path(csv_path)
+    if _up_to_date(npy_path, csv_path):
+        links.append((npy_path, os.path.join(otpt_fldr,
+                                             os.path.basename(npy_path))))
+    for target, link in links:
+        if os.path.lexists(link):
+            os.remove(link)
+        os.symlink(target, link)
+    return links[0][1]
+
+
+# *****************************************************************************
+# Main: convert the CSV files of the folders given as arguments
+# *****************************************************************************
+if __name__ == '__main__':
+    for fldr in sys.argv[1:]:
+        drv_static_build(fldr)
+
+
+# *****************************************************************************
+# End
+# *****************************************************************************
@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+# *****************************************************************************
+# drv_trace.py
+# *****************************************************************************
+
+# Purpose:
+# Python driver tracing the phases of a Lambda invocation (download,
+# namelist, run, upload, cleanup, ...) as nested spans with durations and
+# byte counts, emitted as JSON lines or as a CloudWatch Embedded Metric
+# Format (EMF) line. Directory listings used for debugging are only done in
+# an opt-in span.
+# Authors:
+# Manu Tom, Cedric H. David, 2023-2025
+
+
+# *****************************************************************************
+# Import libraries
+# *****************************************************************************
+import os
+import json
+import time
+import itertools
+import threading
+import contextlib
+import subprocess
+
+
+# *****************************************************************************
+# set parameters (can be overridden with environment variables)
+# *****************************************************************************
+# 'json': one line per span and one summary line, 'emf': one EMF line,
+# 'off': nothing emitted
+trace_format = os.environ.get('CURRNT_TRACE', 'json')
+debug_listing_enabled = os.environ.get('CURRNT_DEBUG_LISTING', '0') == '1'
+emf_namespace = os.environ.get('CURRNT_TRACE_NAMESPACE', 'CURRNT')
+# Time at which this module was imported, i.e. the beginning of the init
+# phase of the container when it is the first module imported by a handler
+t_import = time.time()
+
+
+# *****************************************************************************
+# Module state, reset at the beginning of each invocation
+# *****************************************************************************
+_lock = threading.Lock()
+_local = threading.local()
+_ids = itertools.count(1)
+_spans = []
+_name = 'currnt'
+
+
+# *****************************************************************************
+# Start a new trace
+# *****************************************************************************
+def drv_trace_reset(name):
+    global _name
+    with _lock:
+        _name = name
+        _spans.clear()
+    _local.stack = []
+
+
+def _stack():
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    return _local.stack
+
+
+# *****************************************************************************
+# Trace a phase as a span, nested in the current span of this thread
+# *****************************************************************************
+@contextlib.contextmanager
+def span(name, **attrs):
+    """
+    Context manager recording the duration of a phase, e.g.
+    with drv_trace.span('download', file_type='m3'): ...
+    Returns:
+    dict: The span, whose attributes can be completed inside the block.
+    """
+    stack = _stack()
+    parent = stack[-1] if stack else None
+    t_start = time.time()
+    record = {
+        'span_id': f"{os.getpid()}.{next(_ids)}",
+        'parent_id': parent['span_id'] if parent else None,
+        'name': name,
+        'path': (parent['path'] + '/' if parent else '') + name,
+        'pid': os.getpid(),
+        'start': t_start,
+        'bytes': 0,
+        }
+    record.update(attrs)
+    stack.append(record)
+    try:
+        yield record
+    finally:
+        record['duration_sec'] = time.time() - t_start
+        stack.pop()
+        with _lock:
+            _spans.append(record)
+
+
+# *****************************************************************************
+# Add transferred bytes to the current span of this thread (and its parents)
+# *****************************************************************************
+def add_bytes(n_bytes):
+    for record in _stack():
+        record['bytes'] += n_bytes
+
+
+# *****************************************************************************
+# Summary of the finished spans: total duration and bytes per path
+# *****************************************************************************
+def summary(parent_id=None):
+    """
+    Parameters:
+    parent_id (str): Only summarize the descendants of this span.
+    Returns:
+    dict: {path: {'duration_sec': total, 'bytes': total, 'count': n}}
+    """
+    with _lock:
+        spans = list(_spans)
+    if parent_id is not None:
+        parents = {record['span_id']: record['parent_id'] for record in spans}
+
+        def descends(span_id):
+            while span_id is not None:
+                span_id = parents.get(span_id)
+                if span_id == parent_id:
+                    return True
+            return False
+        spans = [record for record in spans if descends(record['span_id'])]
+    phases = {}
+    for record in spans:
+        phase = phases.setdefault(record['path'], {'duration_sec': 0.0,
+                                                   'bytes': 0, 'count': 0})
+        phase['duration_sec'] += record['duration_sec']
+        phase['bytes'] += record['bytes']
+        phase['count'] += 1
+    return phases
+
+
+# *****************************************************************************
+# A child process starts with no spans: the spans of its parent are not
+# returned again, while the spans merged from its own children (e.g. the
+# members of an ensemble run in a child process of a chain) are
+# *****************************************************************************
+def _after_fork():
+    global _lock, _spans
+    _lock = threading.Lock()
+    _spans = []
+
+
+os.register_at_fork(after_in_child=_after_fork)
+
+
+# *****************************************************************************
+# Spans finished in this process and merged from its child processes, e.g.
+# to return them from a child process
+# *****************************************************************************
+def drv_trace_spans():
+    with _lock:
+        return list(_spans)
+
+
+# *****************************************************************************
+# Add spans recorded in another process (e.g. a child process)
+# *****************************************************************************
+def drv_trace_merge(spans):
+    with _lock:
+        _spans.extend(spans)
+
+
+# *****************************************************************************
+# Emit the trace of the invocation
+# *****************************************************************************
+def drv_trace_emit(extra_metrics=None):
+    """
+    Print the spans (json) or the metrics (emf) of the invocation, so that
+    they can be queried in CloudWatch.
+    Parameters:
+    extra_metrics (dict): Other metrics to emit, e.g. memory usage.
+    """
+    if trace_format == 'off':
+        return
+    phases = summary()
+    if trace_format == 'json':
+        with _lock:
+            spans = sorted(_spans, key=lambda record: record['start'])
+        for record in spans:
+            print(json.dumps({'trace': _name, **record}))
+        print(json.dumps({'trace': _name, 'phases': phases,
+                          **(extra_metrics or {})}))
+    elif trace_format == 'emf':
+        metrics = {f"{path}_sec": phase['duration_sec']
+                   for path, phase in phases.items()}
+        metrics.update({f"{path}_bytes": phase['bytes']
+                        for path, phase in phases.items() if phase['bytes']})
+        # Only numbers are metrics, the other values (e.g. cold_start, labels)
+        # are kept as properties of the record
+        properties = {}
+        for name, value in (extra_metrics or {}).items():
+            if (isinstance(value, (int, float))
+                    and not isinstance(value, bool)):
+                metrics[name] = value
+            else:
+                properties[name] = value
+        print(json.dumps({
+            '_aws': {
+                'Timestamp': int(time.time() * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': emf_namespace,
+                    'Dimensions': [['Function']],
+                    'Metrics': [{'Name': name} for name in metrics],
+                    }],
+                },
+            'Function': _name,
+            **properties,
+            **metrics,
+            }))
+
+
+# *****************************************************************************
+# Driver listing a folder, only when debug listings are enabled
+# *****************************************************************************
+def drv_debug_listing(folder):
+    if not debug_listing_enabled:
+        return
+    with span('debug_listing', folder=folder):
+        result = subprocess.run(["ls", "-lR", folder], capture_output=True,
+                                text=True)
+        print(f"Contents ({folder}):\n", result.stdout)
+
+
+# *****************************************************************************
+# End
+# *****************************************************************************
@@ -0,0 +1,447 @@
+#!/usr/bin/env python3
+# *****************************************************************************
+# drv_vol.py
+# *****************************************************************************
+
+# Purpose:
+# Python driver computing the m3 files (volume of runoff entering each reach
+# at each time step) of one or several basins from one monthly LDAS file.
+# The coupling of each basin is compiled once into a sparse operator (CSR
+# matrix of reach x LDAS cell weights, the areas of the catchments), cached
+# on disk, so that the volumes of all reaches of all basins are one sparse
+# matrix product per block of time steps, with a cost proportional to the
+# number of non-zeros. The runoff fields are read once, by blocks of time
+# steps. Optionally, the runoff of the cells used by each basin is clipped
+# into a small per-basin LDAS file, from which the m3 file of the basin can
+# be computed without the global LDAS file.
+# Authors:
+# Manu Tom, Cedric H. David, 2023-2025
+
+
+# *****************************************************************************
+# Example usage
+# *****************************************************************************
+# python3 drv_vol.py /tmp/GLDAS_VIC_3H_2000-01_utc.nc4 \
+#     /rrr/input/pfaf_74/rapid_coupling_pfaf_74_GLDAS.csv \
+#     /tmp/m3_riv_pfaf_74_GLDAS_VIC_3H_2000-01_utc.nc4 \
+#     /rrr/input/pfaf_73/rapid_coupling_pfaf_73_GLDAS.csv \
+#     /tmp/m3_riv_pfaf_73_GLDAS_VIC_3H_2000-01_utc.nc4
+
+
+# *****************************************************************************
+# Import libraries
+# *****************************************************************************
+import os
+import sys
+import hashlib
+import datetime
+import numpy as np
+import netCDF4 as nc
+import drv_static
+
+
+# *****************************************************************************
+# set parameters (can be overridden with environment variables)
+# *****************************************************************************
+# Time steps of the LDAS file read at once
+vol_block = int(os.environ.get('CURRNT_VOL_BLOCK', '32'))
+# Compiled coupling operators, one folder per basin and LDAS grid
+vol_cache_fldr = os.environ.get(
+    'CURRNT_VOL_CACHE_DIR', os.path.join(drv_static.static_cache_fldr, 'vol'))
+# Time step of the LDAS file when it has a single time step (3H, seconds)
+DEFAULT_DT = 10800.0
+# Seconds per unit of the time variable of the LDAS file
+TIME_UNITS = {'seconds': 1.0, 'second': 1.0, 's': 1.0, 'minutes': 60.0,
+              'minute': 60.0, 'hours': 3600.0, 'hour': 3600.0, 'h': 3600.0,
+              'days': 86400.0, 'day': 86400.0, 'd': 86400.0}
+# Units of the runoff of the LDAS file: rates, multiplied by the time step,
+# or accumulations over the time step
+RUNOFF_RATES = ('kg m-2 s-1', 'kg m-2 s**-1', 'kg/m2/s', 'kg/m^2/s',
+                'mm s-1', 'mm/s')
+RUNOFF_ACCUMULATIONS = ('kg m-2', 'kg/m2', 'kg/m^2', 'mm')
+OPERATOR_ARRAYS = ('rivid', 'lon', 'lat', 'indptr', 'indices', 'data')
+
+
+# *****************************************************************************
+# Module state, kept across invocations of a warm container
+# *****************************************************************************
+_operators = {}
+
+
+# *****************************************************************************
+# Compile the coupling of a basin into a sparse operator
+# *****************************************************************************
+def drv_vol_build(cpl_csv, n_lat, n_lon, crd_csv=None):
+    """
+    Compile the coupling table of a basin (rivid, area in km2, 1-based lon
+    index, 1-based lat index, ...) into a CSR matrix of reach x LDAS cell
+    weights: a reach coupled with several cells has several non-zeros, and
+    cells outside of the grid (index 0) none.
+    Parameters:
+    cpl_csv (str): Path to the coupling file.
+    n_lat, n_lon (int): Size of the LDAS grid.
+    crd_csv (str): Path to the coords file (rivid, lon, lat), which gives the
+    order of the reaches, that of the coupling file by default.
+    Returns:
+    dict: rivid, lon, lat (NaN without coords) of the reaches, and indptr,
+    indices (flat index of the LDAS cells), data (m3 per kg m-2 of runoff)
+    of the CSR matrix.
+    """
+    cpl = drv_static.drv_static_array(cpl_csv)
+    cpl_rivid = cpl[:, 0].astype(np.int64)
+    if crd_csv is not None:
+        crd = drv_static.drv_static_array(crd_csv)
+        rivid = crd[:, 0].astype(np.int64)
+        lon, lat = crd[:, 1].astype(np.float64), crd[:, 2].astype(np.float64)
+    else:
+        unique, first = np.unique(cpl_rivid, return_index=True)
+        rivid = unique[np.argsort(first)]
+        lon = lat = np.full(len(rivid), np.nan)
+    if len(rivid) == 0:
+        raise ValueError(f"No reaches in {crd_csv or cpl_csv}")
+    # Row of each coupling entry
+    sorter = np.argsort(rivid, kind='stable')
+    pos = np.searchsorted(rivid, cpl_rivid, sorter=sorter)
+    pos = sorter[np.minimum(pos, len(rivid) - 1)]
+    if np.any(rivid[pos] != cpl_rivid):
+        raise ValueError(f"Reaches of {cpl_csv} missing from {crd_csv}")
+    i_lon = cpl[:, 2].astype(np.int64) - 1
+    i_lat = cpl[:, 3].astype(np.int64) - 1
+    coupled = ((i_lon >= 0) & (i_lon < n_lon) & (i_lat >= 0)
+               & (i_lat < n_lat) & (cpl[:, 1] != 0))
+    rows = pos[coupled]
+    order = np.argsort(rows, kind='stable')
+    return {
+        'rivid': rivid.astype(np.int32),
+        'lon': lon,
+        'lat': lat,
+        'indptr': np.concatenate(([0], np.cumsum(
+            np.bincount(rows, minlength=len(rivid))))).astype(np.int64),
+        'indices': (i_lat * n_lon + i_lon)[coupled][order],
+        # kg m-2 x km2 -> m3
+        'data': (cpl[:, 1][coupled][order] * 1000.0).astype(np.float32),
+        }
+
+
+# *****************************************************************************
+# Sparse operator of a basin, compiled once and cached on disk
+# *****************************************************************************
+def drv_vol_operator(cpl_csv, n_lat, n_lon, crd_csv=None):
+    """
+    Return the sparse operator of a basin (see drv_vol_build), memory-mapped
+    from the cache, where it is compiled on first use. The cache key
+    includes the paths and modification times of the CSV files and the size
+    of the LDAS grid.
+    """
+    paths = [os.path.realpath(path) for path in (cpl_csv, crd_csv) if path]
+    key = hashlib.sha256(repr(
+        ([(path, os.path.getmtime(path)) for path in paths], n_lat, n_lon,
+         crd_csv is not None)).encode()).hexdigest()[:16]
+    if key not in _operators:
+        fldr = os.path.join(vol_cache_fldr, key)
+        if not os.path.exists(os.path.join(fldr, 'data.npy')):
+            operator = drv_vol_build(cpl_csv, n_lat, n_lon, crd_csv)
+            tmp_fldr = f"{fldr}.tmp{os.getpid()}"
+            os.makedirs(tmp_fldr, exist_ok=True)
+            for name in OPERATOR_ARRAYS:
+                np.save(os.path.join(tmp_fldr, name + '.npy'), operator[name])
+            try:
+                os.rename(tmp_fldr, fldr)
+            except OSError:
+                # compiled meanwhile by another process
+                for name in OPERATOR_ARRAYS:
+                    os.remove(os.path.join(tmp_fldr, name + '.npy'))
+                os.rmdir(tmp_fldr)
+            print(f"Coupling operator of {cpl_csv} compiled: "
+                  f"{len(operator['rivid'])} reaches, "
+                  f"{len(operator['data'])} non-zeros")
+        _operators[key] = {
+            name: np.load(os.path.join(fldr, name + '.npy'), mmap_mode='r')
+            for name in OPERATOR_ARRAYS}
+    return _operators[key]
+
+
+# *****************************************************************************
+# Operator of several basins: their rows stacked
+# *****************************************************************************
+def drv_vol_stack(operators):
+    """
+    Return the CSR arrays (indptr, indices, data) of the operators of
+    several basins stacked, and the offsets of the basins in its rows.
+    """
+    indptrs, offsets = [np.zeros(1, dtype=np.int64)], [0]
+    for operator in operators:
+        indptrs.append(operator['indptr'][1:] + indptrs[-1][-1])
+        offsets.append(offsets[-1] + len(operator['rivid']))
+    return (np.concatenate(indptrs),
+            np.concatenate([operator['indices'] for operator in operators]),
+            np.concatenate([operator['data'] for operator in operators]),
+            offsets)
+
+
+# *****************************************************************************
+# Sparse matrix product: values of the rows of a CSR matrix for each time step
+# *****************************************************************************
+def drv_vol_product(fields, indptr, indices, data):
+    """
+    Parameters:
+    fields (ndarray): Runoff, time steps x LDAS cells.
+    indptr, indices, data (ndarray): CSR matrix, rows x LDAS cells.
+    Returns:
+    ndarray: time steps x rows.
+    """
+    n_row = len(indptr) - 1
+    products = fields[:, indices] * data
+    if len(data) == n_row and np.array_equal(indptr, np.arange(n_row + 1)):
+        # one non-zero per row, the usual coupling
+        return products
+    values = np.zeros((fields.shape[0], n_row), dtype=products.dtype)
+    filled = np.flatnonzero(np.diff(indptr) > 0)
+    if len(filled):
+        values[:, filled] = np.add.reduceat(products, indptr[filled], axis=1)
+    return values
+
+
+# *****************************************************************************
+# LDAS cells used by a basin, in the order of its reaches
+# *****************************************************************************
+def drv_vol_cells(operator):
+    """
+    Returns:
+    tuple: Flat indices of the LDAS cells used by the operator of a basin
+    (in the order of the reaches), and the column of each non-zero of the
+    operator in these cells.
+    """
+    unique, first, inverse = np.unique(operator['indices'],
+                                       return_index=True, return_inverse=True)
+    order = np.argsort(first, kind='stable')
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+    return unique[order], rank[inverse.ravel()]
+
+
+def _time_step(time):
+    """
+    Return the time step of a time variable in its own units (for the time
+    bounds) and in seconds (for the volumes).
+    """
+    units = getattr(time, 'units', 'seconds since 1970-01-01')
+    factor = TIME_UNITS[units.split(' since ')[0].strip().lower()]
+    times = time[:]
+    if len(times) > 1:
+        dt = float(times[1] - times[0])
+        return dt, dt * factor
+    return DEFAULT_DT / factor, DEFAULT_DT
+
+
+def _runoff_factor(ds, dt_sec):
+    """
+    Return the factor converting the runoff (RUNSF and RUNSB) of a LDAS file
+    to kg m-2 per time step: the time step in seconds for rates, 1 for
+    accumulations. Other units raise a ValueError.
+    """
+    factors = []
+    for name in ('RUNSF', 'RUNSB'):
+        units = ' '.join(str(getattr(ds[name], 'units', '')).split())
+        if units in RUNOFF_RATES:
+            factors.append(dt_sec)
+        elif units in RUNOFF_ACCUMULATIONS:
+            factors.append(1.0)
+        else:
+            raise ValueError(f"Units of {name} in {ds.filepath()} are not "
+                             f"a runoff rate or accumulation: '{units}'")
+    if factors[0] != factors[1]:
+        raise ValueError(f"RUNSF and RUNSB of {ds.filepath()} are not both "
+                         f"rates or both accumulations")
+    return factors[0]
+
+
+def _copy_time(ds, time):
+    """
+    Create the time variable with the dtype, fill value and attributes of
+    the time variable of the LDAS file.
+    """
+    var = ds.createVariable('time', time.dtype, ('time',),
+                            fill_value=getattr(time, '_FillValue', None))
+    var.setncatts({attr: time.getncattr(attr) for attr in time.ncattrs()
+                   if attr not in ('_FillValue', 'bounds')})
+    if 'units' not in var.ncattrs():
+        var.units = 'seconds since 1970-01-01 00:00:00 +00:00'
+    return var
+
+
+# *****************************************************************************
+# Create the clipped LDAS file of a basin
+# *****************************************************************************
+def _create_clip(clip_file, cells, ldas, n_lat, n_lon):
+    ds = nc.Dataset(clip_file, 'w', format='NETCDF4')
+    ds.createDimension('time', len(ldas['time']))
+    ds.createDimension('cell', len(cells))
+    var = _copy_time(ds, ldas['time'])
+    var[:] = ldas['time'][:]
+    var = ds.createVariable('cell', 'i8', ('cell',))
+    var.long_name = 'flat index (lat x n_lon + lon) of the LDAS cell'
+    var[:] = cells
+    for name in ('RUNSF', 'RUNSB'):
+        var = ds.createVariable(name, 'f4', ('time', 'cell'), zlib=True)
+        var.units = ldas[name].units
+    ds.n_lat = n_lat
+    ds.n_lon = n_lon
+    ds.source = os.path.basename(ldas.filepath())
+    return ds
+
+
+# *****************************************************************************
+# Create the m3 file of a basin
+# *****************************************************************************
+def _create_m3(m3_file, operator, ldas, dt):
+    ds = nc.Dataset(m3_file, 'w', format='NETCDF4')
+    ds.createDimension('time', len(ldas['time']))
+    ds.createDimension('rivid', len(operator['rivid']))
+    ds.createDimension('nv', 2)
+    var = ds.createVariable('rivid', 'i4', ('rivid',))
+    var.long_name = 'unique identifier for each river reach'
+    var.cf_role = 'timeseries_id'
+    var[:] = operator['rivid']
+    if not np.all(np.isnan(operator['lon'])):
+        for name, long_name, units in (
+                ('lon', 'longitude', 'degrees_east'),
+                ('lat', 'latitude', 'degrees_north')):
+            var = ds.createVariable(name, 'f8', ('rivid',))
+            var.long_name = f"{long_name} of a point related to each river " \
+                "reach"
+            var.standard_name = long_name
+            var.units = units
+            var[:] = operator[name]
+    times = ldas['time'][:]
+    var = _copy_time(ds, ldas['time'])
+    var.standard_name = 'time'
+    var.bounds = 'time_bnds'
+    var[:] = times
+    # same dtype as time, the bounds inherit its attributes (CF)
+    var = ds.createVariable('time_bnds', ldas['time'].dtype, ('time', 'nv'))
+    var[:, 0] = times
+    var[:, 1] = times + dt
+    var = ds.createVariable('m3_riv', 'f4', ('time', 'rivid'),
+                            fill_value=-9999.0)
+    var.long_name = 'accumulated inflow volume in river reach boundaries'
+    var.units = 'm3'
+    var.coordinates = 'lon lat time'
+    ds.Conventions = 'CF-1.6'
+    ds.featureType = 'timeSeries'
+    ds.history = (f"date created: "
+                  f"{datetime.datetime.now(datetime.timezone.utc):%Y-%m-%d}")
+    return ds
+
+
+# *****************************************************************************
+# Driver: m3 files of one or several basins from one LDAS file
+# *****************************************************************************
+def drv_vol_multi(ldas_file, cpl_csvs, m3_files, crd_csvs=None, block=None,
+                  clip_files=None):
+    """
+    Compute the m3 files of several basins, reading the runoff (RUNSF +
+    RUNSB) of the LDAS file once:
+    m3 = runoff (kg m-2 s-1) x time step (s) x area (km2) x 1000, or
+    m3 = runoff (kg m-2 per time step) x area (km2) x 1000.
+    Parameters:
+    ldas_file (str): Path to the monthly LDAS file.
+    cpl_csvs (list): Paths to the coupling files of the basins.
+    m3_files (list): Paths to the m3 files, in the same order.
+    crd_csvs (list): Paths to the coords files (order, lon and lat of the
+    reaches), optional.
+    block (int): Time steps read at once.
+    clip_files (list): Paths to the clipped LDAS files of the basins, also
+    written if given.
+    Returns:
+    list: Paths to the m3 files.
+    """
+    block = block or vol_block
+    crd_csvs = crd_csvs or [None] * len(cpl_csvs)
+    with nc.Dataset(ldas_file) as ldas:
+        n_time, n_lat, n_lon = ldas['RUNSF'].shape
+        dt, dt_sec = _time_step(ldas['time'])
+        operators = [drv_vol_operator(cpl_csv, n_lat, n_lon, crd_csv)
+                     for cpl_csv, crd_csv in zip(cpl_csvs, crd_csvs)]
+        indptr, indices, data, offsets = drv_vol_stack(operators)
+        data = data * np.float32(_runoff_factor(ldas, dt_sec))
+        m3s = [_create_m3(m3_file, operator, ldas, dt)
+               for m3_file, operator in zip(m3_files, operators)]
+        clips = []
+        for clip_file, operator in zip(clip_files or [], operators):
+            cells = drv_vol_cells(operator)[0]
+            clips.append((cells, _create_clip(clip_file, cells, ldas, n_lat,
+                                              n_lon)))
+        try:
+            for i_time in range(0, n_time, block):
+                steps = slice(i_time, min(i_time + block, n_time))
+                fields = {name: np.ma.filled(ldas[name][steps], 0.0).reshape(
+                    -1, n_lat * n_lon) for name in ('RUNSF', 'RUNSB')}
+                # One sparse product for the reaches of all basins
+                volumes = drv_vol_product(fields['RUNSF'] + fields['RUNSB'],
+                                          indptr, indices, data)
+                for i_basin, m3 in enumerate(m3s):
+                    m3['m3_riv'][steps] = volumes[
+                        :, offsets[i_basin]:offsets[i_basin + 1]]
+                for cells, clip in clips:
+                    for name, field in fields.items():
+                        clip[name][steps] = field[:, cells]
+        finally:
+            for ds in m3s + [clip for cells, clip in clips]:
+                ds.close()
+    print(f"m3 files of {len(m3_files)} basins ({offsets[-1]} reaches, "
+          f"{len(data)} non-zeros) computed from {ldas_file}")
+    return m3_files
+
+
+# *****************************************************************************
+# Driver: m3 files of basins from their clipped LDAS files
+# *****************************************************************************
+def drv_vol_clipped(clip_files, cpl_csvs, m3_files, crd_csvs=None,
+                    block=None):
+    """
+    Compute the m3 files of basins from their clipped LDAS files (written
+    by drv_vol_multi), the same as from the global LDAS file.
+    Parameters:
+    clip_files (list): Paths to the clipped LDAS files of the basins.
+    cpl_csvs, m3_files, crd_csvs (list): As in drv_vol_multi.
+    block (int): Time steps read at once.
+    Returns:
+    list: Paths to the m3 files.
+    """
+    block = block or vol_block
+    crd_csvs = crd_csvs or [None] * len(cpl_csvs)
+    for clip_file, cpl_csv, m3_file, crd_csv in zip(
+            clip_files, cpl_csvs, m3_files, crd_csvs):
+        with nc.Dataset(clip_file) as clip:
+            operator = drv_vol_operator(cpl_csv, int(clip.n_lat),
+                                        int(clip.n_lon), crd_csv)
+            cells, columns = drv_vol_cells(operator)
+            if not np.array_equal(clip['cell'][:], cells):
+                raise ValueError(f"Cells of {clip_file} do not match "
+                                 f"{cpl_csv}")
+            n_time = len(clip['time'])
+            dt, dt_sec = _time_step(clip['time'])
+            factor = _runoff_factor(clip, dt_sec)
+            data = operator['data'] * np.float32(factor)
+            with _create_m3(m3_file, operator, clip, dt) as m3:
+                for i_time in range(0, n_time, block):
+                    steps = slice(i_time, min(i_time + block, n_time))
+                    runoff = (np.ma.filled(clip['RUNSF'][steps], 0.0)
+                              + np.ma.filled(clip['RUNSB'][steps], 0.0))
+                    m3['m3_riv'][steps] = drv_vol_product(
+                        runoff, operator['indptr'], columns, data)
+        print(f"m3 file {m3_file} computed from {clip_file}")
+    return m3_files
+
+
+# *****************************************************************************
+# Main: LDAS file followed by pairs of coupling and m3 files
+# *****************************************************************************
+if __name__ == '__main__':
+    drv_vol_multi(sys.argv[1], sys.argv[2::2], sys.argv[3::2])
+
+
+# *****************************************************************************
+# End
+# *****************************************************************************
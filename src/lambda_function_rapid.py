@@ -5,7 +5,16 @@
 # Purpose:
 # run RAPID on AWS with lambda service:
 # 1) using an executable
-# 2) for 1 basin, 1 month
+# 2) for 1 basin, 1 month per message, several messages per SQS body
+# 3) or for 1 basin, a range of months per message, chaining the states of
+#    successive months locally
+# 4) optionally processing independent basins/LSM models concurrently
+# 5) reporting the SQS records whose messages failed (batchItemFailures), so
+#    that only these are redelivered, and not running again the months
+#    already simulated with the same inputs (provenance fingerprint)
+# 6) optionally running an ensemble of parameter sets (k and x files hig,
+#    low, nrm) for 1 basin, 1 month, from one download of the m3 file, the
+#    members running concurrently and having their own outputs and states
 # Authors:
 # Manu Tom, Cedric H. David, 2023-2024
 
@@ -21,193 +30,885 @@
 #     "yyyy_mm": "2000-01"
 #     "s3_name": "currnt-data"
 # }
+# or, for a range of months:
+# {
+#     "basin_id": "74",
+#     "lsm_exp": "GLDAS",
+#     "lsm_mod": "VIC"
+#     "lsm_stp": "3H"
+#     "yyyy_mm_start": "2000-01"
+#     "yyyy_mm_end": "2000-12"
+#     "s3_name": "currnt-data"
+# }
+# or, for an ensemble (true for the members of CURRNT_ENSEMBLE_MEMBERS):
+# {
+#     "basin_id": "74",
+#     "lsm_exp": "GLDAS",
+#     "lsm_mod": "VIC"
+#     "lsm_stp": "3H"
+#     "yyyy_mm": "2000-01"
+#     "s3_name": "currnt-data"
+#     "ensemble": ["hig", "low", "nrm"]
+# }
+# The outputs of a member are in its own subfolder of the month, e.g.
+# pfaf_74/GLDAS/VIC/3H/2000-01/hig/Qout_pfaf_74_GLDAS_VIC_3H_2000-01.nc and
+# pfaf_74/GLDAS/VIC/3H/2000-02/hig/Qinit_pfaf_74_GLDAS_VIC_3H_2000-02.nc
 
-import subprocess
 import os
 import shutil
 import json
 import time
 import resource
+import tempfile
+# Imported first, its import time is the beginning of the init phase
+import drv_trace as trace_drv
 import drv_rapid as rapid_io_drv
+import drv_s3 as s3_drv
+import drv_cache as cache_drv
+import drv_provenance as prov_drv
 import drv_MERIT_Hydro_v07_Basins_v01_GLDAS_v20 as rapid_drv
 
 
 # *****************************************************************************
-# lambda_handler
+# set parameters
 # *****************************************************************************
-def lambda_handler(event, context):
-    ns_runtime = 0.0
-    t_start = time.time()
-    rapid_io_drv.suppress_debug_logging()  # Suppress debug messages
-    print("received event: ", event)
-    for record in event['Records']:
-        sqs_body = record['body']
-        # Split the body content into individual JSON objects
-        messages = sqs_body.strip().split('\n')
+# Maximum number of message chains (basin/LSM model combinations) processed
+# concurrently, each in its own process. The default of 1 processes all
+# messages one after another in the Lambda process.
+max_workers = int(os.environ.get('CURRNT_MAX_WORKERS', '1'))
+# Static inputs (k, x, ...) downloaded from Zenodo in the image
+inpt_root = os.environ.get('CURRNT_RAPID_INPUT_DIR', '/rapid/input/')
+# Members of the ensemble messages ("ensemble": true): parameter sets, i.e.
+# suffixes of the k and x files
+ensemble_members = os.environ.get('CURRNT_ENSEMBLE_MEMBERS',
+                                  'hig,low,nrm').split(',')
+# Maximum number of members of an ensemble run concurrently, each in its own
+# process (on its own core)
+ensemble_workers = int(os.environ.get('CURRNT_ENSEMBLE_WORKERS',
+                                      str(os.cpu_count() or 1)))
 
-        # Process each message separately
-        for message in messages:
-            message_data = json.loads(message)
-            basin_id = message_data.get('basin_id')
-            lsm_exp = message_data.get('lsm_exp')
-            lsm_mod = message_data.get('lsm_mod')
-            lsm_stp = message_data.get('lsm_stp')
-            yyyy_mm = message_data.get('yyyy_mm')
-            s3_name = message_data.get('s3_name')
-
-            # Print extracted data for debugging
-            print("basin_id:", basin_id)
-            print("lsm_mod:", lsm_mod)
-            print("lsm_stp:", lsm_stp)
-            print("yyyy_mm:", yyyy_mm)
-            print("s3_name:", s3_name)
-
-            # *****************************************************************
-            # Download m3 and Qinit files from s3 to /tmp
-            # *****************************************************************
-            subfolder = rapid_io_drv.drv_dwn_S3(s3_name, basin_id, lsm_exp,
-                                                lsm_mod, lsm_stp, yyyy_mm,
-                                                'm3')
 
-            # If subfolder is None, skip the rest of the processing
-            if subfolder is None:
-                continue
+# *****************************************************************************
+# Init phase (once per container, before the first invocation): S3 client
+# and table of the hashes of the static inputs (computed at build time) used
+# by the provenance fingerprints
+# *****************************************************************************
+s3_drv.drv_s3_warmup()
+prov_drv.drv_load_hash_table(inpt_root)
+init_runtime = time.time() - trace_drv.t_import
+cold_start = True
 
-            # for all months except 1979-12
-            # Note: 1979-12 only used to create Qinit of 1980-01 with zeros
-            if (yyyy_mm != "1979-12"):
-                subfolder = rapid_io_drv.drv_dwn_S3(s3_name, basin_id, lsm_exp,
-                                                    lsm_mod, lsm_stp, yyyy_mm,
-                                                    'Qinit')
 
-            # If subfolder is None, skip the rest of the processing
-            if subfolder is None:
-                continue
+# *****************************************************************************
+# Upload a file from tmp_fldr to s3 bucket, raise an error if it failed. The
+# file is compressed first if enabled (only Qout is quantized, the states
+# are kept exact)
+# *****************************************************************************
+def upload(s3_name, f_upld, subfolder, basin_id, lsm_exp, lsm_mod, lsm_stp,
+           yyyy_mm, fingerprint):
+    if rapid_io_drv.compress_enabled:
+        with trace_drv.span('compress'):
+            try:
+                rapid_io_drv.drv_compress_nc(
+                    f_upld, lossy_var='Qout' if os.path.basename(
+                        f_upld).startswith('Qout_') else None,
+                    significant_digits=rapid_io_drv.compress_digits)
+            except Exception as e:
+                # The file is uploaded as written by RAPID
+                print(f"Compression of {os.path.basename(f_upld)} failed: "
+                      f"{e}")
+    if not rapid_io_drv.drv_upl_S3(s3_name, f_upld, subfolder, basin_id,
+                                   lsm_exp, lsm_mod, lsm_stp, yyyy_mm,
+                                   fingerprint):
+        raise IOError(f"Upload of {os.path.basename(f_upld)} failed")
 
-            m3_file = os.path.join('/tmp',
-                                   "m3_riv_pfaf_{}_{}_{}_{}_{}_utc.nc4".format(
-                                       basin_id, lsm_exp, lsm_mod, lsm_stp,
-                                       yyyy_mm))
-
-            q_init_file = '/tmp/Qinit_pfaf_' + basin_id + '_' + lsm_exp + '_' \
-                + lsm_mod + '_' + lsm_stp + '_' + yyyy_mm + '_utc.nc'
-
-            # *****************************************************************
-            # Check inputs downloaded from zenodo
-            # *****************************************************************
-            input_files_check = subprocess.run(["ls", "-lR",
-                                                '/rapid/input/pfaf_'
-                                                + basin_id + '/'],
-                                               capture_output=True, text=True)
-
-            print("Contents (/rapid/input/pfaf_XX):\n",
-                  input_files_check.stdout)
-
-            # *****************************************************************
-            # Run RAPID and check Qout in /tmp
-            # *****************************************************************
-            rapid = rapid_drv.RAPID(basin_id, lsm_mod, lsm_stp, yyyy_mm)
-
-            # Write the namelist file
-            rapid_drv.drv_write_namelist(rapid)
-
-            namelist_file = os.path.join('/tmp',
-                                         "rapid_namelist_pfaf_{}_{}_{}_{}_{}".
-                                         format(basin_id, lsm_exp, lsm_mod,
-                                                lsm_stp, yyyy_mm))
-
-            # Run RAPID
-            t_ns_start = time.time()
-            rapid_drv.drv_run(rapid)
-            t_ns_end = time.time()
-            ns_runtime = t_ns_end - t_ns_start
-            result_filegen_check = subprocess.run(["ls", "-lR", '/tmp'],
-                                                  capture_output=True,
-                                                  text=True)
-            print("Contents (/tmp):\n", result_filegen_check.stdout)
-
-            # *****************************************************************
-            # Upload Qout and Qfinal (as Qinit of next month) files from /tmp
-            # to the S3 bucket
-            # *****************************************************************
-            q_out_file = '/tmp/Qout_pfaf_' + basin_id + '_' + lsm_exp + '_' + \
-                lsm_mod + '_' + lsm_stp + '_' + yyyy_mm + '_utc.nc'
-
-            rapid_io_drv.drv_upl_S3(s3_name, q_out_file, subfolder, basin_id,
-                                    lsm_exp, lsm_mod, lsm_stp, yyyy_mm)
-
-            q_final_file = '/tmp/Qfinal_pfaf_' + basin_id + '_'\
-                + lsm_exp + '_' + lsm_mod + '_' + lsm_stp + '_'\
-                + yyyy_mm + '_utc.nc'
-
-            # upload Qfinal of current month as Qinit of next month
-            if yyyy_mm.endswith('12'):  # for December to January transition
-                next_month = str(int(yyyy_mm[:4]) + 1) + '-01'
-            else:
-                next_month = yyyy_mm[:5] + str(int(yyyy_mm[5:]) + 1).zfill(2)
 
-            subfolder = subfolder.replace(yyyy_mm, next_month)
-            q_init_file_nxt_month = '/tmp/Qinit_pfaf_' + basin_id + '_'\
-                + lsm_exp + '_' + lsm_mod + '_' + lsm_stp + '_'\
-                + next_month + '_utc.nc'
+# *****************************************************************************
+# RAPID object of 1 basin, 1 month, using the parameter files (k, x) of a
+# member of an ensemble (e.g. k_pfaf_74_hig.csv) instead of the nrm ones
+# *****************************************************************************
+def member_rapid(basin_id, lsm_mod, lsm_stp, yyyy_mm, member=None):
+    rapid = rapid_drv.RAPID(basin_id, lsm_mod, lsm_stp, yyyy_mm)
+    if member is None:
+        return rapid
+    for name, value in vars(rapid).items():
+        if isinstance(value, str) and value.endswith('_nrm.csv'):
+            member_file = value[:-len('_nrm.csv')] + f"_{member}.csv"
+            if not os.path.isfile(member_file):
+                raise FileNotFoundError(f"{os.path.basename(member_file)} "
+                                        f"not found for member {member}")
+            setattr(rapid, name, member_file)
+    return rapid
+
 
-            shutil.copyfile(q_final_file, q_init_file_nxt_month)
-            rapid_io_drv.drv_upl_S3(s3_name, q_init_file_nxt_month, subfolder,
-                                    basin_id, lsm_exp, lsm_mod, lsm_stp,
-                                    next_month)
+# *****************************************************************************
+# Return True if the Qinit file of a member of an ensemble exists, i.e. if
+# the member continues its own states, otherwise it starts from the Qinit
+# file shared by all members
+# *****************************************************************************
+def member_has_state(s3_name, basin_id, lsm_exp, lsm_mod, lsm_stp, yyyy_mm,
+                     member):
+    return prov_drv.drv_head(s3_name, rapid_io_drv.drv_s3_key(
+        basin_id, lsm_exp, lsm_mod, lsm_stp, yyyy_mm, 'Qinit',
+        member)) is not None
 
-            print("Upload driver: done")
 
-            # only for 1979-12
-            # generate the Qinit file (with Qout as zeros) for 1980-01
-            # from the Qfinal of 1979-12
-            if (yyyy_mm == "1979-12"):
-                q_init_zeros_file = '/tmp/Qinit_pfaf_' + basin_id + '_'\
-                    + lsm_exp + '_' + lsm_mod + '_' + lsm_stp + '_'\
-                    + next_month + '_utc.nc'
+# *****************************************************************************
+# Provenance fingerprint of the RAPID run of 1 basin, 1 month: m3 and Qinit
+# objects, RAPID parameters (namelist), static inputs (k, x, ...) and image
+# version. Return None if the m3 file does not exist.
+# *****************************************************************************
+def fingerprint_month(s3_name, basin_id, lsm_exp, lsm_mod, lsm_stp, yyyy_mm,
+                      qinit_id=None, member=None, qinit_member=None):
+    """
+    Parameters:
+    qinit_id (str): Identity of the Qinit file, e.g. the fingerprint of the
+        previous month when chaining months locally. Read from S3 if None.
+    member (str): Member of an ensemble (e.g. hig), None for the nrm
+        parameters of the messages without ensemble.
+    qinit_member (str): Member whose Qinit file is used, None for the Qinit
+        file shared by all members.
+    """
+    m3_id = prov_drv.drv_object_id(prov_drv.drv_head(
+        s3_name, rapid_io_drv.drv_s3_key(basin_id, lsm_exp, lsm_mod, lsm_stp,
+                                         yyyy_mm, 'm3')))
+    if m3_id is None:
+        return None
+    # Note: no Qinit for 1979-12
+    if qinit_id is None and yyyy_mm != "1979-12":
+        qinit_id = prov_drv.drv_object_id(prov_drv.drv_head(
+            s3_name, rapid_io_drv.drv_s3_key(basin_id, lsm_exp, lsm_mod,
+                                             lsm_stp, yyyy_mm, 'Qinit',
+                                             qinit_member)))
+    rapid = member_rapid(basin_id, lsm_mod, lsm_stp, yyyy_mm, member)
+    return prov_drv.drv_fingerprint(
+        model='RAPID', lsm_exp=lsm_exp, m3=m3_id, qinit=qinit_id,
+        params=prov_drv.drv_object_params(rapid),
+        static=prov_drv.drv_input_files(rapid, inpt_root))
+
+
+# *****************************************************************************
+# Run RAPID for 1 basin, 1 month in tmp_fldr, return the simulation time
+# *****************************************************************************
+def run_rapid(basin_id, lsm_mod, lsm_stp, yyyy_mm, tmp_fldr, member=None):
+    with trace_drv.span('namelist'):
+        rapid = member_rapid(basin_id, lsm_mod, lsm_stp, yyyy_mm, member)
+        rapid_io_drv.drv_relocate_tmp(rapid, tmp_fldr)
+
+        # Write the namelist file
+        rapid_drv.drv_write_namelist(rapid)
+        # RAPID must only use the files of the scratch folder
+        rapid_io_drv.drv_check_tmp(rapid, tmp_fldr,
+                                   getattr(rapid, 'namelist_file', None))
 
+    # Run RAPID
+    with trace_drv.span('rapid_run') as run_span:
+        rapid_drv.drv_run(rapid)
+    trace_drv.drv_debug_listing(tmp_fldr)
+    return run_span['duration_sec']
+
+
+# *****************************************************************************
+# Run RAPID for 1 member of an ensemble in its own folder, possibly in a child
+# process: return the simulation time and the spans of this process
+# *****************************************************************************
+def run_member(basin_id, lsm_mod, lsm_stp, yyyy_mm, member_fldr, member):
+    with trace_drv.span('member', member=member):
+        runtime = run_rapid(basin_id, lsm_mod, lsm_stp, yyyy_mm, member_fldr,
+                            member)
+    return runtime, trace_drv.drv_trace_spans()
+
+
+# *****************************************************************************
+# Process one message (1 basin, 1 month) using tmp_fldr as scratch folder
+# *****************************************************************************
+def process_message(message_data, tmp_fldr):
+    basin_id = message_data.get('basin_id')
+    lsm_exp = message_data.get('lsm_exp')
+    lsm_mod = message_data.get('lsm_mod')
+    lsm_stp = message_data.get('lsm_stp')
+    yyyy_mm = message_data.get('yyyy_mm')
+    s3_name = message_data.get('s3_name')
+    rerun = message_data.get('rerun_legacy')
+    result = {
+        'basin_id': basin_id,
+        'lsm_exp': lsm_exp,
+        'lsm_mod': lsm_mod,
+        'lsm_stp': lsm_stp,
+        'yyyy_mm': yyyy_mm,
+        'status': 'Failed',
+        'runtime_ns_sec': 0.0
+        }
+
+    # Print extracted data for debugging
+    print("basin_id:", basin_id)
+    print("lsm_mod:", lsm_mod)
+    print("lsm_stp:", lsm_stp)
+    print("yyyy_mm:", yyyy_mm)
+    print("s3_name:", s3_name)
+
+    # *************************************************************************
+    # Do not run again a month already simulated with the same inputs
+    # *************************************************************************
+    with trace_drv.span('provenance'):
+        fingerprint = fingerprint_month(s3_name, basin_id, lsm_exp, lsm_mod,
+                                        lsm_stp, yyyy_mm)
+        done = rapid_io_drv.drv_month_done(s3_name, basin_id, lsm_exp,
+                                           lsm_mod, lsm_stp, yyyy_mm,
+                                           fingerprint, rerun=rerun)
+    if done:
+        result['status'] = 'Done'
+        return result
+
+    # *************************************************************************
+    # Download m3 and Qinit files from s3 to tmp_fldr
+    # *************************************************************************
+    with trace_drv.span('download', file_type='m3'):
+        subfolder = rapid_io_drv.drv_dwn_S3(s3_name, basin_id, lsm_exp,
+                                            lsm_mod, lsm_stp, yyyy_mm, 'm3',
+                                            tmp_fldr)
+
+    # If subfolder is None, the input is missing
+    if subfolder is None:
+        raise FileNotFoundError(f"m3 file of {yyyy_mm} not found")
+
+    # for all months except 1979-12
+    # Note: 1979-12 only used to create Qinit of 1980-01 with zeros
+    if (yyyy_mm != "1979-12"):
+        with trace_drv.span('download', file_type='Qinit'):
+            subfolder = rapid_io_drv.drv_dwn_S3(s3_name, basin_id, lsm_exp,
+                                                lsm_mod, lsm_stp, yyyy_mm,
+                                                'Qinit', tmp_fldr)
+
+    # If subfolder is None, the input is missing
+    if subfolder is None:
+        raise FileNotFoundError(f"Qinit file of {yyyy_mm} not found")
+
+    m3_file = os.path.join(tmp_fldr,
+                           "m3_riv_pfaf_{}_{}_{}_{}_{}_utc.nc4".format(
+                               basin_id, lsm_exp, lsm_mod, lsm_stp, yyyy_mm))
+
+    q_init_file = os.path.join(tmp_fldr, 'Qinit_pfaf_' + basin_id + '_'
+                               + lsm_exp + '_' + lsm_mod + '_' + lsm_stp
+                               + '_' + yyyy_mm + '_utc.nc')
+
+    # *************************************************************************
+    # Check inputs downloaded from zenodo (only when debugging)
+    # *************************************************************************
+    trace_drv.drv_debug_listing('/rapid/input/pfaf_' + basin_id + '/')
+
+    # *************************************************************************
+    # Run RAPID and check Qout in tmp_fldr
+    # *************************************************************************
+    result['runtime_ns_sec'] = run_rapid(basin_id, lsm_mod, lsm_stp, yyyy_mm,
+                                         tmp_fldr)
+
+    namelist_file = os.path.join(tmp_fldr,
+                                 "rapid_namelist_pfaf_{}_{}_{}_{}_{}".
+                                 format(basin_id, lsm_exp, lsm_mod, lsm_stp,
+                                        yyyy_mm))
+
+    # *************************************************************************
+    # Upload Qout and Qfinal (as Qinit of next month) files from tmp_fldr to
+    # the S3 bucket
+    # *************************************************************************
+    with trace_drv.span('upload'):
+        q_out_file = os.path.join(tmp_fldr, 'Qout_pfaf_' + basin_id + '_'
+                                  + lsm_exp + '_' + lsm_mod + '_' + lsm_stp
+                                  + '_' + yyyy_mm + '_utc.nc')
+
+        upload(s3_name, q_out_file, subfolder, basin_id, lsm_exp, lsm_mod,
+               lsm_stp, yyyy_mm, fingerprint)
+
+        q_final_file = os.path.join(tmp_fldr, 'Qfinal_pfaf_' + basin_id + '_'
+                                    + lsm_exp + '_' + lsm_mod + '_' + lsm_stp
+                                    + '_' + yyyy_mm + '_utc.nc')
+
+        # upload Qfinal of current month as Qinit of next month
+        next_month = rapid_io_drv.drv_next_month(yyyy_mm)
+
+        subfolder = subfolder.replace(yyyy_mm, next_month)
+        q_init_file_nxt_month = os.path.join(tmp_fldr, 'Qinit_pfaf_'
+                                             + basin_id + '_' + lsm_exp + '_'
+                                             + lsm_mod + '_' + lsm_stp + '_'
+                                             + next_month + '_utc.nc')
+
+        shutil.copyfile(q_final_file, q_init_file_nxt_month)
+        # The Qinit of the next month is uploaded last, it marks the month as
+        # done (for 1979-12, it is replaced by the Qinit with zeros below)
+        if (yyyy_mm != "1979-12"):
+            upload(s3_name, q_init_file_nxt_month, subfolder, basin_id,
+                   lsm_exp, lsm_mod, lsm_stp, next_month, fingerprint)
+
+        print("Upload driver: done")
+
+        # only for 1979-12
+        # generate the Qinit file (with Qout as zeros) for 1980-01
+        # from the Qfinal of 1979-12
+        if (yyyy_mm == "1979-12"):
+            q_init_zeros_file = os.path.join(tmp_fldr, 'Qinit_pfaf_'
+                                             + basin_id + '_' + lsm_exp + '_'
+                                             + lsm_mod + '_' + lsm_stp + '_'
+                                             + next_month + '_utc.nc')
+
+            rapid_io_drv.drv_generate_initial_Qinit(q_final_file,
+                                                    q_init_zeros_file)
+            upload(s3_name, q_init_zeros_file, subfolder, basin_id,
+                   lsm_exp, lsm_mod, lsm_stp, next_month, fingerprint)
+
+    # *************************************************************************
+    # Delete Qout, Qfinal, m3, Qinit, namelist files from tmp_fldr
+    # *************************************************************************
+    with trace_drv.span('cleanup'):
+        if (yyyy_mm != "1979-12"):  # no Qinit for 1979-12
+            rapid_io_drv.drv_del_file(q_init_file)
+        rapid_io_drv.drv_del_file(m3_file)
+        rapid_io_drv.drv_del_file(q_out_file)
+        rapid_io_drv.drv_del_file(q_final_file)
+        rapid_io_drv.drv_del_file(q_init_file_nxt_month)
+        rapid_io_drv.drv_del_file(namelist_file)
+
+        # only for 1979-12
+        if (yyyy_mm == "1979-12"):
+            rapid_io_drv.drv_del_file(q_init_zeros_file)
+    trace_drv.drv_debug_listing(tmp_fldr)
+
+    result['status'] = 'Success'
+    return result
+
+
+# *****************************************************************************
+# Process one message (1 basin, range of months) using tmp_fldr as scratch
+# folder: the Qfinal of each month is used locally as the Qinit of the next
+# month, only the Qout files and the final state are uploaded
+# *****************************************************************************
+def process_range(message_data, tmp_fldr):
+    basin_id = message_data.get('basin_id')
+    lsm_exp = message_data.get('lsm_exp')
+    lsm_mod = message_data.get('lsm_mod')
+    lsm_stp = message_data.get('lsm_stp')
+    s3_name = message_data.get('s3_name')
+    rerun = message_data.get('rerun_legacy')
+    months = rapid_io_drv.drv_month_range(message_data.get('yyyy_mm_start'),
+                                          message_data.get('yyyy_mm_end'))
+    results = [{
+        'basin_id': basin_id,
+        'lsm_exp': lsm_exp,
+        'lsm_mod': lsm_mod,
+        'lsm_stp': lsm_stp,
+        'yyyy_mm': yyyy_mm,
+        'status': 'Failed',
+        'runtime_ns_sec': 0.0
+        } for yyyy_mm in months]
+    print(f"basin_id: {basin_id}, months: {months[0]} to {months[-1]}")
+
+    def fail(results_failed, error):
+        print(f"Error: {error}")
+        for result in results_failed:
+            result['status'] = 'Failed'
+            result['error'] = error
+
+    def tmp_file(prefix, yyyy_mm, ext):
+        return os.path.join(tmp_fldr, "{}_pfaf_{}_{}_{}_{}_{}_utc.{}".format(
+            prefix, basin_id, lsm_exp, lsm_mod, lsm_stp, yyyy_mm, ext))
+
+    def subfolder(yyyy_mm):
+        return "pfaf_{}/{}/{}/{}/{}".format(basin_id, lsm_exp, lsm_mod,
+                                            lsm_stp, yyyy_mm)
+
+    def run_month(result, yyyy_mm, fingerprint):
+        with trace_drv.span('download', file_type='m3'):
+            if rapid_io_drv.drv_dwn_S3(s3_name, basin_id, lsm_exp, lsm_mod,
+                                       lsm_stp, yyyy_mm, 'm3',
+                                       tmp_fldr) is None:
+                raise FileNotFoundError(f"m3 file of {yyyy_mm} not found")
+
+        result['runtime_ns_sec'] = run_rapid(basin_id, lsm_mod, lsm_stp,
+                                             yyyy_mm, tmp_fldr)
+
+        with trace_drv.span('upload'):
+            upload(s3_name, tmp_file('Qout', yyyy_mm, 'nc'),
+                   subfolder(yyyy_mm), basin_id, lsm_exp, lsm_mod, lsm_stp,
+                   yyyy_mm, fingerprint)
+
+        with trace_drv.span('cleanup'):
+            # Qfinal of current month becomes Qinit of next month, except for
+            # 1979-12 whose Qfinal only provides the template of the Qinit of
+            # 1980-01 (with Qout as zeros)
+            next_month = rapid_io_drv.drv_next_month(yyyy_mm)
+            q_final_file = tmp_file('Qfinal', yyyy_mm, 'nc')
+            q_init_file_nxt_month = tmp_file('Qinit', next_month, 'nc')
+            if (yyyy_mm == "1979-12"):
                 rapid_io_drv.drv_generate_initial_Qinit(q_final_file,
-                                                        q_init_zeros_file)
-                rapid_io_drv.drv_upl_S3(s3_name, q_init_zeros_file, subfolder,
-                                        basin_id, lsm_exp, lsm_mod, lsm_stp,
-                                        next_month)
-
-            # *****************************************************************
-            # Delete Qout, Qfinal, m3, Qinit, namelist files from /tmp
-            # *****************************************************************
-            if (yyyy_mm != "1979-12"):  # no Qinit for 1979-12
-                rapid_io_drv.drv_del_file(q_init_file)
-            rapid_io_drv.drv_del_file(m3_file)
-            rapid_io_drv.drv_del_file(q_out_file)
-            rapid_io_drv.drv_del_file(q_final_file)
-            rapid_io_drv.drv_del_file(q_init_file_nxt_month)
-            rapid_io_drv.drv_del_file(namelist_file)
-
-            # only for 1979-12
+                                                        q_init_file_nxt_month)
+                rapid_io_drv.drv_del_file(q_final_file)
+            else:
+                os.replace(q_final_file, q_init_file_nxt_month)
+                rapid_io_drv.drv_del_file(tmp_file('Qinit', yyyy_mm, 'nc'))
+
+            rapid_io_drv.drv_del_file(tmp_file('m3_riv', yyyy_mm, 'nc4'))
+            rapid_io_drv.drv_del_file(tmp_file('Qout', yyyy_mm, 'nc'))
+            rapid_io_drv.drv_del_file(os.path.join(
+                tmp_fldr, "rapid_namelist_pfaf_{}_{}_{}_{}_{}".format(
+                    basin_id, lsm_exp, lsm_mod, lsm_stp, yyyy_mm)))
+        result['status'] = 'Success'
+
+    # *************************************************************************
+    # Do not run again the months already simulated with the same inputs.
+    # The fingerprint of each month includes the one of the previous month
+    # (its Qinit), and only the state reached at the end of a range is
+    # uploaded: look for the last month done, the months before it are done
+    # with the same inputs too
+    # *************************************************************************
+    with trace_drv.span('provenance'):
+        fingerprints = []
+        qinit_id = None
+        for yyyy_mm in months:
+            fingerprint = fingerprint_month(s3_name, basin_id, lsm_exp,
+                                            lsm_mod, lsm_stp, yyyy_mm,
+                                            qinit_id)
+            if fingerprint is None:  # missing m3 file
+                break
+            fingerprints.append(fingerprint)
+            qinit_id = fingerprint
+        n_done = 0
+        for idx in reversed(range(len(fingerprints))):
+            if rapid_io_drv.drv_month_done(s3_name, basin_id, lsm_exp,
+                                           lsm_mod, lsm_stp, months[idx],
+                                           fingerprints[idx], rerun=rerun):
+                n_done = idx + 1
+                break
+    for result in results[:n_done]:
+        result['status'] = 'Done'
+    if n_done == len(months):
+        return results
+
+    # *************************************************************************
+    # Download the Qinit file of the first month
+    # *************************************************************************
+    # Note: 1979-12 only used to create Qinit of 1980-01 with zeros
+    if (months[n_done] != "1979-12"):
+        with trace_drv.span('download', file_type='Qinit'):
+            subfolder_qinit = rapid_io_drv.drv_dwn_S3(
+                s3_name, basin_id, lsm_exp, lsm_mod, lsm_stp, months[n_done],
+                'Qinit', tmp_fldr)
+        if subfolder_qinit is None:
+            fail(results[n_done:],
+                 f"Qinit file of {months[n_done]} not found")
+            return results
+
+    # *************************************************************************
+    # Chain the months locally
+    # *************************************************************************
+    # month of the Qinit file currently in tmp_fldr
+    yyyy_mm_state = months[n_done]
+    fingerprint_state = None  # fingerprint of the month producing the state
+    for idx in range(n_done, len(months)):
+        yyyy_mm = months[idx]
+        fingerprint = fingerprints[idx] if idx < len(fingerprints) else None
+        try:
+            with trace_drv.span('month', yyyy_mm=yyyy_mm):
+                run_month(results[idx], yyyy_mm, fingerprint)
+        except Exception as e:
+            # the following months depend on this one
+            fail(results[idx:], f"{yyyy_mm}: {e}")
+            break
+        yyyy_mm_state = rapid_io_drv.drv_next_month(yyyy_mm)
+        fingerprint_state = fingerprint
+
+    # *************************************************************************
+    # Upload the state reached (Qinit of the next month to simulate), so
+    # that the chain can be continued later even if a month was missing
+    # *************************************************************************
+    if yyyy_mm_state != months[n_done]:
+        q_init_file = tmp_file('Qinit', yyyy_mm_state, 'nc')
+        try:
+            with trace_drv.span('upload'):
+                upload(s3_name, q_init_file, subfolder(yyyy_mm_state),
+                       basin_id, lsm_exp, lsm_mod, lsm_stp, yyyy_mm_state,
+                       fingerprint_state)
+        except IOError as e:
+            # without this state, the last month simulated is not done
+            fail([result for result in results
+                  if result['status'] == 'Success'][-1:], str(e))
+        rapid_io_drv.drv_del_file(q_init_file)
+    else:
+        rapid_io_drv.drv_del_file(tmp_file('Qinit', months[n_done], 'nc'))
+
+    print("Upload driver: done")
+    return results
+
+
+# *****************************************************************************
+# Process one ensemble message (1 basin, 1 month, several parameter sets)
+# using tmp_fldr as scratch folder: the m3 file is downloaded once, each
+# member gets its own folder and namelist, and the members run concurrently
+# *****************************************************************************
+def process_ensemble(message_data, tmp_fldr):
+    basin_id = message_data.get('basin_id')
+    lsm_exp = message_data.get('lsm_exp')
+    lsm_mod = message_data.get('lsm_mod')
+    lsm_stp = message_data.get('lsm_stp')
+    yyyy_mm = message_data.get('yyyy_mm')
+    s3_name = message_data.get('s3_name')
+    rerun = message_data.get('rerun_legacy')
+    members = message_data.get('ensemble')
+    if members is True:
+        members = ensemble_members
+    if 'yyyy_mm_start' in message_data:
+        raise ValueError("ensemble messages are for 1 month")
+    result = {
+        'basin_id': basin_id,
+        'lsm_exp': lsm_exp,
+        'lsm_mod': lsm_mod,
+        'lsm_stp': lsm_stp,
+        'yyyy_mm': yyyy_mm,
+        'status': 'Failed',
+        'runtime_ns_sec': 0.0,
+        'members': {member: 'Failed' for member in members}
+        }
+    print(f"basin_id: {basin_id}, yyyy_mm: {yyyy_mm}, members: {members}")
+    next_month = rapid_io_drv.drv_next_month(yyyy_mm)
+
+    def subfolder(month, member):
+        return os.path.dirname(rapid_io_drv.drv_s3_key(
+            basin_id, lsm_exp, lsm_mod, lsm_stp, month, 'Qout', member))
+
+    def tmp_file(fldr, prefix, month, ext):
+        return os.path.join(fldr, "{}_pfaf_{}_{}_{}_{}_{}_utc.{}".format(
+            prefix, basin_id, lsm_exp, lsm_mod, lsm_stp, month, ext))
+
+    # *************************************************************************
+    # Do not run again the members already simulated with the same inputs.
+    # A member continues its own states, or starts from the Qinit file shared
+    # by all members (e.g. its first month)
+    # *************************************************************************
+    with trace_drv.span('provenance'):
+        qinit_members = {}
+        fingerprints = {}
+        pending = []
+        for member in members:
+            if (yyyy_mm != "1979-12"
+                    and member_has_state(s3_name, basin_id, lsm_exp,
+                                         lsm_mod, lsm_stp, yyyy_mm, member)):
+                qinit_members[member] = member
+            else:
+                qinit_members[member] = None
+            fingerprints[member] = fingerprint_month(
+                s3_name, basin_id, lsm_exp, lsm_mod, lsm_stp, yyyy_mm,
+                member=member, qinit_member=qinit_members[member])
+            if rapid_io_drv.drv_month_done(s3_name, basin_id, lsm_exp,
+                                           lsm_mod, lsm_stp, yyyy_mm,
+                                           fingerprints[member], member,
+                                           rerun):
+                result['members'][member] = 'Done'
+            else:
+                pending.append(member)
+    if not pending:
+        result['status'] = 'Done'
+        return result
+
+    # *************************************************************************
+    # Download the m3 file once, and the Qinit files (the shared one at most
+    # once), the members find them in their folders
+    # *************************************************************************
+    m3_file = tmp_file(tmp_fldr, 'm3_riv', yyyy_mm, 'nc4')
+    q_init_file = tmp_file(tmp_fldr, 'Qinit', yyyy_mm, 'nc')
+    with trace_drv.span('download', file_type='m3'):
+        if rapid_io_drv.drv_dwn_S3(s3_name, basin_id, lsm_exp, lsm_mod,
+                                   lsm_stp, yyyy_mm, 'm3', tmp_fldr) is None:
+            raise FileNotFoundError(f"m3 file of {yyyy_mm} not found")
+
+    ensemble_fldr = None
+    try:
+        # The members have their own scratch folders, also when tmp_fldr is
+        # /tmp
+        ensemble_fldr = tempfile.mkdtemp(prefix='ensemble_', dir=tmp_fldr)
+        member_fldrs = {}
+        for member in pending:
+            member_fldrs[member] = os.path.join(ensemble_fldr, member)
+            os.makedirs(member_fldrs[member])
+            os.symlink(m3_file, tmp_file(member_fldrs[member], 'm3_riv',
+                                         yyyy_mm, 'nc4'))
+            # Note: 1979-12 only used to create Qinit of 1980-01 with zeros
             if (yyyy_mm == "1979-12"):
-                rapid_io_drv.drv_del_file(q_init_zeros_file)
+                continue
+            qinit_member = qinit_members[member]
+            with trace_drv.span('download', file_type='Qinit',
+                                member=qinit_member):
+                if qinit_member is not None:
+                    subfolder_qinit = rapid_io_drv.drv_dwn_S3(
+                        s3_name, basin_id, lsm_exp, lsm_mod, lsm_stp, yyyy_mm,
+                        'Qinit', member_fldrs[member], qinit_member)
+                elif os.path.exists(q_init_file):
+                    subfolder_qinit = subfolder(yyyy_mm, None)
+                else:
+                    subfolder_qinit = rapid_io_drv.drv_dwn_S3(
+                        s3_name, basin_id, lsm_exp, lsm_mod, lsm_stp, yyyy_mm,
+                        'Qinit', tmp_fldr)
+            if subfolder_qinit is None:
+                raise FileNotFoundError(f"Qinit file of {yyyy_mm} not found")
+            if qinit_member is None:
+                os.symlink(q_init_file, tmp_file(member_fldrs[member],
+                                                 'Qinit', yyyy_mm, 'nc'))
+
+        # *********************************************************************
+        # Run the members concurrently, each in its own process
+        # *********************************************************************
+        n_workers = max(1, min(ensemble_workers, len(pending)))
+        print(f"Running {len(pending)} member(s) with {n_workers} worker(s)")
+        with trace_drv.span('ensemble',
+                            members=len(pending)) as ensemble_span:
+            member_results = rapid_io_drv.drv_run_parallel(
+                run_member, [(basin_id, lsm_mod, lsm_stp, yyyy_mm,
+                              member_fldrs[member], member)
+                             for member in pending],
+                n_workers, raise_errors=False)
+        if n_workers > 1:
+            # Spans recorded in the child processes
+            for member_result in member_results:
+                if member_result is not None:
+                    trace_drv.drv_trace_merge(member_result[1])
+        # Wall-clock time of the ensemble, the members overlap
+        result['runtime_ns_sec'] = ensemble_span['duration_sec']
+
+        # *********************************************************************
+        # Upload the Qout and Qfinal (as Qinit of next month) files of each
+        # member in its own subfolder, the Qinit being uploaded last
+        # *********************************************************************
+        errors = []
+        for member, member_result in zip(pending, member_results):
+            if member_result is None:
+                errors.append(f"{member}: RAPID failed")
+                continue
+            member_fldr = member_fldrs[member]
+            q_final_file = tmp_file(member_fldr, 'Qfinal', yyyy_mm, 'nc')
+            q_init_file_nxt_month = tmp_file(member_fldr, 'Qinit', next_month,
+                                             'nc')
+            try:
+                with trace_drv.span('upload', member=member):
+                    upload(s3_name,
+                           tmp_file(member_fldr, 'Qout', yyyy_mm, 'nc'),
+                           subfolder(yyyy_mm, member), basin_id, lsm_exp,
+                           lsm_mod, lsm_stp, yyyy_mm, fingerprints[member])
+                    # for 1979-12, the Qinit of 1980-01 has Qout as zeros
+                    if (yyyy_mm == "1979-12"):
+                        rapid_io_drv.drv_generate_initial_Qinit(
+                            q_final_file, q_init_file_nxt_month)
+                    else:
+                        os.replace(q_final_file, q_init_file_nxt_month)
+                    upload(s3_name, q_init_file_nxt_month,
+                           subfolder(next_month, member), basin_id, lsm_exp,
+                           lsm_mod, lsm_stp, next_month, fingerprints[member])
+            except Exception as e:
+                errors.append(f"{member}: {e}")
+                continue
+            result['members'][member] = 'Success'
+        print("Upload driver: done")
+    finally:
+        # *********************************************************************
+        # Delete the folders of the members, m3 and Qinit files from
+        # tmp_fldr, also when a download or a member failed
+        # *********************************************************************
+        with trace_drv.span('cleanup'):
+            if ensemble_fldr is not None:
+                shutil.rmtree(ensemble_fldr, ignore_errors=True)
+            for file_path in (m3_file, q_init_file):
+                if os.path.exists(file_path):
+                    rapid_io_drv.drv_del_file(file_path)
+        trace_drv.drv_debug_listing(tmp_fldr)
+
+    if errors:
+        # The members done are not run again when the message is redelivered
+        result['error'] = "; ".join(errors)
+        print(f"Error: {result['error']}")
+        return result
+    result['status'] = 'Success'
+    return result
+
 
-            result_filegen_check = subprocess.run(["ls", "-lR", '/tmp'],
-                                                  capture_output=True,
-                                                  text=True)
-            print("Contents (/tmp):\n", result_filegen_check.stdout)
+# *****************************************************************************
+# Process the messages of one chain (1 basin, 1 LSM model) in order
+# *****************************************************************************
+def process_chain(messages):
+    """
+    Parameters:
+    messages (list): (message_id, message_data) of the messages of the chain,
+        message_id being the id of the SQS record of the message.
+    Returns:
+    tuple: Results (one per month), cache and compression statistics and
+        trace spans.
+    """
+    stats_start = {**cache_drv.get_cache_stats(),
+                   **rapid_io_drv.get_compress_stats()}
+    results = []
+    for message_id, message_data in messages:
+        # With concurrent chains, each message gets its own scratch folder so
+        # that the chains never share file names in /tmp, and nothing is left
+        # behind by a failed message. Serial processing uses /tmp as is.
+        if max_workers > 1:
+            tmp_fldr = tempfile.mkdtemp(
+                prefix="pfaf_{}_{}_".format(
+                    message_data.get('basin_id'),
+                    message_data.get('yyyy_mm',
+                                     message_data.get('yyyy_mm_start'))),
+                dir='/tmp')
+        else:
+            tmp_fldr = '/tmp'
+
+        try:
+            with trace_drv.span('message',
+                                basin_id=message_data.get('basin_id')) as msg:
+                if message_data.get('ensemble'):
+                    message_results = [process_ensemble(message_data,
+                                                        tmp_fldr)]
+                elif 'yyyy_mm_start' in message_data:
+                    message_results = process_range(message_data, tmp_fldr)
+                else:
+                    message_results = [process_message(message_data,
+                                                       tmp_fldr)]
+        except Exception as e:
+            # The other messages are still processed, only this one is
+            # reported as failed
+            print(f"Error processing message {message_data}: {e}")
+            message_results = [{
+                'basin_id': message_data.get('basin_id'),
+                'lsm_exp': message_data.get('lsm_exp'),
+                'lsm_mod': message_data.get('lsm_mod'),
+                'lsm_stp': message_data.get('lsm_stp'),
+                'yyyy_mm': message_data.get(
+                    'yyyy_mm', message_data.get('yyyy_mm_start')),
+                'status': 'Failed',
+                'error': str(e),
+                'runtime_ns_sec': 0.0
+                }]
+        finally:
+            if tmp_fldr != '/tmp':
+                shutil.rmtree(tmp_fldr, ignore_errors=True)
+        # Phases of this message only
+        phases = trace_drv.summary(msg['span_id'])
+        for result in message_results:
+            result['message_id'] = message_id
+            result['phases'] = phases
+        results.extend(message_results)
+    # Cache/compression statistics and spans of this chain only, the chains
+    # may run in different processes of a warm container
+    stats = {name: value - stats_start[name]
+             for name, value in {**cache_drv.get_cache_stats(),
+                                 **rapid_io_drv.get_compress_stats()}.items()}
+    return results, stats, trace_drv.drv_trace_spans()
+
+
+# *****************************************************************************
+# lambda_handler
+# *****************************************************************************
+def lambda_handler(event, context):
+    global cold_start
+    t_start = time.time()
+    trace_drv.drv_trace_reset('rapid')
+    rapid_io_drv.suppress_debug_logging()  # Suppress debug messages
+    print("received event: ", event)
 
-            message = ' {} using m3 input from s3 bucket\
-                {} and uploaded Qout to s3 bucket {}!'.format(
-                basin_id, s3_name, s3_name)
+    # Group the messages in chains of the same basin and LSM model: months of
+    # a chain depend on each other through Qinit, chains are independent
+    chains = {}
+    failed_ids = set()  # SQS records with at least one failed message
+    for record in event['Records']:
+        message_id = record.get('messageId')
+        sqs_body = record['body']
+        # Split the body content into individual JSON objects
+        messages = sqs_body.strip().split('\n')
+        for message in messages:
+            try:
+                message_data = json.loads(message)
+            except ValueError as e:
+                print(f"Invalid message in record {message_id}: {e}")
+                failed_ids.add(message_id)
+                continue
+            chain_key = (message_data.get('basin_id'),
+                         message_data.get('lsm_exp'),
+                         message_data.get('lsm_mod'),
+                         message_data.get('lsm_stp'))
+            chains.setdefault(chain_key, []).append((message_id,
+                                                     message_data))
+
+    # Process the chains, concurrently if allowed and useful
+    concurrent = max_workers > 1 and len(chains) > 1
+    n_workers = min(max_workers, len(chains)) if concurrent else 1
+    print(f"Processing {len(chains)} chain(s) with {n_workers} worker(s)")
+    chain_results = rapid_io_drv.drv_run_parallel(
+        process_chain, [(messages,) for messages in chains.values()],
+        n_workers, raise_errors=False)
+    for messages, chain_result in zip(chains.values(), chain_results):
+        if chain_result is None:
+            # The process of the chain died, none of its messages is done
+            failed_ids.update(message_id for message_id, _ in messages)
+    chain_results = [chain_result for chain_result in chain_results
+                     if chain_result is not None]
+    results = [result for chain, _, _ in chain_results for result in chain]
+    cache_stats = {name: sum(stats[name] for _, stats, _ in chain_results)
+                   for name in ('cache_hits', 'cache_misses',
+                                'compress_bytes_in', 'compress_bytes_out')}
+    if concurrent:
+        # Spans recorded in the child processes
+        for _, _, spans in chain_results:
+            trace_drv.drv_trace_merge(spans)
+    failed_ids.update(result['message_id'] for result in results
+                      if result['status'] == 'Failed')
+
+    ns_runtime = sum(result['runtime_ns_sec'] for result in results)
     t_end = time.time()
     total_runtime = t_end - t_start
     max_mem_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    if concurrent:
+        max_mem_mb = max(max_mem_mb, resource.getrusage(
+            resource.RUSAGE_CHILDREN).ru_maxrss / 1024)
     print(f"[Profiling] Total RunTime: {total_runtime:.2f} seconds")
+    if cold_start:
+        print(f"[Profiling] Init (cold start) RunTime: {init_runtime:.2f} "
+              "seconds")
     print(f"[Profiling] Numerical Simulation Time: {ns_runtime:.2f} seconds")
     print(f"[Profiling] Max Memory Usage: {max_mem_mb:.2f} MB")
+    s3_stats = s3_drv.get_s3_stats()
+    print(f"[Profiling] S3 clients created: {s3_stats['s3_clients_created']}")
+    print(f"[Profiling] Cache hits/misses: {cache_stats['cache_hits']}/"
+          f"{cache_stats['cache_misses']}")
+    phases = trace_drv.summary()
+    compress_runtime = sum(phase['duration_sec']
+                           for path, phase in phases.items()
+                           if path.endswith('/compress'))
+    compress_ratio = (cache_stats['compress_bytes_in']
+                      / max(cache_stats['compress_bytes_out'], 1))
+    if rapid_io_drv.compress_enabled:
+        print(f"[Profiling] Compression: {compress_ratio:.2f}x in "
+              f"{compress_runtime:.2f} seconds")
+    print(f"Failed SQS records: {len(failed_ids)} of {len(event['Records'])}")
+    profiling = {
+        'runtime_total_sec': total_runtime,
+        'runtime_init_sec': init_runtime if cold_start else 0.0,
+        'cold_start': cold_start,
+        'runtime_ns_sec': ns_runtime,
+        'memory_max_MB': max_mem_mb,
+        'workers': n_workers,
+        's3_clients_created': s3_stats['s3_clients_created'],
+        'cache_hits': cache_stats['cache_hits'],
+        'cache_misses': cache_stats['cache_misses'],
+        'runtime_compress_sec': compress_runtime,
+        'compress_bytes_in': cache_stats['compress_bytes_in'],
+        'compress_bytes_out': cache_stats['compress_bytes_out'],
+        'compress_ratio': compress_ratio
+        }
+    trace_drv.drv_trace_emit(profiling)
+    profiling['phases'] = phases
+    cold_start = False
+    # Only the failed records are redelivered by SQS (requires
+    # ReportBatchItemFailures in the event source mapping)
     return {
-        'status': 'Success',
-        'profiling': {
-            'runtime_total_sec': total_runtime,
-            'runtime_ns_sec': ns_runtime,
-            'memory_max_MB': max_mem_mb
-            }
+        'status': 'Failed' if failed_ids else 'Success',
+        'results': results,
+        'profiling': profiling,
+        'batchItemFailures': [{'itemIdentifier': message_id}
+                              for message_id in sorted(failed_ids, key=str)]
         }
 
 # *****************************************************************************
@@ -4,11 +4,16 @@
 
 # Purpose:
 # run RRR on AWS cloud using Lambda service:
-# 1) for 1 basin, 1 month at a time
+# 1) for 1 month at a time, and 1 basin (or several basins)
 # 2) using a python driver
 # 3) using earthaccess library for Earthdata (LDAS) download
 # 4) to generate the monthly LDAS file and upload it to s3 bucket
 # 4) to generate the m3 file and upload it to s3 bucket
+# 5) preparing the LDAS file of a month once, when several basins of the same
+#    month run concurrently (lease on the LDAS file)
+# 6) reporting the SQS records whose messages failed (batchItemFailures), so
+#    that only these are redelivered, and skipping the months whose m3 file
+#    was already produced with the same inputs (provenance fingerprint)
 # Authors:
 # Manu Tom, Cedric H. David, 2023-2025
 
@@ -24,167 +29,389 @@
 #     "yyyy_mm": "2000-01"
 #     "s3_name": "currnt-data"
 # }
+# "basin_ids": ["74", "73"] instead of "basin_id" computes the m3 files of
+# several basins from one read of the LDAS file
 
 
 # *****************************************************************************
 # import libraries
 # *****************************************************************************
 import os
-import shutil
 import json
-import boto3
 import time
 import resource
+# Imported first, its import time is the beginning of the init phase
+import drv_trace as trace_drv
 import rrr_drv_MERIT_Hydro_v07_Basins_v01_GLDAS_v20 as rrr_drv
 import drv_rrr as rrr_io_drv
+import drv_s3 as s3_drv
+import drv_cache as cache_drv
+import drv_provenance as prov_drv
+import drv_static as static_drv
+import drv_granules as granules_drv
+import drv_lease as lease_drv
+import drv_vol as vol_drv
 
 
 # *****************************************************************************
 # set parameters
 # *****************************************************************************
 otpt_fldr = "/tmp/"
+# Static inputs (connect, coords, coupling) downloaded from Zenodo in the image
+inpt_root = os.environ.get('CURRNT_RRR_INPUT_DIR', '/rrr/input')
+# Volume driver of the messages of 1 basin: 'rrr' (RRR volume driver) or
+# 'csr' (sparse coupling operators of drv_vol, always used for messages of
+# several basins)
+vol_engine = os.environ.get('CURRNT_VOL_ENGINE', 'rrr')
+# '1': the runoff of the LDAS cells used by each basin is clipped into a
+# small LDAS file per basin (stored next to the global LDAS file), from
+# which the m3 file of the basin is computed without the global LDAS file
+# (drv_vol engine only)
+ldas_clip = os.environ.get('CURRNT_LDAS_CLIP', '0') == '1'
+# Earthdata collection of the LDAS granules of a LSM model and time step
+ldas_short_name = os.environ.get('CURRNT_LDAS_SHORT_NAME',
+                                 'GLDAS_{lsm_mod}10_{lsm_stp}')
+
+
+# *****************************************************************************
+# Init phase (once per container, before the first invocation): S3 client,
+# table of the hashes of the static inputs (computed at build time) used by
+# the provenance fingerprints and arrays of the static inputs
+# *****************************************************************************
+s3_drv.drv_s3_warmup()
+prov_drv.drv_load_hash_table(inpt_root)
+static_drv.drv_static_warmup(inpt_root)
+init_runtime = time.time() - trace_drv.t_import
+cold_start = True
+
+
+# *****************************************************************************
+# Inputs and outputs of one basin, 1 month
+# *****************************************************************************
+def basin_files(basin_id, lsm_exp, lsm_mod, lsm_stp, yyyy_mm):
+    inpt_fldr = os.path.join(inpt_root, "pfaf_" + basin_id)
+    return {
+        'basin_id': basin_id,
+        'rrr': rrr_drv.RRR(basin_id, lsm_mod, lsm_stp, yyyy_mm),
+        'con_csv': os.path.join(inpt_fldr, "rapid_connect_pfaf_" + basin_id
+                                + ".csv"),
+        'crd_csv': os.path.join(inpt_fldr, "coords_pfaf_" + basin_id
+                                + ".csv"),
+        'cpl_csv': os.path.join(inpt_fldr, "rapid_coupling_pfaf_" + basin_id
+                                + "_" + lsm_exp + ".csv"),
+        'm3_file_key': (
+            f"pfaf_{basin_id}/{lsm_exp}/{lsm_mod}/{lsm_stp}/{yyyy_mm}/"
+            f"m3_riv_pfaf_{basin_id}_{lsm_exp}_{lsm_mod}_{lsm_stp}_"
+            f"{yyyy_mm}_utc.nc4"
+            ),
+        'm3_file': (
+            f"/tmp/m3_riv_pfaf_{basin_id}_{lsm_exp}_{lsm_mod}_"
+            f"{lsm_stp}_{yyyy_mm}_utc.nc4"
+            ),
+        'clip_file_key': (
+            f"{lsm_exp}/{lsm_mod}/{lsm_stp}/{yyyy_mm}/clip/"
+            f"{lsm_exp}_{lsm_mod}_{lsm_stp}_{yyyy_mm}_pfaf_{basin_id}_utc.nc4"
+            ),
+        'clip_file': (
+            f"/tmp/{lsm_exp}_{lsm_mod}_{lsm_stp}_{yyyy_mm}_pfaf_{basin_id}_"
+            f"utc.nc4"
+            ),
+        }
+
+
+# *****************************************************************************
+# Process one message (1 month, 1 basin or several basins listed in
+# "basin_ids"): LDAS preparation (once), volume driver and background
+# uploads. Return the status of the message ('Done' if the m3 files of all
+# its basins were already produced with the same inputs) and the futures of
+# its uploads.
+# *****************************************************************************
+def process_message(message_data, transfers, ldas_fldrs, leases):
+    basin_ids = message_data.get('basin_ids') or [
+        message_data.get('basin_id')]
+    lsm_exp = message_data.get('lsm_exp')
+    lsm_mod = message_data.get('lsm_mod')
+    lsm_stp = message_data.get('lsm_stp')
+    yyyy_mm = message_data.get('yyyy_mm')
+    s3_name = message_data.get('s3_name')
+    # Print extracted data for debugging
+    print("basin_id:", ", ".join(basin_ids))
+    print("lsm_mod:", lsm_mod)
+    print("lsm_stp:", lsm_stp)
+    print("yyyy_mm:", yyyy_mm)
+    print("s3_name:", s3_name)
+    uploads = []
+    basins = [basin_files(basin_id, lsm_exp, lsm_mod, lsm_stp, yyyy_mm)
+              for basin_id in basin_ids]
+    ldas_file_key = (
+       f"{lsm_exp}/{lsm_mod}/{lsm_stp}/{yyyy_mm}/"
+       f"{lsm_exp}_{lsm_mod}_{lsm_stp}_{yyyy_mm}_utc.nc4"
+       )
+    local_path = f"/tmp/{os.path.basename(ldas_file_key)}"
+    # A previous message may still be uploading these files
+    with trace_drv.span('upload_wait'):
+        transfers.wait_for(local_path)
+        for basin in basins:
+            transfers.wait_for(basin['m3_file'])
+            transfers.wait_for(basin['clip_file'])
+    # *************************************************************************
+    # Do not run again a month already produced with the same inputs: LDAS
+    # file (the fingerprint of its generation, or its ETag), RRR parameters,
+    # static inputs and image version
+    # *************************************************************************
+    with trace_drv.span('provenance'):
+        ldas_fingerprint = prov_drv.drv_fingerprint(
+            model='LDAS', lsm_exp=lsm_exp, lsm_mod=lsm_mod, lsm_stp=lsm_stp,
+            yyyy_mm=yyyy_mm)
+        ldas_head = prov_drv.drv_head(s3_name, ldas_file_key)
+        for basin in basins:
+            basin['fingerprint'] = prov_drv.drv_fingerprint(
+                model='RRR', lsm_exp=lsm_exp,
+                ldas=prov_drv.drv_object_id(ldas_head) or ldas_fingerprint,
+                params=prov_drv.drv_object_params(basin['rrr']),
+                static=prov_drv.drv_file_hashes(
+                    [basin['con_csv'], basin['crd_csv'], basin['cpl_csv']]))
+            basin['state'] = prov_drv.drv_output_state(
+                prov_drv.drv_head(s3_name, basin['m3_file_key']),
+                basin['fingerprint'], message_data.get('rerun_legacy'))
+            basin['clip_fingerprint'] = prov_drv.drv_fingerprint(
+                model='LDAS_CLIP',
+                ldas=prov_drv.drv_object_id(ldas_head) or ldas_fingerprint,
+                static=prov_drv.drv_file_hashes(
+                    [basin['crd_csv'], basin['cpl_csv']]))
+    for basin in basins:
+        if basin['state'] in ('match', 'legacy'):
+            print(f"m3 file of {yyyy_mm} already in S3 for basin "
+                  f"{basin['basin_id']}")
+        elif basin['state'] == 'stale':
+            print(f"Inputs of {yyyy_mm} changed for basin "
+                  f"{basin['basin_id']}")
+    basins = [basin for basin in basins
+              if basin['state'] not in ('match', 'legacy')]
+    if not basins:
+        return 'Done', uploads
+    rrr = basins[0]['rrr']
+    ldas_fldr = "/tmp/input/pfaf_" + basins[0]['basin_id'] + "/GLDAS20/" \
+        + lsm_mod + "/" + lsm_stp + "/" + yyyy_mm
+    ldas_file = f'/tmp/{lsm_exp}_{lsm_mod}_{lsm_stp}_{yyyy_mm}_utc.nc4'
+    vol_multi = 'basin_ids' in message_data or vol_engine == 'csr'
+    # *************************************************************************
+    # Clipped LDAS files of the basins, used instead of the global LDAS file
+    # when all of them are in S3
+    # *************************************************************************
+    clipped = False
+    if ldas_clip and vol_multi and ldas_head is not None:
+        with trace_drv.span('ldas_clip_download'):
+            clipped = all(
+                prov_drv.drv_output_state(
+                    prov_drv.drv_head(s3_name, basin['clip_file_key']),
+                    basin['clip_fingerprint']) == 'match'
+                for basin in basins)
+            if clipped:
+                for basin in basins:
+                    cache_drv.drv_cached_download(
+                        s3_name, basin['clip_file_key'], basin['clip_file'])
+                print(f"Clipped LDAS files of {len(basins)} basins "
+                      "downloaded from S3")
+    # *************************************************************************
+    # The LDAS file does not depend on the basin: only one of the concurrent
+    # invocations prepares it, the others wait for it in S3
+    # *************************************************************************
+    lease = None
+    if ldas_head is None:
+        with trace_drv.span('ldas_lease'):
+            lease, ldas_head = lease_drv.drv_single_flight(
+                s3_name, ldas_file_key,
+                lambda: prov_drv.drv_head(s3_name, ldas_file_key))
+        if lease is not None:
+            # released when the LDAS file is in S3, or at the latest at the
+            # end of the invocation
+            leases.append(lease)
+    if ldas_head is None:
+        # *********************************************************************
+        # driver: download (granule search answered from a cache, downloads
+        # made by a pool of workers)
+        # *********************************************************************
+        with trace_drv.span('ed_download'):
+            rrr_io_drv.drv_dwn_ED(
+                ldas_short_name.format(lsm_mod=lsm_mod, lsm_stp=lsm_stp),
+                yyyy_mm, ldas_fldr)
+        print("Download driver: done")
+        # *********************************************************************
+        # driver: lsm
+        # *********************************************************************
+        with trace_drv.span('lsm'):
+            rrr_drv.drv_lsm(rrr)
+        print("LSM driver: done")
+        # Upload ldas files (3H) to S3 in the background, while the volume
+        # driver runs
+        if os.path.exists(ldas_fldr):
+            for root, dirs, files in os.walk(ldas_fldr):
+                for filename in files:
+                    file_path = os.path.join(root, filename)
+                    uploads.append(transfers.submit_upload(
+                        s3_name, file_path, basins[0]['basin_id'], lsm_exp,
+                        lsm_mod, lsm_stp, yyyy_mm, 'LDAS', ldas_fingerprint))
+            ldas_fldrs.append(ldas_fldr)
+    elif not clipped:
+        print(
+            f"Skipping download and LSM drivers for {ldas_file_key} "
+            "as it already exists in S3."
+            )
+        # File exists in S3, download it to /tmp (or reuse the copy cached
+        # by a previous invocation)
+        with trace_drv.span('ldas_download'):
+            cache_drv.drv_cached_download(s3_name, ldas_file_key, local_path)
+        print(f"File downloaded from S3 to {local_path}")
+    # *************************************************************************
+    # driver: volume
+    # *************************************************************************
+    cpl_csvs = [basin['cpl_csv'] for basin in basins]
+    m3_files = [basin['m3_file'] for basin in basins]
+    crd_csvs = [basin['crd_csv'] for basin in basins]
+    clip_files = [basin['clip_file'] for basin in basins]
+    if clipped:
+        with trace_drv.span('volume', n_basins=len(basins)):
+            vol_drv.drv_vol_clipped(clip_files, cpl_csvs, m3_files, crd_csvs)
+        for clip_file in clip_files:
+            rrr_io_drv.drv_del_file(clip_file)
+    elif vol_multi:
+        # All the basins of the message from one read of the LDAS file, one
+        # sparse product per block of time steps (and their clipped LDAS
+        # files written during the same read)
+        with trace_drv.span('volume', n_basins=len(basins)):
+            vol_drv.drv_vol_multi(ldas_file, cpl_csvs, m3_files, crd_csvs,
+                                  clip_files=clip_files if ldas_clip
+                                  else None)
+    else:
+        # Links (not copies) to the connect, coord, coupling files from
+        # Zenodo and to their arrays converted when building the image
+        print("Linking connect, coord, coupling files from Zenodo in /tmp")
+        with trace_drv.span('static_link'):
+            static_drv.drv_static_link(basins[0]['con_csv'], otpt_fldr)
+            static_drv.drv_static_link(basins[0]['crd_csv'], otpt_fldr)
+            static_drv.drv_static_link(basins[0]['cpl_csv'], otpt_fldr)
+        with trace_drv.span('volume'):
+            rrr_drv.drv_vol(rrr)
+    print("Volume driver: done")
+    # *************************************************************************
+    # Upload to S3 bucket
+    # *************************************************************************
+    # Upload files in the background
+    files_to_upload = [
+        (basin['m3_file'], 'm3', basin['fingerprint'], basin['basin_id'])
+        for basin in basins]
+    if ldas_clip and vol_multi and not clipped:
+        files_to_upload += [
+            (basin['clip_file'], 'clip', basin['clip_fingerprint'],
+             basin['basin_id']) for basin in basins]
+    if not clipped:
+        files_to_upload.append((ldas_file, 'LDAS', ldas_fingerprint,
+                                basins[0]['basin_id']))
+    for file_path, label, file_fingerprint, basin_id in files_to_upload:
+        if os.path.exists(file_path):
+            if label in ('m3', 'clip') or (
+                    label == 'LDAS' and
+                    not rrr_io_drv.drv_s3_file_exists(s3_name, ldas_file_key)
+                    ):
+                uploads.append(transfers.submit_upload(
+                    s3_name, file_path, basin_id, lsm_exp, lsm_mod, lsm_stp,
+                    yyyy_mm, label, file_fingerprint))
+                if label == 'LDAS' and lease is not None:
+                    uploads[-1].add_done_callback(
+                        lambda future: lease.release())
+            else:
+                rrr_io_drv.drv_del_file(file_path)
+        elif label == 'm3':
+            raise FileNotFoundError(f"m3 file not found at {file_path}")
+        else:
+            print(f"{label} file not found at {file_path}, skipping upload.")
+    return 'Success', uploads
 
 
 # *****************************************************************************
 # lambda_handler
 # *****************************************************************************
 def lambda_handler(event, context):
+    global cold_start
     t_start = time.time()
-    ed_dwnld_runtime = 0.0
-    ns_lsm_runtime = 0.0
-    ns_vol_runtime = 0.0
+    trace_drv.drv_trace_reset('rrr')
+    cache_stats_start = {**cache_drv.get_cache_stats(),
+                         **granules_drv.get_granule_stats(),
+                         **lease_drv.get_lease_stats()}
+    # Uploads run in the background and are only waited for before returning
+    transfers = rrr_io_drv.TransferQueue()
+    ldas_fldrs = []
+    leases = []
+    results = []
     print(event)
     for record in event['Records']:
+        message_id = record.get('messageId')
         sqs_body = record['body']
         # Split the body content into individual JSON objects
         messages = sqs_body.strip().split('\n')
-        # Process each message separately
+        # Process each message separately, a failed message does not stop
+        # the others
         for message in messages:
-            message_data = json.loads(message)
-            basin_id = message_data.get('basin_id')
-            lsm_exp = message_data.get('lsm_exp')
-            lsm_mod = message_data.get('lsm_mod')
-            lsm_stp = message_data.get('lsm_stp')
-            yyyy_mm = message_data.get('yyyy_mm')
-            s3_name = message_data.get('s3_name')
-            # Print extracted data for debugging
-            print("basin_id:", basin_id)
-            print("lsm_mod:", lsm_mod)
-            print("lsm_stp:", lsm_stp)
-            print("yyyy_mm:", yyyy_mm)
-            print("s3_name:", s3_name)
-            inpt_fldr = "/rrr/input/pfaf_" + basin_id
-            ldas_fldr = "/tmp/input/pfaf_" + basin_id + "/GLDAS20/" \
-                + lsm_mod + "/" + lsm_stp + "/" + yyyy_mm
-            # *****************************************************************
-            # create rrr object
-            # *****************************************************************
-            rrr = rrr_drv.RRR(basin_id, lsm_mod, lsm_stp, yyyy_mm)
-            ldas_file_key = (
-               f"{lsm_exp}/{lsm_mod}/{lsm_stp}/{yyyy_mm}/"
-               f"{lsm_exp}_{lsm_mod}_{lsm_stp}_{yyyy_mm}_utc.nc4"
-               )
-            local_path = f"/tmp/{os.path.basename(ldas_file_key)}"
-            if not rrr_io_drv.drv_s3_file_exists(s3_name, ldas_file_key):
-                # *************************************************************
-                # driver: download
-                # *************************************************************
-                t_ed_dwnld_start = time.time()
-                rrr_drv.drv_dwn(rrr)
-                t_ed_dwnld_end = time.time()
-                ed_dwnld_runtime = t_ed_dwnld_end - t_ed_dwnld_start
-                print("Download driver: done")
-                # *************************************************************
-                # driver: lsm
-                # *************************************************************
-                t_ns_lsm_start = time.time()
-                rrr_drv.drv_lsm(rrr)
-                t_ns_lsm_end = time.time()
-                ns_lsm_runtime = t_ns_lsm_end - t_ns_lsm_start
-                print("LSM driver: done")
-                # Upload ldas files (3H) to S3
-                if os.path.exists(ldas_fldr):
-                    for root, dirs, files in os.walk(ldas_fldr):
-                        for filename in files:
-                            file_path = os.path.join(root, filename)
-                            if rrr_io_drv.drv_upl_S3(s3_name, file_path,
-                                                     basin_id, lsm_exp,
-                                                     lsm_mod, lsm_stp,
-                                                     yyyy_mm, 'LDAS'):
-                                rrr_io_drv.drv_del_file(file_path)
-                    rrr_io_drv.drv_del_folder(ldas_fldr)
-                    print(
-                        f"All contents of {ldas_fldr} have been uploaded "
-                        "and deleted successfully."
-                        )
-            else:
-                print(
-                    f"Skipping download and LSM drivers for {ldas_file_key} "
-                    "as it already exists in S3."
-                    )
-                # File exists in S3, download it to /tmp
-                s3_client = boto3.client('s3')
-                try:
-                    s3_client.download_file(s3_name, ldas_file_key, local_path)
-                    print(f"File downloaded from S3 to {local_path}")
-                except Exception as e:
-                    print(f"Error downloading file from S3: {e}")
-            # *****************************************************************
-            # driver: volume
-            # *****************************************************************
-            con_csv = os.path.join(inpt_fldr, "rapid_connect_pfaf_" + basin_id
-                                   + ".csv")
-            crd_csv = os.path.join(inpt_fldr, "coords_pfaf_" + basin_id
-                                   + ".csv")
-            cpl_csv = os.path.join(inpt_fldr, "rapid_coupling_pfaf_" + basin_id
-                                   + "_" + lsm_exp + ".csv")
-
-            print("Copying connect, coord, coupling files from Zenodo to /tmp")
-            shutil.copy(con_csv, otpt_fldr)
-            shutil.copy(crd_csv, otpt_fldr)
-            shutil.copy(cpl_csv, otpt_fldr)
-            t_ns_vol_start = time.time()
-            rrr_drv.drv_vol(rrr)
-            print("Volume driver: done")
-            t_ns_vol_end = time.time()
-            ns_vol_runtime = t_ns_vol_end - t_ns_vol_start
-            # *****************************************************************
-            # Define file paths and upload to S3 bucket
-            # *****************************************************************
-            m3_file = (
-                f"/tmp/m3_riv_pfaf_{basin_id}_{lsm_exp}_{lsm_mod}_"
-                f"{lsm_stp}_{yyyy_mm}_utc.nc4"
-                )
-            ldas_file = f'/tmp/{lsm_exp}_{lsm_mod}_{lsm_stp}_{yyyy_mm}_utc.nc4'
-            # Upload files
-            files_to_upload = [(m3_file, 'm3'), (ldas_file, 'LDAS')]
-            for file_path, label in files_to_upload:
-                if os.path.exists(file_path):
-                    if label == 'm3' or (
-                            label == 'LDAS' and
-                            not rrr_io_drv.drv_s3_file_exists(s3_name,
-                                                              ldas_file_key)
-                            ):
-                        try:
-                            rrr_io_drv.drv_upl_S3(s3_name, file_path, basin_id,
-                                                  lsm_exp, lsm_mod, lsm_stp,
-                                                  yyyy_mm, label)
-                            print(f"{label} file uploaded successfully.")
-                            rrr_io_drv.drv_del_file(file_path)
-                        except Exception as e:
-                            print(f"Failed to upload {label} file: {e}")
-                else:
-                    print(
-                        f"{label} file not found at {file_path}, "
-                        "skipping upload."
-                        )
+            result = {'message_id': message_id, 'status': 'Failed',
+                      'uploads': []}
+            results.append(result)
+            try:
+                message_data = json.loads(message)
+                result['basin_id'] = message_data.get(
+                    'basin_id', message_data.get('basin_ids'))
+                result['yyyy_mm'] = message_data.get('yyyy_mm')
+                with trace_drv.span('message', basin_id=result['basin_id'],
+                                    yyyy_mm=result['yyyy_mm']):
+                    result['status'], result['uploads'] = process_message(
+                        message_data, transfers, ldas_fldrs, leases)
+            except Exception as e:
+                print(f"Error processing message {message}: {e}")
+                result['error'] = str(e)
+    # *************************************************************************
+    # Wait for the background uploads
+    # *************************************************************************
+    with trace_drv.span('upload_wait') as upl_wait:
+        n_upl_ok, n_upl_failed = transfers.wait()
+    upl_wait_runtime = upl_wait['duration_sec']
+    print(f"Uploads: {n_upl_ok} succeeded, {n_upl_failed} failed")
+    # Leases of the LDAS files not uploaded (e.g. failed messages)
+    for lease in leases:
+        lease.release()
+    # A message whose uploads failed is not done
+    for result in results:
+        if not all(future.result() for future in result.pop('uploads')):
+            result['status'] = 'Failed'
+            result['error'] = "Upload failed"
+    failed_ids = {result['message_id'] for result in results
+                  if result['status'] == 'Failed'}
+    print(f"Failed SQS records: {len(failed_ids)} of {len(event['Records'])}")
+    for ldas_fldr in ldas_fldrs:
+        rrr_io_drv.drv_del_folder(ldas_fldr)
+        print(
+            f"All contents of {ldas_fldr} have been uploaded "
+            "and deleted successfully."
+            )
     t_end = time.time()
     total_runtime = t_end - t_start
     max_mem_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024
+    # Runtimes of the drivers, summed over all the messages of the event
+    phases = trace_drv.summary()
+
+    def phase_runtime(path):
+        return phases.get(path, {}).get('duration_sec', 0.0)
+    ed_dwnld_runtime = phase_runtime('message/ed_download')
+    ns_lsm_runtime = phase_runtime('message/lsm')
+    ns_vol_runtime = phase_runtime('message/volume')
     print(
         f"[Profiling] Total RunTime: "
         f"{total_runtime:.2f} seconds"
         )
+    if cold_start:
+        print(
+            f"[Profiling] Init (cold start) RunTime: "
+            f"{init_runtime:.2f} seconds"
+            )
     print(
         f"[Profiling] Earthdata download RunTime: "
         f"{ed_dwnld_runtime:.2f} seconds"
@@ -197,16 +424,65 @@ def lambda_handler(event, context):
         f"[Profiling] Numerical Simulation (Volume driver) Time: "
         f"{ns_vol_runtime:.2f} seconds"
         )
+    print(
+        f"[Profiling] Upload wait (after computations) Time: "
+        f"{upl_wait_runtime:.2f} seconds"
+        )
     print(f"[Profiling] Max Memory Usage: {max_mem_mb:.2f} MB")
+    s3_stats = s3_drv.get_s3_stats()
+    print(f"[Profiling] S3 clients created: {s3_stats['s3_clients_created']}")
+    cache_stats = {name: value - cache_stats_start[name]
+                   for name, value in {
+                       **cache_drv.get_cache_stats(),
+                       **granules_drv.get_granule_stats(),
+                       **lease_drv.get_lease_stats()}.items()}
+    print(f"[Profiling] Cache hits/misses: {cache_stats['cache_hits']}/"
+          f"{cache_stats['cache_misses']}")
+    print(f"[Profiling] Granule search cache hits/misses: "
+          f"{cache_stats['granule_cache_hits']}/"
+          f"{cache_stats['granule_cache_misses']}")
+    print(f"[Profiling] Granules downloaded/skipped/retried: "
+          f"{cache_stats['granule_downloads']}/"
+          f"{cache_stats['granule_skipped']}/"
+          f"{cache_stats['granule_retries']}, "
+          f"{cache_stats['granule_bytes'] / 1e6:.1f} MB")
+    print(f"[Profiling] LDAS leases acquired/waited: "
+          f"{cache_stats['lease_acquired']}/{cache_stats['lease_waited']}, "
+          f"{cache_stats['lease_wait_sec']:.2f} seconds")
+    profiling = {
+        'runtime_total_sec': total_runtime,
+        'runtime_init_sec': init_runtime if cold_start else 0.0,
+        'cold_start': cold_start,
+        'runtime_ed_dwnld_sec': ed_dwnld_runtime,
+        'runtime_ns_lsm_sec': ns_lsm_runtime,
+        'runtime_ns_vol_sec': ns_vol_runtime,
+        'runtime_upl_wait_sec': upl_wait_runtime,
+        'memory_max_MB': max_mem_mb,
+        's3_clients_created': s3_stats['s3_clients_created'],
+        'cache_hits': cache_stats['cache_hits'],
+        'cache_misses': cache_stats['cache_misses'],
+        'granule_cache_hits': cache_stats['granule_cache_hits'],
+        'granule_cache_misses': cache_stats['granule_cache_misses'],
+        'granule_downloads': cache_stats['granule_downloads'],
+        'granule_skipped': cache_stats['granule_skipped'],
+        'granule_retries': cache_stats['granule_retries'],
+        'granule_bytes': cache_stats['granule_bytes'],
+        'lease_acquired': cache_stats['lease_acquired'],
+        'lease_taken_over': cache_stats['lease_taken_over'],
+        'lease_waited': cache_stats['lease_waited'],
+        'lease_wait_sec': cache_stats['lease_wait_sec']
+    }
+    trace_drv.drv_trace_emit(profiling)
+    profiling['phases'] = phases
+    cold_start = False
+    # Only the failed records are redelivered by SQS (requires
+    # ReportBatchItemFailures in the event source mapping)
     return {
-        'status': 'Success',
-        'profiling': {
-            'runtime_total_sec': total_runtime,
-            'runtime_ed_dwnld_sec': ed_dwnld_runtime,
-            'runtime_ns_lsm_sec': ns_lsm_runtime,
-            'runtime_ns_vol_sec': ns_vol_runtime,
-            'memory_max_MB': max_mem_mb
-        }
+        'status': 'Failed' if failed_ids else 'Success',
+        'results': results,
+        'profiling': profiling,
+        'batchItemFailures': [{'itemIdentifier': message_id}
+                              for message_id in sorted(failed_ids, key=str)]
     }
 
 